@@ -7,19 +7,35 @@ import seaborn as sns
 from itertools import product
 import matplotlib.pyplot as plt
 from argparse import ArgumentParser
-from typing import List, Generator
+from typing import Callable, Dict, List, Generator, Tuple
 from abc import ABC, abstractmethod
+import tensorflow as tf
 from ml4h.defines import StorageType
+from ml4h.tf_dataset import TensorMapTfDataset
+from ml4h.ml4ht_integration.tensor_map import TensorMapSampleGetter
+from ml4h.ml4ht_integration.tensor_generator import TensorMapDataLoader
+from ml4h.tensor_generators import TensorGenerator, _MultiModalMultiTaskWorker
 from contextlib import contextmanager
 from multiprocessing import cpu_count
 
-from data import build_tensor_maps, build_hd5s_ukbb, get_hd5_paths, DataDescription, SYNTHETIC_DATA_PATH
+from data import build_tensor_maps, build_corpus, DataDescription, SYNTHETIC_DATA_PATH
+from data import CODECS, CHUNKINGS, hd5s_size, read_hd5s, valid_codec_chunkings
+from profiling import MemoryProfiler, CpuProfiler, line_profile, MEMORY_COLS, WORKERS_RSS_COL, PARENT_RSS_COL, SHARED_MEMORY_COL, CPU_COL
 
 
 DELTA_COL = 'step_delta_seconds'
 WORKER_COL = 'num_workers'
 BATCH_SIZE_COL = 'batch_size'
 NAME_COL = 'name'
+LOADER_COL = 'loader'
+FIRST_BATCH_COL = 'time_to_first_batch_seconds'
+CODEC_COL = 'codec'
+CHUNKING_COL = 'chunking'
+WRITE_COL = 'write_mb_per_sec'
+READ_COL = 'read_mb_per_sec'
+DISK_COL = 'disk_mb'
+RATIO_COL = 'compression_ratio'
+STORAGE_COLS = [WRITE_COL, READ_COL, DISK_COL, RATIO_COL]
 
 
 class GeneratorFactory(ABC):
@@ -38,34 +54,174 @@ class GeneratorFactory(ABC):
     def get_name(self) -> str:
         pass
 
+    def line_profiled_functions(self) -> List[Callable]:
+        """Functions of the worker loop to profile line by line when running with no worker processes"""
+        return []
+
+    def storage_stats(self) -> Dict[str, float]:
+        """How fast setup wrote and read back the data and how large it is, if the factory measures it"""
+        return {}
+
 
 class TensorGeneratorFactory(GeneratorFactory):
+    loader = 'TensorGenerator'
 
-    def __init__(self, compression: str):
+    def __init__(
+            self, compression: str, chunking: str = 'auto', compressible: bool = False,
+            setup_workers: int = 1, seed: int = 0, rebuild: bool = False,
+    ):
+        """
+        :param compression: name of the codec in data.CODECS the hd5s are written with
+        :param chunking: name of the chunking in data.CHUNKINGS the hd5s are written with
+        :param compressible: write data that compresses like real signals instead of white noise
+        :param setup_workers: processes writing the synthetic hd5s
+        :param seed: seed of the synthetic hd5s, which are cached between runs for each seed and data spec
+        :param rebuild: rewrite the synthetic hd5s even if they are cached
+        """
         super().__init__()
         self.compression = compression
+        self.chunking = chunking
+        self.compressible = compressible
+        self.setup_workers = setup_workers
+        self.seed = seed
+        self.rebuild = rebuild
         self.tmaps = None
         self.paths = None
+        self.stats = {}
 
     def get_name(self) -> str:
-        return f'TensorGenerator_{self.compression}'
+        if self.chunking == 'auto':
+            return f'{self.loader}_{self.compression}'
+        return f'{self.loader}_{self.compression}_{self.chunking}'
 
     def setup(self, num_samples: int, data_descriptions: List[DataDescription]):
-        build_hd5s_ukbb(data_descriptions, num_samples, overwrite=True, compression=self.compression)
-        self.paths = get_hd5_paths(True, num_samples)
-        self.tmaps = build_tensor_maps(data_descriptions)
+        self.paths, write_seconds, written_bytes = build_corpus(
+            data_descriptions, num_samples, self.compression, self.chunking, self.compressible,
+            self.setup_workers, self.seed, self.rebuild,
+        )
+        self.tmaps = build_tensor_maps(data_descriptions, self.compression)
+        read_seconds, data_bytes = read_hd5s(self.paths, self.tmaps)  # the files are likely in the page cache, so this is mostly decompression
+        disk_bytes = hd5s_size(self.paths)
+        self.stats = {
+            CODEC_COL: self.compression,
+            CHUNKING_COL: self.chunking,
+            WRITE_COL: written_bytes / 1e6 / max(write_seconds, 1e-9),  # per writing process
+            READ_COL: data_bytes / 1e6 / max(read_seconds, 1e-9),
+            DISK_COL: disk_bytes / 1e6,
+            RATIO_COL: data_bytes / disk_bytes,
+        }
+        print(
+            f'{self.get_name()} wrote {self.stats[WRITE_COL]:.1f}MB/s, read {self.stats[READ_COL]:.1f}MB/s, '
+            f'{self.stats[DISK_COL]:.1f}MB on disk, compression ratio {self.stats[RATIO_COL]:.2f}',
+        )
+
+    def storage_stats(self) -> Dict[str, float]:
+        return self.stats
 
     @contextmanager
     def __call__(self, batch_size: int, num_workers: int) -> Generator:
-        from ml4h.tensor_generators import TensorGenerator
         gen = TensorGenerator(
             batch_size=batch_size, num_workers=num_workers,
             input_maps=self.tmaps, output_maps=[],
             cache_size=0, paths=self.paths,
         )
-        yield gen
+        try:
+            yield gen
+        finally:
+            gen.kill_workers()
+
+    def line_profiled_functions(self) -> List[Callable]:
+        return [
+            _MultiModalMultiTaskWorker._handle_tensor_path,
+            _MultiModalMultiTaskWorker._handle_tm,
+            _MultiModalMultiTaskWorker._open_hd5,
+        ]
+
+
+class TensorMapDataLoaderFactory(TensorGeneratorFactory):
+    """Torch DataLoader workers reading the same hd5s as TensorGeneratorFactory"""
+    loader = 'TensorMapDataLoader'
+
+    def __init__(self, *args, prefetch_factor: int = 2, **kwargs):
+        """:param prefetch_factor: batches each torch worker loads ahead"""
+        super().__init__(*args, **kwargs)
+        self.prefetch_factor = prefetch_factor
+
+    def get_name(self) -> str:
+        return f'{super().get_name()}_prefetch-{self.prefetch_factor}'
+
+    @contextmanager
+    def __call__(self, batch_size: int, num_workers: int) -> Generator:
+        gen = TensorMapDataLoader(
+            batch_size=batch_size, num_workers=num_workers,
+            input_maps=self.tmaps, output_maps=[],
+            paths=self.paths, prefetch_factor=self.prefetch_factor,
+        )
+        try:
+            yield gen
+        finally:
+            gen.kill_workers()
+
+    def line_profiled_functions(self) -> List[Callable]:
+        return [TensorMapSampleGetter.__call__, TensorMapSampleGetter._get_tensor]
+
+
+class _ClosableIterator:
+    def __init__(self, iterator):
+        self.iterator = iterator
 
+    def __next__(self):
+        return next(self.iterator)
 
+    def close(self):
+        self.iterator = None
+
+
+class TfFromGeneratorFactory(TensorGeneratorFactory):
+    """The legacy TensorGenerator wrapped with tf.data.Dataset.from_generator, as wrap_with_tf_dataset does"""
+    loader = 'TfFromGenerator'
+
+    @contextmanager
+    def __call__(self, batch_size: int, num_workers: int) -> Generator:
+        with super().__call__(batch_size, num_workers) as gen:
+            in_shapes = {tm.input_name(): (batch_size,) + tm.static_shape() for tm in self.tmaps}
+            dataset = tf.data.Dataset.from_generator(
+                lambda: gen,
+                output_types=({k: tf.float32 for k in in_shapes}, {}),
+                output_shapes=(in_shapes, {}),
+            )
+            batches = _ClosableIterator(iter(dataset))
+            try:
+                yield batches
+            finally:
+                batches.close()  # a tf iterator waits for the batches it is prefetching, so it must go before the workers
+
+
+class TensorMapTfDatasetFactory(TensorGeneratorFactory):
+    """The native tf.data pipeline, reading samples in num_workers parallel calls"""
+    loader = 'TensorMapTfDataset'
+
+    @contextmanager
+    def __call__(self, batch_size: int, num_workers: int) -> Generator:
+        gen = TensorMapTfDataset(
+            batch_size=batch_size, num_workers=num_workers,
+            input_maps=self.tmaps, output_maps=[], paths=self.paths,
+        )
+        try:
+            yield gen
+        finally:
+            gen.kill_workers()
+
+    def line_profiled_functions(self) -> List[Callable]:
+        return []  # tf.data reads in its own threads
+
+
+LOADERS = {
+    'legacy': TensorGeneratorFactory,
+    'torch': TensorMapDataLoaderFactory,
+    'tf_from_generator': TfFromGeneratorFactory,
+    'tf_data': TensorMapTfDatasetFactory,
+}
 FACTORIES = [
     TensorGeneratorFactory('gzip'),
 ]
@@ -87,21 +243,67 @@ def benchmark_generator_factory(
         generator_factory: GeneratorFactory,
         batch_sizes: List[int], workers: List[int],
         num_steps: int,
+        profile_memory: bool = False,
 ) -> pd.DataFrame:
+    """
+    Step times after the first batch for every batch size and number of workers,
+    with each cell's time to first batch, cpu used while stepping, and with profile_memory its peak memory
+    """
     result_dfs = []
     for batch_size, num_workers in product(batch_sizes, workers):
+        memory = {}
+        memory_profiler = MemoryProfiler() if profile_memory else None
+        if memory_profiler is not None:
+            memory_profiler.start()
+        created = time.time()
         with generator_factory(batch_size, num_workers) as gen:
-            start = time.time()
             print(f'Beginning test at batch size {batch_size}, workers {num_workers}')
+            next(gen)
+            first_batch_seconds = time.time() - created
+            cpu_profiler = CpuProfiler()
+            cpu_profiler.start()
+            start = time.time()
             deltas = benchmark_generator(num_steps // batch_size, gen)
-            print(f'Test at batch size {batch_size}, workers {num_workers} took {time.time() - start:.1f}s')
+            cpu_cores = cpu_profiler.stop()
+            print(
+                f'Test at batch size {batch_size}, workers {num_workers} took {time.time() - start:.1f}s '
+                f'after {first_batch_seconds:.1f}s to the first batch, using {cpu_cores:.1f} cpus',
+            )
+            if memory_profiler is not None:
+                memory = memory_profiler.stop()  # while the workers are alive
+                print(f'Peak memory: parent {memory[PARENT_RSS_COL]:.0f}MB, workers {memory[WORKERS_RSS_COL]:.0f}MB, shared {memory[SHARED_MEMORY_COL]:.0f}MB')
         result_df = pd.DataFrame({DELTA_COL: deltas})
         result_df[BATCH_SIZE_COL] = batch_size
         result_df[WORKER_COL] = num_workers
+        result_df[FIRST_BATCH_COL] = first_batch_seconds
+        result_df[CPU_COL] = cpu_cores
+        for col, value in memory.items():
+            result_df[col] = value
         result_dfs.append(result_df)
     return pd.concat(result_dfs)
 
 
+def line_profile_generator_factory(
+        generator_factory: GeneratorFactory, batch_sizes: List[int], num_steps: int, output_prefix: str,
+) -> List[str]:
+    """Line profiles of the worker loop at each batch size, run with no worker processes so the loop runs in this process"""
+    functions = generator_factory.line_profiled_functions()
+    if not functions:
+        return []
+    profile_paths = []
+    for batch_size in batch_sizes:
+        with generator_factory(batch_size, 0) as gen:
+            print(f'Line profiling at batch size {batch_size}')
+            profile_path = line_profile(
+                functions, lambda: benchmark_generator(num_steps // batch_size, gen),
+                f'{output_prefix}_{generator_factory.get_name()}_batch-size-{batch_size}_line_profile.txt',
+            )
+        if profile_path is None:
+            return profile_paths
+        profile_paths.append(profile_path)
+    return profile_paths
+
+
 class Benchmark:
 
     def __init__(
@@ -113,18 +315,33 @@ class Benchmark:
         self.batch_sizes = batch_sizes
         self.num_workers = num_workers
 
-    def run(self, factories: List[GeneratorFactory]) -> pd.DataFrame:
-        performance_dfs = []
+    def run(
+            self, factories: List[GeneratorFactory], profile_memory: bool = False, line_profile_prefix: str = None,
+            storage_only: bool = False,
+    ) -> Tuple[pd.DataFrame, pd.DataFrame]:
+        """
+        :param profile_memory: also record the peak memory of every batch size and number of workers
+        :param line_profile_prefix: if set, line profiles of each factory's worker loop are saved to files starting with it
+        :param storage_only: only set up each factory to measure its storage, without benchmarking its generators
+        :return: step times of each factory's generators, and each factory's storage stats
+        """
+        performance_dfs, storage_rows = [], []
         for factory in factories:
             name = factory.get_name()
             print(f'------------ {name} ------------')
             factory.setup(self.num_samples, self.data_descriptions)
+            storage_rows.append({NAME_COL: name, **factory.storage_stats()})
+            if storage_only:
+                continue
             performance_df = benchmark_generator_factory(
-                factory, self.batch_sizes, self.num_workers, self.num_samples,
+                factory, self.batch_sizes, self.num_workers, self.num_samples, profile_memory,
             )
+            if line_profile_prefix is not None:
+                line_profile_generator_factory(factory, self.batch_sizes, self.num_samples, line_profile_prefix)
             performance_df[NAME_COL] = name
+            performance_df[LOADER_COL] = getattr(factory, 'loader', name)
             performance_dfs.append(performance_df)
-        return pd.concat(performance_dfs)
+        return pd.concat(performance_dfs) if performance_dfs else pd.DataFrame(), pd.DataFrame(storage_rows)
 
 
 ECG_BENCHMARK = Benchmark(
@@ -182,12 +399,49 @@ def plot_benchmark(performance_df: pd.DataFrame, save_path: str, benchmark_name:
     plt.savefig(save_path, dpi=200, bbox_inches='tight')
 
 
-def run_benchmark(benchmark_name: str):
-    performance_df = BENCHMARKS[benchmark_name].run(FACTORIES)
+def plot_cell_metrics(performance_df: pd.DataFrame, metrics: List[str], save_path: str, title: str):
+    """Plot metrics measured once per benchmark cell"""
+    cell_df = performance_df.drop_duplicates([NAME_COL, BATCH_SIZE_COL, WORKER_COL]).melt(
+        id_vars=[NAME_COL, BATCH_SIZE_COL, WORKER_COL], value_vars=metrics, var_name='metric',
+    )
+    sns.catplot(
+        data=cell_df, kind='point', sharey=False,
+        hue=NAME_COL, y='value', x=WORKER_COL, col=BATCH_SIZE_COL, row='metric',
+    )
+    plt.suptitle(title, weight='bold', size='large', y=1.02)
+    print(f'Saving figure to {save_path}')
+    plt.savefig(save_path, dpi=200, bbox_inches='tight')
+
+
+def plot_storage(storage_df: pd.DataFrame, save_path: str, benchmark_name: str):
+    storage_df = storage_df.melt(id_vars=[CODEC_COL, CHUNKING_COL], value_vars=STORAGE_COLS, var_name='metric')
+    sns.catplot(
+        data=storage_df, kind='bar', sharex=False,
+        hue=CHUNKING_COL, x='value', y=CODEC_COL, col='metric', col_wrap=2,
+    )
+    plt.suptitle(f'Storage: {benchmark_name}', weight='bold', size='large', y=1.02)
+    print(f'Saving figure to {save_path}')
+    plt.savefig(save_path, dpi=200, bbox_inches='tight')
+
+
+def run_benchmark(
+        benchmark_name: str, factories: List[GeneratorFactory] = FACTORIES,
+        profile_memory: bool = False, line_profiles: bool = False, storage_only: bool = False,
+):
     output_folder = os.path.join(os.path.dirname(__file__), 'benchmark_results', benchmark_name)
     date = datetime.datetime.now().strftime('%d-%m-%Y_%H:%M:%S')
     description = f'{date}_cpus-{cpu_count()}'
     os.makedirs(output_folder, exist_ok=True)
+    performance_df, storage_df = BENCHMARKS[benchmark_name].run(
+        factories, profile_memory, os.path.join(output_folder, description) if line_profiles else None, storage_only,
+    )
+    if not storage_df.empty and CODEC_COL in storage_df:
+        storage_path = os.path.join(output_folder, f'{description}_storage.tsv')
+        print(f'Saving storage tsv to {storage_path}')
+        storage_df.to_csv(storage_path, sep='\t', index=False, float_format='%.5f')
+        plot_storage(storage_df, os.path.join(output_folder, f'{description}_storage_plot.png'), benchmark_name)
+    if storage_only:
+        return
     tsv_path = os.path.join(output_folder, f'{description}_results.tsv')
     print(f'Saving benchmark tsv to {tsv_path}')
     performance_df.to_csv(
@@ -198,21 +452,87 @@ def run_benchmark(benchmark_name: str):
         os.path.join(output_folder, f'{description}_plot.png'),
         benchmark_name,
     )
+    plot_cell_metrics(
+        performance_df, [FIRST_BATCH_COL, CPU_COL],
+        os.path.join(output_folder, f'{description}_startup_cpu_plot.png'), f'Startup and cpu: {benchmark_name}',
+    )
+    if profile_memory:
+        plot_cell_metrics(
+            performance_df, MEMORY_COLS,
+            os.path.join(output_folder, f'{description}_memory_plot.png'), f'Memory: {benchmark_name}',
+        )
 
 
 if __name__ == '__main__':
-    # TODO: add memory and line profiling
     parser = ArgumentParser()
     parser.add_argument(
         '--benchmarks', required=False, nargs='*',
         help='Benchmarks to run. If no argument is provided, all will be run.',
     )
+    parser.add_argument(
+        '--profile_memory', action='store_true',
+        help='Record peak RSS of the parent and each worker, shared memory and parent allocations of every benchmark cell.',
+    )
+    parser.add_argument(
+        '--line_profile', action='store_true',
+        help='Also save line by line profiles of the worker loop at each batch size. Needs line_profiler.',
+    )
+    parser.add_argument(
+        '--codecs', nargs='*', default=['gzip'], choices=list(CODECS),
+        help='Codecs to write the synthetic hd5s with. Each is benchmarked with every chunking it can be written with.',
+    )
+    parser.add_argument(
+        '--chunkings', nargs='*', default=['auto'], choices=list(CHUNKINGS),
+        help='Chunkings to write the synthetic hd5s with. Codecs that compress whole arrays only use whole.',
+    )
+    parser.add_argument(
+        '--codec_matrix', action='store_true',
+        help='Benchmark every codec with every chunking, instead of --codecs and --chunkings.',
+    )
+    parser.add_argument(
+        '--compressible', action='store_true',
+        help='Write data that compresses like digitized signals instead of white noise.',
+    )
+    parser.add_argument(
+        '--setup_workers', type=int, default=cpu_count(),
+        help='Processes writing the synthetic hd5s.',
+    )
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed of the synthetic hd5s. Hd5s are cached in synthetic_data between runs for each seed and data spec.',
+    )
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='Rewrite the synthetic hd5s even if they are cached.',
+    )
+    parser.add_argument(
+        '--loaders', nargs='*', default=['legacy'], choices=list(LOADERS),
+        help='Data loaders to compare on the same hd5s: the legacy multiprocess TensorGenerator, the torch TensorMapDataLoader, '
+             'the legacy generator wrapped by tf.data.Dataset.from_generator, or the native tf.data pipeline.',
+    )
+    parser.add_argument(
+        '--prefetch_factors', nargs='*', default=[2], type=int,
+        help='Batches each torch data loader worker loads ahead. Each is benchmarked.',
+    )
+    parser.add_argument(
+        '--storage_only', action='store_true',
+        help='Only measure write throughput, read throughput and size on disk of each codec and chunking.',
+    )
     args = parser.parse_args()
     benchmarks = args.benchmarks or list(BENCHMARKS)
+    if args.codec_matrix:
+        args.codecs, args.chunkings = list(CODECS), list(CHUNKINGS)
+    factories = []
+    for (codec, chunking), loader in product(valid_codec_chunkings(args.codecs, args.chunkings), args.loaders):
+        factory_args = codec, chunking, args.compressible, args.setup_workers, args.seed, args.rebuild
+        if loader == 'torch':
+            factories += [TensorMapDataLoaderFactory(*factory_args, prefetch_factor=p) for p in args.prefetch_factors]
+        else:
+            factories.append(LOADERS[loader](*factory_args))
     print(f'Will run benchmarks: {", ".join(benchmarks)}')
     os.makedirs(SYNTHETIC_DATA_PATH, exist_ok=True)
     for benchmark in benchmarks:
         print('======================================')
         print(f'Running benchmark {benchmark}')
         print('======================================')
-        run_benchmark(benchmark)
+        run_benchmark(benchmark, factories, args.profile_memory, args.line_profile, args.storage_only)
@@ -1,9 +1,16 @@
 import os
 import sys
+import json
 import time
 import h5py
+import hashlib
+import numcodecs
 import numpy as np
-from typing import Tuple, Optional, List
+from itertools import product
+from functools import partial
+from multiprocessing import Pool
+from contextlib import nullcontext
+from typing import Tuple, Optional, List, NamedTuple, Union, Dict, Callable
 
 from ml4h.defines import TENSOR_EXT, StorageType
 from ml4h.TensorMap import TensorMap, Interpretation
@@ -14,19 +21,74 @@ DataDescription = Tuple[str, Shape, StorageType]
 
 
 SYNTHETIC_DATA_PATH = os.path.join(os.path.dirname(__file__), 'synthetic_data')
+CORPUS_VERSION = 1  # bump when the synthetic data change so cached corpora are rebuilt
+CORPUS_KEY_LENGTH = 16
+CORPUS_STATS = 'corpus.json'
+WRITE_CHUNKSIZE = 8
 
 
-def random_concrete_shape(shape: Shape) -> Tuple[int, ...]:
-    return tuple(x if x is not None else 1 + np.random.randint(10) for x in shape)
+class Codec(NamedTuple):
+    """
+    How continuous data is compressed in an hd5.
+    Either an hd5 filter applied to each chunk of the dataset,
+    or a numcodecs codec that encodes the whole array into one opaque void dataset like tensor_writer_mgb and ingest_mri do.
+    """
+    compression: Optional[str] = None
+    compression_opts: Optional[int] = None
+    blob_codec: Optional[numcodecs.abc.Codec] = None
 
 
-def build_example(shape: Shape, storage_type: StorageType) -> np.ndarray:
-    shape = random_concrete_shape(shape)
+CODECS = {
+    'none': Codec(),
+    'gzip': Codec('gzip'),  # h5py's default level 4, what tensor_writer_ukbb writes
+    'gzip-1': Codec('gzip', 1),
+    'gzip-9': Codec('gzip', 9),
+    'lzf': Codec('lzf'),
+    'blosc-lz4': Codec(blob_codec=numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)),
+    'blosc-zstd': Codec(blob_codec=numcodecs.Blosc(cname='zstd', clevel=9, shuffle=numcodecs.Blosc.SHUFFLE)),  # as ingest_mri
+    'zstd': Codec(blob_codec=numcodecs.Zstd(level=19)),  # as tensor_writer_mgb
+}
+Chunks = Union[None, bool, Tuple[int, ...]]
+CHUNKINGS: Dict[str, Callable[[Tuple[int, ...]], Chunks]] = {
+    'contiguous': lambda shape: None,  # only without an hd5 filter
+    'auto': lambda shape: True,  # h5py picks chunks
+    'whole': lambda shape: shape,  # one chunk per dataset
+    'last_axis': lambda shape: shape[:-1] + (1,),  # a chunk per ECG lead or MRI slice
+}
+BLOB_CHUNKING = 'whole'  # a blob is always compressed in one piece
+
+
+def valid_codec_chunkings(codecs: List[str], chunkings: List[str]) -> List[Tuple[str, str]]:
+    """The pairs of codec and chunking that can be written"""
+    pairs = []
+    for codec, chunking in product(codecs, chunkings):
+        if CODECS[codec].blob_codec is not None and chunking != BLOB_CHUNKING:
+            continue
+        if CODECS[codec].compression is not None and chunking == 'contiguous':
+            continue
+        pairs.append((codec, chunking))
+    return pairs
+
+
+def random_concrete_shape(shape: Shape, rng: np.random.Generator) -> Tuple[int, ...]:
+    return tuple(x if x is not None else 1 + rng.integers(10) for x in shape)
+
+
+def build_example(shape: Shape, storage_type: StorageType, compressible: bool = False, rng: np.random.Generator = None) -> np.ndarray:
+    """
+    :param compressible: If True, continuous data are integer valued random walks along the first axis,
+                         which compress like digitized signals and images rather than like white noise
+    :param rng: random number generator, a fresh unseeded one if not set
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    shape = random_concrete_shape(shape, rng)
+    if storage_type == StorageType.CONTINUOUS and compressible:
+        return np.round(np.cumsum(10 * rng.standard_normal(shape), axis=0))
     if storage_type == StorageType.CONTINUOUS:
-        return np.random.randn(*shape)
+        return rng.standard_normal(shape)
     if storage_type == StorageType.STRING:
         letters = list('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789')
-        return np.random.choice(letters, shape)
+        return rng.choice(letters, shape)
     else:
         raise NotImplementedError(f'Random generation not implemented for {storage_type}')
 
@@ -35,48 +97,156 @@ def _hd5_path_to_int(path: str) -> int:
     return int(os.path.basename(path).replace(TENSOR_EXT, ''))
 
 
-def _int_to_hd5_path(i: int) -> str:
-    return os.path.join(SYNTHETIC_DATA_PATH, f'{i}{TENSOR_EXT}')
+def _int_to_hd5_path(i: int, directory: str = SYNTHETIC_DATA_PATH) -> str:
+    return os.path.join(directory, f'{i}{TENSOR_EXT}')
 
 
-def get_hd5_paths(overwrite: bool, num_hd5s: int) -> List[str]:
+def get_hd5_paths(overwrite: bool, num_hd5s: int, directory: str = SYNTHETIC_DATA_PATH) -> List[str]:
     if overwrite:
         to_write = list(range(num_hd5s))
     else:
-        to_write = [i for i in range(num_hd5s) if not os.path.exists(_int_to_hd5_path(i))]
-    return [_int_to_hd5_path(i) for i in to_write]
+        to_write = [i for i in range(num_hd5s) if not os.path.exists(_int_to_hd5_path(i, directory))]
+    return [_int_to_hd5_path(i, directory) for i in to_write]
 
 
 def write_in_hd5_ukbb(
     name: str, storage_type: StorageType, value: np.ndarray, hd5: h5py.File,
-    compression: str,
+    compression: str = 'gzip', chunking: str = 'auto',
 ):
-    """Replicates storage behavior in tensor_writer_ukbb"""
+    """Replicates storage behavior in tensor_writer_ukbb, or with a codec name from CODECS and chunking from CHUNKINGS"""
     if storage_type == StorageType.STRING:
         hd5.create_dataset(name, data=value, dtype=h5py.special_dtype(vlen=str))
+    elif storage_type == StorageType.CONTINUOUS and CODECS[compression].blob_codec is not None:
+        dataset = hd5.create_dataset(name, data=np.void(CODECS[compression].blob_codec.encode(value)))
+        dataset.attrs['shape'] = value.shape
+        dataset.attrs['dtype'] = value.dtype.str
+        dataset.attrs['codec'] = json.dumps(CODECS[compression].blob_codec.get_config())
     elif storage_type == StorageType.CONTINUOUS:
-        hd5.create_dataset(name, data=value, compression=compression)
+        codec = CODECS[compression]
+        hd5.create_dataset(
+            name, data=value, compression=codec.compression, compression_opts=codec.compression_opts,
+            chunks=CHUNKINGS[chunking](value.shape),
+        )
     else:
         raise NotImplementedError(f'{storage_type} cannot be automatically written yet')
 
 
+def _write_hd5(
+        path: str, data_descriptions: List[DataDescription], compression: str, chunking: str, compressible: bool,
+        seed: Optional[int],
+) -> Tuple[float, int]:
+    """
+    Write one synthetic hd5, returning the seconds spent writing and the bytes of data before compression.
+    With a seed, the data only depend on the seed and the sample's number.
+    The hd5 is written under a temporary name and then renamed, so an interrupted build never leaves partial hd5s.
+    """
+    rng = np.random.default_rng(None if seed is None else (seed, _hd5_path_to_int(path)))
+    examples = [
+        (name, storage_type, build_example(shape, storage_type, compressible, rng))
+        for name, shape, storage_type in data_descriptions
+    ]
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    start_time = time.time()  # only time writing, not making up data
+    with h5py.File(temp_path, 'w') as hd5:
+        for name, storage_type, data in examples:
+            write_in_hd5_ukbb(name, storage_type, data, hd5, compression, chunking)
+    write_seconds = time.time() - start_time
+    os.replace(temp_path, path)
+    return write_seconds, sum(data.nbytes for _, _, data in examples)
+
+
 def build_hd5s_ukbb(
         data_descriptions: List[DataDescription], num_hd5s: int,
-        overwrite: bool = True, compression: str = 'gzip',
-):
-    paths = get_hd5_paths(overwrite, num_hd5s)
+        overwrite: bool = True, compression: str = 'gzip', chunking: str = 'auto', compressible: bool = False,
+        directory: str = SYNTHETIC_DATA_PATH, num_workers: int = 1, seed: Optional[int] = None,
+) -> Tuple[float, int]:
+    """
+    :param compression: a codec name from CODECS
+    :param chunking: a chunking name from CHUNKINGS
+    :param compressible: write compressible data, see build_example
+    :param directory: where the hd5s are written
+    :param num_workers: processes writing hd5s in parallel
+    :param seed: if set, every hd5's data depend only on the seed and the hd5's number
+    :return: the seconds each process spent writing hd5s summed over processes, and the bytes of data written before compression
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = get_hd5_paths(overwrite, num_hd5s, directory)
+    write_seconds, data_bytes = 0., 0
+    print(f'Beginning to write {len(paths)} hd5s with {num_workers} workers')
+    write = partial(
+        _write_hd5, data_descriptions=data_descriptions, compression=compression, chunking=chunking,
+        compressible=compressible, seed=seed,
+    )
     start_time = time.time()
-    print(f'Beginning to write {len(paths)} hd5s')
-    for i, path in enumerate(paths):
-        with h5py.File(path, 'w') as hd5:
-            for name, shape, storage_type in data_descriptions:
-                data = build_example(shape, storage_type)
-                write_in_hd5_ukbb(name, storage_type, data, hd5, compression)
-        print(f'Writing hd5s {(i + 1) / len(paths):.1%} done', end='\r')
-        sys.stdout.flush()
+    with Pool(num_workers) if num_workers > 1 else nullcontext() as pool:
+        written = map(write, paths) if pool is None else pool.imap_unordered(write, paths, chunksize=WRITE_CHUNKSIZE)
+        for i, (seconds, nbytes) in enumerate(written):
+            write_seconds += seconds
+            data_bytes += nbytes
+            print(f'Writing hd5s {(i + 1) / len(paths):.1%} done', end='\r')
+            sys.stdout.flush()
     print()
     delta = time.time() - start_time
-    print(f'Wrote {len(paths)} hd5s in {delta:.1f} seconds at {len(paths) / delta:.1f} paths/s')
+    print(f'Wrote {len(paths)} hd5s in {delta:.1f} seconds at {len(paths) / max(delta, 1e-9):.1f} paths/s')
+    return write_seconds, data_bytes
+
+
+def corpus_spec(
+        data_descriptions: List[DataDescription], compression: str, chunking: str, compressible: bool, seed: int,
+) -> Dict:
+    """Everything that determines the hd5s of a seeded corpus, except how many there are"""
+    codec = CODECS[compression]
+    return {
+        'version': CORPUS_VERSION,
+        'data_descriptions': [(name, list(shape), storage_type.name) for name, shape, storage_type in data_descriptions],
+        'compression': [codec.compression, codec.compression_opts, None if codec.blob_codec is None else codec.blob_codec.get_config()],
+        'chunking': chunking,
+        'compressible': compressible,
+        'seed': seed,
+    }
+
+
+def build_corpus(
+        data_descriptions: List[DataDescription], num_hd5s: int,
+        compression: str = 'gzip', chunking: str = 'auto', compressible: bool = False,
+        num_workers: int = 1, seed: int = 0, rebuild: bool = False,
+) -> Tuple[List[str], float, int]:
+    """
+    Seeded synthetic hd5s cached between runs in a directory of SYNTHETIC_DATA_PATH named by a hash of the corpus spec.
+    Since each hd5 depends only on the spec and its number, only hd5s missing from the cache are written,
+    so a corpus grows when a benchmark asks for more samples.
+
+    :param rebuild: write every hd5 even if it is cached
+    :return: paths to num_hd5s hd5s, and the write seconds and uncompressed bytes of every hd5 in the corpus as in build_hd5s_ukbb
+    """
+    spec = corpus_spec(data_descriptions, compression, chunking, compressible, seed)
+    key = hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()[:CORPUS_KEY_LENGTH]
+    directory = os.path.join(SYNTHETIC_DATA_PATH, key)
+    stats_path = os.path.join(directory, CORPUS_STATS)
+    stats = {'spec': spec, 'write_seconds': 0., 'data_bytes': 0, 'num_hd5s': 0}
+    if os.path.exists(stats_path) and not rebuild:
+        with open(stats_path) as stats_file:
+            stats = json.load(stats_file)
+    missing = len(get_hd5_paths(rebuild, num_hd5s, directory))
+    if missing:
+        write_seconds, data_bytes = build_hd5s_ukbb(
+            data_descriptions, num_hd5s, rebuild, compression, chunking, compressible, directory, num_workers, seed,
+        )
+        stats['write_seconds'] += write_seconds
+        stats['data_bytes'] += data_bytes
+        stats['num_hd5s'] = max(stats['num_hd5s'], num_hd5s)
+        with open(stats_path, 'w') as stats_file:
+            json.dump(stats, stats_file, indent=2)
+    else:
+        print(f'Using {num_hd5s} cached hd5s in {directory}')
+    return get_hd5_paths(True, num_hd5s, directory), stats['write_seconds'], stats['data_bytes']
+
+
+def tensor_from_blob(tm: TensorMap, hd5: h5py.File, dependents=None) -> np.ndarray:
+    """Reads an array written as one numcodecs encoded void dataset"""
+    dataset = hd5[tm.name]
+    decoded = numcodecs.get_codec(json.loads(dataset.attrs['codec'])).decode(dataset[()].tobytes())
+    return np.frombuffer(decoded, dtype=dataset.attrs['dtype']).reshape(dataset.attrs['shape'])
 
 
 STORAGE_TYPE_TO_INTERPRETATION = {
@@ -86,15 +256,33 @@ STORAGE_TYPE_TO_INTERPRETATION = {
 
 
 def build_tensor_maps(
-    data_descriptions: List[DataDescription],
+    data_descriptions: List[DataDescription], compression: str = 'gzip',
 ) -> List[TensorMap]:
+    """TensorMaps that read the data descriptions, as written with the codec named compression"""
     tmaps = []
     for name, shape, storage_type in data_descriptions:
+        blob = storage_type == StorageType.CONTINUOUS and CODECS[compression].blob_codec is not None
         tmaps.append(
             TensorMap(
                 name,
                 interpretation=STORAGE_TYPE_TO_INTERPRETATION[storage_type],
                 shape=shape,
+                tensor_from_file=tensor_from_blob if blob else None,
             ),
         )
     return tmaps
+
+
+def hd5s_size(paths: List[str]) -> int:
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def read_hd5s(paths: List[str], tmaps: List[TensorMap]) -> Tuple[float, int]:
+    """Seconds to read every TensorMap from every hd5 once in this process, and the bytes of the tensors read"""
+    start_time = time.time()
+    data_bytes = 0
+    for path in paths:
+        with h5py.File(path, 'r') as hd5:
+            for tm in tmaps:
+                data_bytes += tm.tensor_from_file(tm, hd5, {}).nbytes
+    return time.time() - start_time, data_bytes
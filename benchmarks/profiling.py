@@ -0,0 +1,170 @@
+import os
+import time
+import shutil
+import threading
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional
+
+
+SHARED_MEMORY_PATH = '/dev/shm'
+MEMORY_SAMPLE_SECONDS = .05
+MB = 2 ** 20
+
+PARENT_RSS_COL = 'parent_rss_peak_mb'
+WORKER_RSS_COL = 'worker_rss_peak_mb'  # the largest peak of any worker
+WORKERS_RSS_COL = 'workers_rss_peak_total_mb'  # the sum of the workers' peaks
+SHARED_MEMORY_COL = 'shared_memory_peak_mb'
+PARENT_ALLOCATED_COL = 'parent_allocated_peak_mb'
+PARENT_BLOCKS_COL = 'parent_allocated_blocks'
+MEMORY_COLS = [PARENT_RSS_COL, WORKER_RSS_COL, WORKERS_RSS_COL, SHARED_MEMORY_COL, PARENT_ALLOCATED_COL, PARENT_BLOCKS_COL]
+CPU_COL = 'cpu_cores_used'  # cpu seconds of this process and its workers per second of wall time
+
+
+def _status_kb(pid: int, field: str) -> int:
+    """A memory field of /proc/<pid>/status in kB, 0 if the process is gone"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith(field):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return 0
+
+
+def _children(pid: int) -> List[int]:
+    """Every descendant process of pid, found by their parent pids in /proc"""
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat:
+                parents[int(entry)] = int(stat.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    descendants, frontier = [], [pid]
+    while frontier:
+        frontier = [child for child, parent in parents.items() if parent in frontier]
+        descendants += frontier
+    return descendants
+
+
+def _cpu_seconds(pid: int) -> float:
+    """User and system cpu seconds of a process and all its threads, 0 if the process is gone"""
+    try:
+        with open(f'/proc/{pid}/stat') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')  # utime and stime
+
+
+def _shared_memory_used() -> int:
+    if not os.path.exists(SHARED_MEMORY_PATH):
+        return 0
+    return shutil.disk_usage(SHARED_MEMORY_PATH).used
+
+
+class MemoryProfiler:
+    """
+    Peak memory of a benchmark cell, sampled in a background thread.
+    Worker peaks are the larger of their sampled RSS and the kernel's high water mark when the cell ends,
+    so the workers must still be alive when stop is called.
+    Parent allocations are traced with tracemalloc, which slows the parent down.
+    Tracing is left on once started, since stopping it while other threads allocate, like tf.data's, can crash.
+    Memory is read from /proc, so worker and parent RSS are only measured on Linux.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.worker_peaks: Dict[int, int] = defaultdict(int)
+        self.earlier_children = set()  # e.g. workers of earlier cells that have not exited yet
+        self.parent_peak = 0
+        self.shared_memory_start = 0
+        self.shared_memory_peak = 0
+        self.start_snapshot = None
+        self.done = threading.Event()
+        self.thread = None
+
+    def _sample(self):
+        self.parent_peak = max(self.parent_peak, _status_kb(self.pid, 'VmRSS') * 1024)
+        self.shared_memory_peak = max(self.shared_memory_peak, _shared_memory_used() - self.shared_memory_start)
+        for child in set(_children(self.pid)) - self.earlier_children:
+            self.worker_peaks[child] = max(self.worker_peaks[child], _status_kb(child, 'VmRSS') * 1024)
+
+    def _run(self):
+        while not self.done.wait(MEMORY_SAMPLE_SECONDS):
+            self._sample()
+
+    def start(self):
+        self.earlier_children = set(_children(self.pid))
+        self.shared_memory_start = _shared_memory_used()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.start_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> Dict[str, float]:
+        self.done.set()
+        self.thread.join()
+        self._sample()
+        for child in list(self.worker_peaks):
+            self.worker_peaks[child] = max(self.worker_peaks[child], _status_kb(child, 'VmHWM') * 1024)
+        _, allocated_peak = tracemalloc.get_traced_memory()
+        new_blocks = sum(diff.count_diff for diff in tracemalloc.take_snapshot().compare_to(self.start_snapshot, 'filename'))
+        worker_peaks = list(self.worker_peaks.values()) or [0]
+        return {
+            PARENT_RSS_COL: self.parent_peak / MB,
+            WORKER_RSS_COL: max(worker_peaks) / MB,
+            WORKERS_RSS_COL: sum(worker_peaks) / MB,
+            SHARED_MEMORY_COL: self.shared_memory_peak / MB,
+            PARENT_ALLOCATED_COL: allocated_peak / MB,
+            PARENT_BLOCKS_COL: new_blocks,
+        }
+
+
+class CpuProfiler:
+    """
+    Cpu used by this process and its workers between start and stop.
+    Workers must still be alive when stop is called, and workers that exit in between are not counted.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.start_seconds: Dict[int, float] = {}
+        self.start_time = 0.
+
+    def _cpu_seconds(self) -> Dict[int, float]:
+        return {pid: _cpu_seconds(pid) for pid in [self.pid] + _children(self.pid)}
+
+    def start(self):
+        self.start_seconds = self._cpu_seconds()
+        self.start_time = time.time()
+
+    def stop(self) -> float:
+        seconds = self._cpu_seconds()
+        used = sum(cpu - self.start_seconds.get(pid, 0.) for pid, cpu in seconds.items())
+        return used / max(time.time() - self.start_time, 1e-9)
+
+
+def line_profile(functions: List[Callable], run: Callable[[], None], output_path: str) -> Optional[str]:
+    """
+    Run with a line by line profile of functions, written to output_path.
+    Needs the optional line_profiler package, without it run is not called and None is returned.
+    """
+    try:
+        from line_profiler import LineProfiler
+    except ImportError:
+        print('Skipping line profile, it needs line_profiler: pip install line_profiler')
+        return None
+    profiler = LineProfiler(*functions)
+    start = time.time()
+    profiler.runcall(run)
+    with open(output_path, 'w') as output:
+        profiler.print_stats(stream=output, output_unit=1e-3)
+    print(f'Line profiled for {time.time() - start:.1f}s, saved to {output_path}')
+    return output_path
@@ -112,6 +112,8 @@ class TensorMap(object):
         time_series_order: Optional[TimeSeriesOrder] = TimeSeriesOrder.NEWEST,
         time_series_lookup: Optional[Dict[int,Tuple]] = None,
         discretization_bounds: Optional[List[float]] = None,
+        dtype: Optional[np.dtype] = np.float32,
+        hd5_keys: Optional[List[str]] = None,
     ):
         """TensorMap constructor
 
@@ -142,6 +144,9 @@ class TensorMap(object):
         :param time_series_lookup: Dict of time intervals filtering which tensors are used in a time series
         :param discretization_bounds: List of floats that delineate the boundaries of the bins that will be used
                                           for producing categorical values from continuous values
+        :param dtype: numpy dtype of the legacy tensor generators' batch arrays for this TensorMap
+        :param hd5_keys: HD5 paths, any one of which a sample must have for tensor_from_file to succeed.
+                         Lets a sample index skip samples without them. Inferred for the default tensor_from_file.
         """
         self.name = name
         self.interpretation = interpretation
@@ -169,6 +174,8 @@ class TensorMap(object):
         self.time_series_order = time_series_order
         self.time_series_lookup = time_series_lookup
         self.discretization_bounds = discretization_bounds
+        self.dtype = dtype
+        self.hd5_keys = hd5_keys
 
         # Infer loss from interpretation
         if self.loss is None and self.is_categorical():
@@ -286,6 +293,25 @@ class TensorMap(object):
         else:
             return f'/{self.path_prefix}/{self.name}/'
 
+    def required_hd5_keys(self) -> Optional[List[str]]:
+        """HD5 paths any one of which a sample needs for this TensorMap to load it, or None if that is unknown"""
+        if self.hd5_keys is not None:
+            return self.hd5_keys
+        if self.tensor_from_file is not _default_tensor_from_file or self.sentinel is not None:
+            return None
+        if self.is_discretized():
+            channel_map = self.input_channel_map
+        elif self.is_categorical() and self.storage_type != StorageType.CATEGORICAL_FLAG:
+            channel_map = self.channel_map
+        elif self.is_continuous():
+            channel_map = self.channel_map
+        else:
+            return None
+        keys = [self.hd5_key_guess()]
+        if self.path_prefix is not None and channel_map is not None:
+            keys += [f'/{self.path_prefix}/{k}' for k in channel_map]
+        return keys
+
     def hd5_first_dataset_in_group(self, hd5, key_prefix):
         if key_prefix not in hd5:
             raise ValueError(f'Could not find key:{key_prefix} in hd5.')
@@ -308,11 +334,28 @@ class TensorMap(object):
             num_classes=len(self.discretization_bounds) + 1,
         )
 
-    def postprocess_tensor(self, np_tensor, augment: bool, hd5: h5py.File):
+    def _validate(self, np_tensor, hd5: h5py.File):
         self.validator(self, np_tensor, hd5)
-        np_tensor = self.apply_augmentations(np_tensor, augment)
-        np_tensor = self.normalize(np_tensor)
-        return self.discretize(np_tensor)
+        return np_tensor
+
+    def postprocess_stages(self, augment: bool, hd5: h5py.File) -> List[Tuple[str, Callable[[np.ndarray], np.ndarray]]]:
+        """The named stages that turn a tensor from tensor_from_file into the tensor the model sees, in order"""
+        return [
+            ('validate', lambda np_tensor: self._validate(np_tensor, hd5)),
+            ('augment', lambda np_tensor: self.apply_augmentations(np_tensor, augment)),
+            ('normalize', self.normalize),
+            ('discretize', self.discretize),
+        ]
+
+    def postprocess_tensor(self, np_tensor, augment: bool, hd5: h5py.File, profiler=None):
+        """
+        Validate, augment, normalize and discretize a tensor read by tensor_from_file
+
+        :param profiler: If set, a TensorMapProfiler that records the time and output size of each stage
+        """
+        for stage, transform in self.postprocess_stages(augment, hd5):
+            np_tensor = transform(np_tensor) if profiler is None else profiler.run(self.name, stage, transform, np_tensor)
+        return np_tensor
 
     def rescale(self, np_tensor):
         if self.normalization is None:
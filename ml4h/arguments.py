@@ -25,11 +25,12 @@ from typing import Set, Dict, List, Optional, Tuple
 from collections import defaultdict
 
 from ml4h.logger import load_config
+from ml4h.correlations import CORRELATION_METHODS
 from ml4h.TensorMap import TensorMap, TimeSeriesOrder
 from ml4h.models.legacy_models import parent_sort, BottleneckType, check_no_bottleneck
 from ml4h.models.legacy_models import NORMALIZATION_CLASSES, CONV_REGULARIZATION_CLASSES, DENSE_REGULARIZATION_CLASSES
 from ml4h.tensormap.mgb.dynamic import make_mgb_dynamic_tensor_maps
-from ml4h.defines import IMPUTATION_RANDOM, IMPUTATION_MEAN
+from ml4h.defines import IMPUTATION_RANDOM, IMPUTATION_MEAN, SAMPLERS, INFERENCE_FORMATS, EMBEDDING_FORMATS, EMBEDDING_DTYPES
 from ml4h.tensormap.tensor_map_maker import generate_continuous_tensor_map_from_file, generate_random_text_tensor_maps, make_test_tensor_maps, \
     generate_random_pixel_as_text_tensor_maps
 
@@ -73,11 +74,31 @@ def parse_args():
     parser.add_argument('--dicoms', default='./dicoms/', help='Path to folder of dicoms.')
     parser.add_argument('--sample_csv', default=None, help='Path to CSV with Sample IDs to restrict tensor paths')
     parser.add_argument('--tsv_style', default='standard', choices=['standard', 'genetics'], help='Format choice for the TSV file produced in output by infer and explore modes.')
+    parser.add_argument(
+        '--inference_format', default='tsv', choices=INFERENCE_FORMATS,
+        help='Format of infer mode predictions. tsv writes one file, parquet and arrow write a directory of typed columnar files with a manifest.',
+    )
+    parser.add_argument('--inference_writers', default=1, type=int, help='Number of parallel writers of parquet or arrow inference, each writes its own files.')
+    parser.add_argument('--inference_row_group_size', default=65536, type=int, help='Rows in each row group of parquet or arrow inference.')
+    parser.add_argument(
+        '--inference_partition_size', default=0, type=int,
+        help='If positive, parquet or arrow inference is split into files by sample id ranges of this size. Needs numeric sample ids.',
+    )
+    parser.add_argument(
+        '--embedding_format', default='tsv', choices=EMBEDDING_FORMATS,
+        help='Format of infer_hidden mode embeddings. npy writes memory mappable matrix shards with a sample id index.',
+    )
+    parser.add_argument('--embedding_dtype', default='float32', choices=EMBEDDING_DTYPES, help='Data type of npy embeddings.')
+    parser.add_argument('--embedding_shard_size', default=65536, type=int, help='Samples in each npy embedding shard.')
     parser.add_argument('--app_csv', help='Path to file used to link sample IDs between UKBB applications 17488 and 7089')
     parser.add_argument('--tensors', help='Path to folder containing tensors, or where tensors will be written.')
     parser.add_argument('--output_folder', default='./recipes_output/', help='Path to output folder for recipes.py runs.')
     parser.add_argument('--model_file', help='Path to a saved model architecture and weights (hd5).')
     parser.add_argument('--model_files', nargs='*', default=[], help='List of paths to saved model architectures and weights (hd5).')
+    parser.add_argument(
+        '--comparison_threads', default=0, type=int,
+        help='Number of model_files predicting each batch in parallel when comparing models, one thread per model if 0.',
+    )
     parser.add_argument('--model_layers', help='Path to a model file (hd5) which will be loaded by layer, useful for transfer learning.')
     parser.add_argument('--freeze_model_layers', default=False, action='store_true', help='Whether to freeze the layers from model_layers.')
     parser.add_argument('--text_file', default=None, help='Path to a file with text.')
@@ -107,6 +128,11 @@ def parse_args():
     parser.add_argument('--include_instance', default=False, action='store_true', help='Include instances for UKBB phenotypes.')
     parser.add_argument('--min_values', default=10, type=int, help='Per feature size minimum.')
     parser.add_argument('--min_samples', default=3, type=int, help='Min number of samples to require for calculating correlations.')
+    parser.add_argument(
+        '--correlation_method', default='pearson', choices=CORRELATION_METHODS,
+        help='Correlation of the tabulate_correlations mode. Spearman ranks each field over all of its samples, '
+             'so it is approximate for pairs of fields whose missing samples differ.',
+    )
     parser.add_argument(
         '--max_samples', type=int, default=None,
         help='Max number of samples to use for tensor reporting -- all samples are used if not specified.',
@@ -272,11 +298,92 @@ def parse_args():
     parser.add_argument("--embed_visualization", help="Method to visualize embed layer. Options: None, tsne, or umap")
     parser.add_argument('--attractor_iterations', default=3, type=int, help='Number of iterations for autoencoder generated fixed points.')
     parser.add_argument("--explore_export_errors", default=False, action="store_true", help="Export error_type columns in tensors_all*.csv generated by explore.")
+    parser.add_argument(
+        '--explore_skip_csv', default=False, action='store_true',
+        help='Only write the parquet dataset of explored tensors, skipping the tensors_all*.csv exports.',
+    )
+    parser.add_argument('--explore_chunk_size', default=64, type=int, help='Number of hd5s each explore worker reads at a time.')
     parser.add_argument('--plot_hist', default=True, help='Plot histograms of continuous tensors in explore mode.')
 
     # Training optimization options
     parser.add_argument('--num_workers', default=multiprocessing.cpu_count(), type=int, help="Number of workers to use for every tensor generator.")
     parser.add_argument('--cache_size', default=3.5e9/multiprocessing.cpu_count(), type=float, help="Tensor map cache size per worker.")
+    parser.add_argument(
+        '--shared_memory_transport', default=False, action='store_true',
+        help='Send batches from tensor generator workers through a ring of shared memory slabs instead of pickling them. '
+             'Only the legacy generator implements this, so it is used instead of the data loader.',
+    )
+    parser.add_argument(
+        '--buffer_pool', default=False, action='store_true',
+        help='Tensor generator workers allocate batch arrays once and reuse them. '
+             'Only the legacy generator implements this, so it is used instead of the data loader.',
+    )
+    parser.add_argument(
+        '--shared_cache', default=False, action='store_true',
+        help='Workers share one least recently used tensor cache of cache_size * num_workers bytes in shared memory, '
+             'instead of each worker filling its own cache once.',
+    )
+    parser.add_argument(
+        '--tensor_cache_dir', default=None,
+        help='Directory of a persistent cache of postprocessed tensors, keyed by TensorMap definition and hd5 modification time. '
+             'Reused across epochs and runs. Augmentations still run live.',
+    )
+    parser.add_argument(
+        '--fused_hd5_reads', default=False, action='store_true',
+        help='Tensor generator workers look up each hd5 group and read each dataset once per sample for all TensorMaps, '
+             'prefetching the datasets learned from the first samples. '
+             'Only the legacy generator implements this, so it is used instead of the data loader.',
+    )
+    parser.add_argument(
+        '--read_ahead', default=0, type=int,
+        help='Number of upcoming samples whose files each legacy generator worker reads into memory in background threads, '
+             'overlapping slow storage reads with postprocessing. 0 reads each file when it is needed. '
+             'Only the legacy generator implements this, so it is used instead of the data loader.',
+    )
+    parser.add_argument(
+        '--generator_metrics', default=False, action='store_true',
+        help='Append per worker and per TensorMap read time, postprocess time, cache and error metrics of every legacy '
+             'generator epoch to <generator>_metrics.jsonl in the output folder. '
+             'Only the legacy generator implements this, so it is used instead of the data loader.',
+    )
+    parser.add_argument(
+        '--profile_tensor_maps', default=False, action='store_true',
+        help='Histogram the latency, output bytes, allocated bytes and bytes read from storage of every TensorMap read, validate, augment, normalize and discretize stage '
+             'in the legacy generator and data loader workers, logging a summary table every epoch '
+             'and appending it to <generator>_tensor_map_profile.tsv files in the output folder.',
+    )
+    parser.add_argument(
+        '--tf_data', default=False, action='store_true',
+        help='Load batches with a tf.data pipeline that reads samples in parallel threads and prefetches batches, '
+             'instead of worker processes. Not used with mixup or siamese models.',
+    )
+    parser.add_argument(
+        '--tf_data_cache', default=False, action='store_true',
+        help='With --tf_data, keep the tensors the training and validation pipelines read in memory after their first epoch, '
+             'training only when no input or output TensorMap has augmentations. The whole dataset must fit in memory.',
+    )
+    parser.add_argument(
+        '--sampler', default='shuffle', choices=SAMPLERS,
+        help='How the training data loader picks samples each epoch when not balancing csvs. '
+             'shuffle visits every sample once, class_balanced draws every label equally often, '
+             'stratified visits every sample once with each label spread evenly through the epoch.',
+    )
+    parser.add_argument(
+        '--sampler_label', default=None,
+        help='Name of the output TensorMap that class_balanced and stratified samplers read labels from. '
+             'Defaults to the first categorical output.',
+    )
+    parser.add_argument(
+        '--sample_index', default=None,
+        help='Parquet index of the datasets in each sample hd5. Built from --tensors if it does not exist. '
+             'Samples are read from it instead of listing --tensors, and samples missing TensorMaps are skipped. '
+             'Random train/valid/test splits follow the order of the index without the skipped samples, '
+             'so the same --random_seed can assign samples to different sets than without an index.',
+    )
+    parser.add_argument(
+        '--update_sample_index', default=False, action='store_true',
+        help='Rescan new and changed samples in --tensors into --sample_index before training.',
+    )
 
     # Cross reference arguments
     parser.add_argument(
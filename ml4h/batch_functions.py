@@ -0,0 +1,108 @@
+# batch_functions.py
+#
+# Batch level transforms applied to each collated batch, by the legacy TensorGenerator workers
+# and as the collate function of TensorMapDataLoader.
+# Each takes an input batch, an output batch, whether to return paths and the batch's paths,
+# and returns (in_batch, out_batch) or (in_batch, out_batch, paths).
+# Mixup and siamese pair the first half of a batch with the second half, so they need batches twice as big as they yield.
+
+from functools import partial
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+Path = str
+Batch = Dict[Path, np.ndarray]
+BatchFunction = Callable[[Batch, Batch, bool, List[Path], 'kwargs'], Any]
+
+
+def _identity_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
+    return (in_batch, out_batch, paths) if return_paths else (in_batch, out_batch)
+
+
+def _weighted_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
+    return (in_batch, out_batch, paths) if return_paths else (in_batch, out_batch)
+
+
+def _batch_size(batch: Batch) -> int:
+    return next(iter(batch.values())).shape[0]
+
+
+def _mixup_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path], alpha: float = 1.0, permute_first: bool = False):
+    full_batch = _batch_size(in_batch)
+    half_batch = full_batch // 2
+
+    if permute_first:
+        permuted = np.random.permutation(full_batch)
+        in_batch = {k: v[permuted] for k, v in in_batch.items()}
+        out_batch = {k: v[permuted] for k, v in out_batch.items()}
+        paths = [paths[i] for i in permuted] if paths else paths
+
+    weights = np.random.beta(alpha, alpha, size=half_batch)
+
+    def _mix(array: np.ndarray) -> np.ndarray:
+        weight = weights.reshape((half_batch,) + (1,) * (array.ndim - 1))  # broadcasts over the sample's axes
+        return array[:half_batch] * weight + array[half_batch:2 * half_batch] * (1 - weight)
+
+    mixed_ins = {k: _mix(v) for k, v in in_batch.items()}
+    mixed_outs = {k: _mix(v) for k, v in out_batch.items()}
+    return _identity_batch(mixed_ins, mixed_outs, return_paths, paths[:half_batch])
+
+
+def _make_batch_siamese(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
+    half_batch = _batch_size(in_batch) // 2
+
+    siamese_in = {f'{k}_left': np.array(v[:half_batch], dtype=np.float64) for k, v in in_batch.items()}
+    siamese_in.update({f'{k}_right': np.array(v[half_batch:2 * half_batch], dtype=np.float64) for k, v in in_batch.items()})
+
+    # Each pair is compared on one randomly chosen output, and labeled 0 if they match on it and 1 if not
+    keys = list(out_batch.keys())
+    differs = np.stack(
+        [
+            np.any(
+                out_batch[k][:half_batch].reshape(half_batch, -1) != out_batch[k][half_batch:2 * half_batch].reshape(half_batch, -1),
+                axis=1,
+            )
+            for k in keys
+        ],
+        axis=1,
+    )
+    random_tasks = np.random.randint(len(keys), size=half_batch)
+    siamese_out = {'output_siamese': differs[np.arange(half_batch), random_tasks].astype(np.float64)[:, np.newaxis]}
+
+    return _identity_batch(siamese_in, siamese_out, return_paths, paths)
+
+
+def pick_batch_function(mixup_alpha: float = 0.0, siamese: bool = False) -> Tuple[BatchFunction, Dict, int]:
+    """
+    The batch function for a training mode, its keyword arguments,
+    and how many samples must be collated for each row of the batches it yields.
+    """
+    if mixup_alpha > 0:
+        return _mixup_batch, {'alpha': mixup_alpha}, 2
+    if siamese:
+        return _make_batch_siamese, {}, 1
+    return _identity_batch, {}, 1
+
+
+def _apply_batch_function(
+        samples: Sequence[Tuple], collate_fn: Callable, batch_function: BatchFunction, return_paths: bool, batch_function_kwargs: Dict,
+):
+    if return_paths:
+        in_batch, out_batch = collate_fn([sample[:2] for sample in samples])
+        paths = [sample[2] for sample in samples]
+    else:
+        in_batch, out_batch = collate_fn(samples)
+        paths = []
+    return batch_function(in_batch, out_batch, return_paths, paths, **batch_function_kwargs)
+
+
+def batch_function_collate(collate_fn: Callable, batch_function: BatchFunction, return_paths: bool, **batch_function_kwargs) -> Callable:
+    """
+    A collate function that collates samples with collate_fn then applies batch_function to the batch.
+    Samples are (in_batch, out_batch) or (in_batch, out_batch, path) if return_paths.
+    """
+    return partial(
+        _apply_batch_function, collate_fn=collate_fn, batch_function=batch_function,
+        return_paths=return_paths, batch_function_kwargs=batch_function_kwargs,
+    )
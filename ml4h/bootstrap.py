@@ -0,0 +1,173 @@
+# bootstrap.py
+#
+# Bootstrap distributions of performance metrics, computed a chunk of resamples at a time.
+# Each chunk draws its resample indices from its own seed, gathers the resampled truth and predictions as (resamples, samples) arrays,
+# and computes a metric for every resample at once with rank based formulas, so memory is bounded by the chunk, not by the number of resamples.
+# Chunk seeds are spawned from one seed, so results only depend on the seed, whether chunks run in this process or a pool.
+
+import logging
+from multiprocessing import Pool
+from typing import Callable, Dict, Optional, Tuple, Union
+
+import numpy as np
+from scipy.stats import rankdata
+
+from ml4h.metrics import concordance_index_censored
+
+BOOTSTRAP_CHUNK_ELEMENTS = 2 ** 22  # resampled values per chunk, bounding each chunk's arrays to tens of MB
+BOOTSTRAP_SAMPLES = 1000
+
+
+def batch_roc_auc(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+    """
+    Area under the ROC curve of each row of (resamples, samples) binary truth and scores, from the Mann-Whitney U statistic.
+    Ties in scores count half, like sklearn.metrics.roc_auc_score. Rows with only one class are NaN.
+    """
+    ranks = rankdata(prediction, axis=-1)
+    positive = truth > 0.5
+    positives = positive.sum(axis=-1)
+    negatives = truth.shape[-1] - positives
+    rank_sum = np.where(positive, ranks, 0).sum(axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (rank_sum - positives * (positives + 1) / 2) / (positives * negatives)
+
+
+def batch_average_precision(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+    """
+    Average precision of each row of (resamples, samples) binary truth and scores, like sklearn.metrics.average_precision_score:
+    the precision at each distinct score threshold, weighted by the recall gained there. Rows without positives are NaN.
+    """
+    order = np.argsort(-prediction, axis=-1, kind='stable')
+    scores = np.take_along_axis(prediction, order, axis=-1)
+    true_positives = np.cumsum(np.take_along_axis(truth > 0.5, order, axis=-1), axis=-1)
+    # thresholds are the last position of each run of tied scores
+    last_of_tie = np.ones(scores.shape, dtype=bool)
+    last_of_tie[..., :-1] = scores[..., 1:] != scores[..., :-1]
+    positions = np.arange(1, scores.shape[-1] + 1)
+    precision = true_positives / positions
+    previous_threshold = np.maximum.accumulate(np.where(last_of_tie, np.arange(scores.shape[-1]), -1), axis=-1)
+    previous_threshold = np.concatenate([np.full(scores.shape[:-1] + (1,), -1), previous_threshold[..., :-1]], axis=-1)
+    previous_true_positives = np.where(
+        previous_threshold >= 0, np.take_along_axis(true_positives, np.maximum(previous_threshold, 0), axis=-1), 0,
+    )
+    gained = np.where(last_of_tie, true_positives - previous_true_positives, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (gained * precision).sum(axis=-1) / true_positives[..., -1]
+
+
+def batch_r2(truth: np.ndarray, prediction: np.ndarray, eps: float = 1e-6) -> np.ndarray:
+    """ml4h.metrics.coefficient_of_determination of each resample, over all values of the resample"""
+    truth = truth.reshape(truth.shape[0], -1)
+    prediction = prediction.reshape(prediction.shape[0], -1)
+    total_sum_of_squares = np.sum((truth - truth.mean(axis=-1, keepdims=True)) ** 2, axis=-1)
+    residual_sum_of_squares = np.sum((prediction - truth) ** 2, axis=-1)
+    return 1 - residual_sum_of_squares / (total_sum_of_squares + eps)
+
+
+def batch_pearson(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+    """Pearson correlation of each resample, over all values of the resample"""
+    truth = truth.reshape(truth.shape[0], -1)
+    prediction = prediction.reshape(prediction.shape[0], -1)
+    truth = truth - truth.mean(axis=-1, keepdims=True)
+    prediction = prediction - prediction.mean(axis=-1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sum(truth * prediction, axis=-1) / np.sqrt(np.sum(truth ** 2, axis=-1) * np.sum(prediction ** 2, axis=-1))
+
+
+def batch_concordance_index(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+    """
+    Harrell's C of each resample, with truth (resamples, samples, 2) event indicators and times and prediction risk scores.
+    Each resample is counted in O(n log n) by ml4h.metrics.concordance_index_censored. Resamples without comparable pairs are NaN.
+    """
+    prediction = prediction.reshape(prediction.shape[:2])
+    c_indices = np.full(truth.shape[0], np.nan)
+    for i in range(truth.shape[0]):
+        try:
+            c_indices[i] = concordance_index_censored(truth[i, :, 0] == 1.0, truth[i, :, 1], prediction[i])[0]
+        except ValueError:
+            continue
+    return c_indices
+
+
+def _per_column(batch_metric: Callable[[np.ndarray, np.ndarray], np.ndarray]) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    """A batch metric of (resamples, samples) arrays that macro averages the columns of (resamples, samples, columns) arrays, like sklearn"""
+    def _metric(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+        if truth.ndim == 2:
+            return batch_metric(truth, prediction.reshape(truth.shape))
+        return np.mean([batch_metric(truth[..., i], prediction[..., i]) for i in range(truth.shape[-1])], axis=0)
+    return _metric
+
+
+BOOTSTRAP_METRICS: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]] = {
+    'roc_auc': _per_column(batch_roc_auc),
+    'average_precision': _per_column(batch_average_precision),
+    'r2': batch_r2,
+    'pearson': batch_pearson,
+    'c_index': batch_concordance_index,
+}
+
+
+def _metric_of_resamples(metric: Union[str, Callable]) -> Callable[[np.ndarray, np.ndarray], np.ndarray]:
+    if isinstance(metric, str):
+        if metric not in BOOTSTRAP_METRICS:
+            raise ValueError(f'Unknown bootstrap metric {metric}, choose from {list(BOOTSTRAP_METRICS)} or pass a function.')
+        return BOOTSTRAP_METRICS[metric]
+
+    def _each_resample(truth: np.ndarray, prediction: np.ndarray) -> np.ndarray:
+        return np.array([metric(t, p) for t, p in zip(truth, prediction)], dtype=np.float64)
+    return _each_resample
+
+
+def _bootstrap_chunk(arguments: Tuple) -> np.ndarray:
+    truth, prediction, metric, resamples, seed = arguments
+    indices = np.random.default_rng(seed).integers(len(truth), size=(resamples, len(truth)))
+    return _metric_of_resamples(metric)(truth[indices], prediction[indices])
+
+
+def bootstrap(
+    truth: np.ndarray, prediction: np.ndarray, metric: Union[str, Callable[[np.ndarray, np.ndarray], float]],
+    n_boot: int = BOOTSTRAP_SAMPLES, seed: Optional[int] = None, chunk_size: Optional[int] = None, processes: int = 0,
+) -> np.ndarray:
+    """
+    The metric of n_boot resamples, drawn with replacement, of truth and prediction.
+
+    :param truth: truth of each sample, resamples are taken along the first axis
+    :param prediction: prediction of each sample
+    :param metric: one of BOOTSTRAP_METRICS, computed for a whole chunk of resamples at once,
+                   or a function of one resample's truth and prediction, called for each resample
+    :param n_boot: number of resamples
+    :param seed: resamples only depend on this seed, drawn from np.random if not set
+    :param chunk_size: resamples computed at once, by default as many as fit in BOOTSTRAP_CHUNK_ELEMENTS resampled values
+    :param processes: if positive, chunks are computed by a pool of this many processes
+    :return: the metric of each resample
+    """
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+    if chunk_size is None:
+        chunk_size = max(1, BOOTSTRAP_CHUNK_ELEMENTS // max(int(np.prod(truth.shape)), 1))
+    chunk_sizes = [min(chunk_size, n_boot - start) for start in range(0, n_boot, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    chunks = [(truth, prediction, metric, resamples, chunk_seed) for resamples, chunk_seed in zip(chunk_sizes, seeds)]
+    performance = np.empty(n_boot)
+    start = 0
+    if processes > 0 and len(chunks) > 1:
+        with Pool(min(processes, len(chunks))) as pool:
+            for values in pool.imap(_bootstrap_chunk, chunks):
+                performance[start:start + len(values)] = values
+                start += len(values)
+    else:
+        for chunk in chunks:
+            values = _bootstrap_chunk(chunk)
+            performance[start:start + len(values)] = values
+            start += len(values)
+    logging.debug(f'Bootstrapped {n_boot} resamples of {len(truth)} samples in {len(chunks)} chunks.')
+    return performance
+
+
+def bootstrap_interval(
+    truth: np.ndarray, prediction: np.ndarray, metric: Union[str, Callable[[np.ndarray, np.ndarray], float]],
+    n_boot: int = BOOTSTRAP_SAMPLES, bottom: float = 2.5, top: float = 97.5, **kwargs,
+) -> Tuple[float, np.ndarray]:
+    """The mean and bottom and top percentiles of the bootstrap distribution of a metric, ignoring resamples where it is undefined"""
+    performance = bootstrap(truth, prediction, metric, n_boot, **kwargs)
+    return np.nanmean(performance), np.nanpercentile(performance, [bottom, top])
@@ -0,0 +1,172 @@
+# correlations.py
+#
+# Correlations of every pair of explore fields, computed a block of fields at a time with matrix products.
+# Each field is kept as the compact arrays of the samples it has values for, and its values are standardized once.
+# For a pair of blocks, the fields are laid out as dense (samples, fields) value and mask matrices,
+# and the sample counts, sums, sums of squares and cross products over the samples both fields have
+# are all matrix products of those, so correlations are pairwise complete like correlating each pair on its common samples.
+# Only two blocks are dense at once, so memory is bounded by the block size, not by the number of fields.
+# Spearman ranks each field once over its own samples, so it is only exact for pairs of fields with the same missing samples.
+
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rankdata
+
+CORRELATION_METHODS = ['pearson', 'spearman']
+CORRELATION_BLOCK_ELEMENTS = 2 ** 24  # dense values per block, each block matrix is at most 128 MB
+CONSTANT_TOLERANCE = 1e-10  # relative variance under which a field is constant on a pair's common samples
+
+Stats = Dict[str, Dict[str, List[float]]]
+
+
+def correlation_header(method: str = 'pearson') -> List[str]:
+    name = method.capitalize()
+    return ["Field 1", "Field 2", f"{name} R", f"{name} R^2", "Sample Size"]
+
+
+class _FieldColumns:
+    """
+    The rows of the samples each field has one value for, and those values, standardized, or ranked then standardized for spearman.
+    Fields with more than one value for some sample are kept aside in multi_valued, fields with any NaN in fields_with_nans.
+    """
+
+    def __init__(self, stats: Stats, method: str):
+        self.fields = list(stats.keys())
+        sample_rows: Dict[str, int] = {}
+        self.rows: Dict[int, np.ndarray] = {}
+        self.values: Dict[int, np.ndarray] = {}
+        self.multi_valued: List[int] = []
+        self.fields_with_nans: List[str] = []
+        for i, field in enumerate(self.fields):
+            samples = stats[field]
+            if any(len(values) != 1 for values in samples.values()):
+                if any(np.isnan(value) for values in samples.values() for value in values):
+                    self.fields_with_nans.append(field)
+                else:
+                    self.multi_valued.append(i)
+                continue
+            values = np.fromiter((values[0] for values in samples.values()), dtype=np.float64, count=len(samples))
+            if np.isnan(values).any():
+                self.fields_with_nans.append(field)
+                continue
+            if method == 'spearman':
+                values = rankdata(values)
+            scale = values.std()
+            self.values[i] = (values - values.mean()) / (scale if scale > 0 else 1.0)
+            self.rows[i] = np.fromiter((sample_rows.setdefault(sample, len(sample_rows)) for sample in samples), dtype=np.int64, count=len(samples))
+        self.samples = len(sample_rows)
+        self.single_valued = sorted(self.values)
+
+    def dense(self, block: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        """The values, zero where missing, and the mask of present values of a block of fields, as (samples, fields) matrices"""
+        values = np.zeros((self.samples, len(block)))
+        mask = np.zeros((self.samples, len(block)))
+        for k, i in enumerate(block):
+            values[self.rows[i], k] = self.values[i]
+            mask[self.rows[i], k] = 1.0
+        return values, mask
+
+
+def _block_correlations(
+    block_1: List[int], block_2: List[int], min_samples: int,
+    dense_1: Tuple[np.ndarray, np.ndarray], dense_2: Tuple[np.ndarray, np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """The field indices, correlations and sample counts of the pairs of two blocks with enough common samples and variance"""
+    values_1, mask_1 = dense_1
+    values_2, mask_2 = dense_2
+    counts = mask_1.T @ mask_2
+    sums_1 = values_1.T @ mask_2
+    sums_2 = mask_1.T @ values_2
+    squares_1 = (values_1 ** 2).T @ mask_2
+    squares_2 = mask_1.T @ values_2 ** 2
+    products = values_1.T @ values_2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums_1 * sums_2 / counts
+        variance_1 = squares_1 - sums_1 ** 2 / counts
+        variance_2 = squares_2 - sums_2 ** 2 / counts
+        correlation = covariance / np.sqrt(variance_1 * variance_2)
+    fields_1, fields_2 = np.asarray(block_1)[:, np.newaxis], np.asarray(block_2)[np.newaxis, :]
+    valid = (counts >= max(min_samples, 1)) & (fields_1 < fields_2)
+    valid &= (variance_1 > CONSTANT_TOLERANCE * squares_1) & (variance_2 > CONSTANT_TOLERANCE * squares_2)
+    valid &= np.isfinite(correlation)
+    index_1, index_2 = np.nonzero(valid)
+    return (
+        np.asarray(block_1)[index_1], np.asarray(block_2)[index_2],
+        np.clip(correlation[valid], -1.0, 1.0), counts[valid].astype(np.int64),
+    )
+
+
+def _multi_valued_correlation(stats: Stats, field_1: str, field_2: str, min_samples: int) -> Optional[Tuple[float, int]]:
+    """
+    The correlation of a pair where a field has several values for a sample, on the concatenated values of their common samples.
+    None when there are too few common samples, the pair has different numbers of values, or a field is constant.
+    """
+    common_samples = set(stats[field_1].keys()).intersection(stats[field_2].keys())
+    if len(common_samples) < max(min_samples, 1):
+        return None
+    values_1 = [value for sample in common_samples for value in stats[field_1][sample]]
+    values_2 = [value for sample in common_samples for value in stats[field_2][sample]]
+    if len(values_1) != len(values_2) or len(set(values_1)) == 1 or len(set(values_2)) == 1:
+        return None
+    correlation = np.corrcoef(values_1, values_2)[1, 0]
+    return None if np.isnan(correlation) else (correlation, len(common_samples))
+
+
+def correlation_table(
+    stats: Stats, min_samples: int, method: str = 'pearson', block_size: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    The correlation of every pair of fields on the samples both have values for, sorted from most to least correlated.
+
+    :param stats: field names to sample ids to the field's values for the sample
+    :param min_samples: only correlate fields with values from at least this many common samples
+    :param method: pearson, or spearman to correlate the ranks of each field's values.
+                   Each field is ranked once over all of its own samples, not again within each pair's common samples,
+                   so spearman is exact for pairs of fields with the same samples and approximate when their missing samples differ.
+    :param block_size: fields correlated at once, by default as many as fit in CORRELATION_BLOCK_ELEMENTS dense values
+    :return: a row per correlated pair with the columns of correlation_header. Pairs with a constant field are left out,
+             as are fields with any NaN value.
+    """
+    if method not in CORRELATION_METHODS:
+        raise ValueError(f'Unknown correlation method {method}, choose from {CORRELATION_METHODS}.')
+    columns = _FieldColumns(stats, method)
+    if block_size is None:
+        block_size = max(1, CORRELATION_BLOCK_ELEMENTS // max(columns.samples, 1))
+    fields = columns.single_valued
+    blocks = [fields[start:start + block_size] for start in range(0, len(fields), block_size)]
+    logging.info(f"There are {len(stats) * (len(stats) - 1) // 2} field pairs, correlating them in {len(blocks)} blocks of {block_size} fields.")
+
+    pairs = []
+    for b1, block_1 in enumerate(blocks):
+        dense_1 = columns.dense(block_1)
+        for block_2 in blocks[b1:]:
+            dense_2 = dense_1 if block_2 is block_1 else columns.dense(block_2)
+            pairs.append(_block_correlations(block_1, block_2, min_samples, dense_1, dense_2))
+        logging.debug(f"Correlated block {b1 + 1} of {len(blocks)}.")
+
+    multi_valued = set(columns.multi_valued)
+    for i in columns.multi_valued:
+        for j in sorted(multi_valued.union(fields)):
+            if j in multi_valued and j <= i:
+                continue
+            correlated = _multi_valued_correlation(stats, columns.fields[i], columns.fields[j], min_samples)
+            if correlated is not None:
+                pair = (min(i, j), max(i, j))
+                pairs.append((np.array([pair[0]]), np.array([pair[1]]), np.array([correlated[0]]), np.array([correlated[1]])))
+
+    if columns.fields_with_nans:
+        logging.warning(f"The {len(columns.fields_with_nans)} fields containing NaNs are: {', '.join(columns.fields_with_nans)}.")
+    header = correlation_header(method)
+    if not pairs:
+        return pd.DataFrame(columns=header)
+    index_1, index_2, correlation, counts = (np.concatenate(part) for part in zip(*pairs))
+    order = np.lexsort((index_2, index_1, -correlation))  # most correlated first, ties in field order
+    names = np.asarray(columns.fields, dtype=object)
+    correlation = correlation[order]
+    return pd.DataFrame({
+        header[0]: names[index_1[order]], header[1]: names[index_2[order]],
+        header[2]: correlation, header[3]: correlation * correlation, header[4]: counts[order],
+    })
@@ -185,6 +185,12 @@ TENSOR_MAP_GROUP_MISSING_CONTINUOUS = 'multi_field_continuous'
 IMPUTATION_RANDOM = 'random'
 IMPUTATION_MEAN = 'mean'
 
+SAMPLERS = ['shuffle', 'class_balanced', 'stratified']
+
+INFERENCE_FORMATS = ['tsv', 'parquet', 'arrow']
+EMBEDDING_FORMATS = ['tsv', 'npy']
+EMBEDDING_DTYPES = ['float32', 'float16']
+
 
 def dataset_name_from_meaning(group: str, fields: List[str]) -> str:
     clean_fields = []
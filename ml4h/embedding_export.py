@@ -0,0 +1,111 @@
+# embedding_export.py
+#
+# Embeddings written as binary matrices instead of text, so they are loaded without parsing.
+# Rows are gathered into shards of shard_size samples, each saved as an npy file that np.load can memory map.
+# Shards are saved in a background thread while the next rows are inferred.
+# An index parquet table maps each sample id to its shard and row, and a small json records the shape and dtype.
+
+import os
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from ml4h.defines import EMBEDDING_DTYPES
+
+EMBEDDING_SHARD_SIZE = 65536
+EMBEDDING_INDEX = 'index.parquet'
+EMBEDDING_METADATA = 'embeddings.json'
+
+
+class EmbeddingShardWriter:
+    """
+    Writes embeddings of samples into npy shards of shard_size rows in directory, with an index of where each sample is.
+    Call write with batches of sample ids and their embeddings, then close to save the last shard and the index.
+    """
+
+    def __init__(self, directory: str, dimensions: int, dtype: str = 'float32', shard_size: int = EMBEDDING_SHARD_SIZE):
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f'Unknown embedding dtype {dtype}, choose from {EMBEDDING_DTYPES}.')
+        self.directory = directory
+        self.dimensions = dimensions
+        self.dtype = np.dtype(dtype)
+        self.shard_size = shard_size
+        self.shard = np.empty((shard_size, dimensions), dtype=self.dtype)
+        self.rows = 0
+        self.sample_ids: List[str] = []
+        self.shards: List[str] = []
+        self.pool = ThreadPoolExecutor(1)
+        self.saving: Optional[Future] = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _save_shard(self):
+        if self.saving is not None:
+            self.saving.result()  # at most one shard is being saved while the next fills, and its errors are raised here
+        name = f'shard_{len(self.shards):05d}.npy'
+        self.shards.append(name)
+        self.saving = self.pool.submit(np.save, os.path.join(self.directory, name), self.shard[:self.rows])
+        self.shard = np.empty((self.shard_size, self.dimensions), dtype=self.dtype)
+        self.rows = 0
+
+    def write(self, sample_ids: List[str], embeddings: np.ndarray):
+        embeddings = embeddings.reshape((len(sample_ids), self.dimensions))
+        start = 0
+        while start < len(sample_ids):
+            rows = min(len(sample_ids) - start, self.shard_size - self.rows)
+            self.shard[self.rows:self.rows + rows] = embeddings[start:start + rows]
+            self.rows += rows
+            start += rows
+            if self.rows == self.shard_size:
+                self._save_shard()
+        self.sample_ids.extend(sample_ids)
+
+    def close(self):
+        if self.rows > 0:
+            self._save_shard()
+        if self.saving is not None:
+            self.saving.result()
+        self.pool.shutdown()
+        sample_ids = pd.Series(self.sample_ids, dtype=str)
+        if len(sample_ids) and sample_ids.str.isdigit().all():
+            sample_ids = sample_ids.astype(np.int64)
+        rows = np.arange(len(sample_ids))
+        index = pd.DataFrame({'sample_id': sample_ids, 'shard': rows // self.shard_size, 'row': rows % self.shard_size})
+        index.to_parquet(os.path.join(self.directory, EMBEDDING_INDEX), index=False)
+        metadata = {'samples': len(sample_ids), 'dimensions': self.dimensions, 'dtype': self.dtype.name, 'shards': self.shards}
+        with open(os.path.join(self.directory, EMBEDDING_METADATA), 'w') as metadata_file:
+            json.dump(metadata, metadata_file)
+        logging.info(f'Wrote {len(sample_ids)} embeddings of {self.dimensions} {self.dtype.name}s in {len(self.shards)} shards to {self.directory}')
+
+
+def is_embedding_shards(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, EMBEDDING_METADATA))
+
+
+def load_embeddings(directory: str, mmap: bool = True) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The sample ids and the embedding matrix written by an EmbeddingShardWriter.
+    With one shard the matrix is memory mapped, more shards are concatenated into memory.
+    """
+    with open(os.path.join(directory, EMBEDDING_METADATA)) as metadata_file:
+        metadata = json.load(metadata_file)
+    index = pd.read_parquet(os.path.join(directory, EMBEDDING_INDEX), columns=['sample_id'])
+    shards = [np.load(os.path.join(directory, name), mmap_mode='r' if mmap else None) for name in metadata['shards']]
+    if len(shards) == 1:
+        matrix = shards[0]
+    elif shards:
+        matrix = np.concatenate(shards)
+    else:
+        matrix = np.empty((0, metadata['dimensions']), dtype=metadata['dtype'])
+    return index['sample_id'].to_numpy(), matrix
+
+
+def embeddings_dataframe(directory: str, prefix: str = 'latent_') -> pd.DataFrame:
+    """Embeddings written by an EmbeddingShardWriter, as a DataFrame like the hidden layer inference tsv"""
+    sample_ids, matrix = load_embeddings(directory, mmap=False)
+    columns = pd.DataFrame(matrix, columns=[f'{prefix}{i}' for i in range(matrix.shape[1])])
+    columns.insert(0, 'sample_id', sample_ids)
+    return columns
@@ -6,16 +6,16 @@ import csv
 import math
 import copy
 import logging
-import operator
 import datetime
 from functools import reduce
-from itertools import combinations
 from collections import defaultdict, Counter, OrderedDict
 from typing import Dict, List, Tuple, Generator, Optional, DefaultDict
 
 import h5py
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import multiprocessing as mp
 from sklearn.decomposition import PCA
 from tensorflow.keras.models import Model
@@ -28,6 +28,10 @@ from ml4h.models.legacy_models import make_multimodal_multitask_model
 from ml4h.TensorMap import TensorMap, Interpretation, decompress_data
 from ml4h.tensor_generators import TensorGenerator, test_train_valid_tensor_generators
 from ml4h.tensor_generators import BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX, BATCH_PATHS_INDEX
+from ml4h.packed_hd5 import open_hd5, sample_paths
+from ml4h.embedding_export import is_embedding_shards, load_embeddings
+from ml4h.inference_writer import INFERENCE_MANIFEST, INFERENCE_ROW_GROUP_SIZE
+from ml4h.correlations import correlation_table
 from ml4h.plots import plot_histograms_in_pdf, plot_heatmap, plot_cross_reference, SUBPLOT_SIZE
 from ml4h.plots import evaluate_predictions, subplot_rocs, subplot_scatters, plot_categorical_tmap_over_time
 from ml4h.defines import JOIN_CHAR, MRI_SEGMENTED_CHANNEL_MAP, CODING_VALUES_MISSING, CODING_VALUES_LESS_THAN_ONE
@@ -35,6 +39,9 @@ from ml4h.defines import TENSOR_EXT, IMAGE_EXT, ECG_CHAR_2_IDX, ECG_IDX_2_CHAR,
 
 
 CSV_EXT = '.tsv'
+EXPLORE_DATASET = 'tensors_all_union.parquet'  # a directory of parquet files and their manifest
+EXPLORE_CHUNK_SIZE = 64  # hd5s each explore worker reads before returning their rows
+EXPLORE_FILE_ROWS = 1048576
 
 
 def predictions_to_pngs(
@@ -232,6 +239,7 @@ def tabulate_correlations_of_tensors(
     output_folder: str,
     min_samples: int,
     max_samples: int = None,
+    method: str = 'pearson',
 ) -> None:
     """
     :param id: name for the plotting run
@@ -239,10 +247,12 @@ def tabulate_correlations_of_tensors(
     :param output_folder: folder containing the output plot
     :param min_samples: calculate correlation coefficient only if both fields have values from that many common samples
     :param max_samples: specifies how many tensor files to down-sample from; by default all tensors are used
+    :param method: pearson or spearman correlation. Spearman ranks each field over all of its samples,
+                   so it is approximate for pairs of fields whose missing samples differ
     """
     stats, _ = _collect_continuous_stats_from_tensor_files(tensor_folder, max_samples)
     logging.info(f"Collected continuous stats for {len(stats)} fields. Now tabulating their cross-correlations...")
-    _tabulate_correlations(stats, run_id, min_samples, output_folder)
+    _tabulate_correlations(stats, run_id, min_samples, output_folder, method)
 
 
 def mri_dates(tensors: str, output_folder: str, run_id: str):
@@ -251,10 +261,9 @@ def mri_dates(tensors: str, output_folder: str, run_id: str):
     disease = 'hypertension'
     disease_date_key = disease + '_date'
     data_date_key = 'assessment-date_0_0'
-    tensor_paths = [tensors + tp for tp in os.listdir(tensors) if os.path.splitext(tp)[-1].lower() == TENSOR_EXT]
-    for tp in tensor_paths:
+    for tp in sample_paths(tensors):
         try:
-            with h5py.File(tp, 'r') as hd5:
+            with open_hd5(tp) as hd5:
                 if data_date_key in hd5 and disease_date_key in hd5:
                     if int(hd5[disease][0]) == 1:
                         data_date = str2date(str(hd5[data_date_key][0]))
@@ -279,10 +288,9 @@ def mri_dates(tensors: str, output_folder: str, run_id: str):
 def ecg_dates(tensors: str, output_folder: str, run_id: str):
     incident_dates = []
     prevalent_dates = []
-    tensor_paths = [tensors + tp for tp in os.listdir(tensors) if os.path.splitext(tp)[-1].lower()==TENSOR_EXT]
-    for tp in tensor_paths:
+    for tp in sample_paths(tensors):
         try:
-            with h5py.File(tp, 'r') as hd5:
+            with open_hd5(tp) as hd5:
                 if 'ecg_bike_date_0' in hd5 and 'coronary_artery_disease_soft_date' in hd5:
                     ecg_date = str2date(str(hd5['ecg_bike_date_0'][0]))
                     cad_date = str2date(str(hd5['coronary_artery_disease_soft_date'][0]))
@@ -364,7 +372,7 @@ def sample_from_char_embed_model(tensor_maps_in: List[TensorMap], char_model: Mo
         embed_in = test_batch[embed_map.input_name()][i:i+1, :]
         burn_in = np.zeros((1, window_size, alphabet_size), dtype=np.float32)
         window_size = burn_in.shape[1]
-        with h5py.File(test_paths[i], 'r') as hd5:
+        with open_hd5(test_paths[i]) as hd5:
             logging.info(f"\n")
             if 'read_' in language_map.name:
                 caption = decompress_data(data_compressed=hd5[tm.name][()], dtype=hd5[tm.name].attrs['dtype'])
@@ -394,7 +402,7 @@ def tensors_to_label_dictionary(
 ) -> Dict[str, np.ndarray]:
     label_dict = {k: np.zeros((len(test_paths))) for k in categorical_labels + continuous_labels + gene_labels}
     for i, tp in enumerate(test_paths):
-        hd5 = h5py.File(tp, 'r')
+        hd5 = open_hd5(tp)
         for k in categorical_labels:
             if k in hd5['categorical']:
                 label_dict[k][i] = 1
@@ -433,7 +441,7 @@ def infer_with_pixels(args):
     tensor_paths_inferred = {}
     args.num_workers = 0
     inference_tsv = os.path.join(args.output_folder, args.id, 'pixel_inference_' + args.id + '.tsv')
-    tensor_paths = [args.tensors + tp for tp in sorted(os.listdir(args.tensors)) if os.path.splitext(tp)[-1].lower() == TENSOR_EXT]
+    tensor_paths = sample_paths(args.tensors)
     # hard code batch size to 1 so we can iterate over file names and generated tensors together in the tensor_paths for loop
     model = make_multimodal_multitask_model(**args.__dict__)
     generate_test = TensorGenerator(
@@ -550,6 +558,8 @@ def _tabulate_correlations(
     output_file_name: str,
     min_samples: int,
     output_folder_path: str,
+    method: str = 'pearson',
+    block_size: Optional[int] = None,
 ) -> None:
 
     """
@@ -558,71 +568,16 @@ def _tabulate_correlations(
     :param output_file_name: name of output file in pdf
     :param output_folder_path: directory that output file will be written to
     :param min_samples: calculate correlation coefficient only if both fields have values from that many common samples
+    :param method: pearson or spearman correlation. Spearman ranks each field over all of its samples,
+                   so it is approximate for pairs of fields whose missing samples differ
+    :param block_size: number of fields correlated at once with matrix products, by default sized to the number of samples
     :return: None
     """
 
-    fields = stats.keys()
-    num_fields = len(fields)
-    field_pairs = combinations(fields, 2)
-    table_rows: List[list] = []
-    logging.info(f"There are {int(num_fields * (num_fields - 1) / 2)} field pairs.")
-    processed_field_pair_count = 0
-    nan_counter = Counter()  # keep track of if we've seen a field have NaNs
-    for field1, field2 in field_pairs:
-        if field1 not in nan_counter.keys() and field2 not in nan_counter.keys():
-            common_samples = set(stats[field1].keys()).intersection(stats[field2].keys())
-            num_common_samples = len(common_samples)
-            processed_field_pair_count += 1
-            if processed_field_pair_count % 50000 == 0:
-                logging.debug(f"Processed {processed_field_pair_count} field pairs.")
-            if num_common_samples >= min_samples:
-                field1_values = reduce(operator.concat, [stats[field1][sample] for sample in common_samples])
-                field2_values = reduce(operator.concat, [stats[field2][sample] for sample in common_samples])
-
-                num_field1_nans = len(list(filter(math.isnan, field1_values)))
-                num_field2_nans = len(list(filter(math.isnan, field2_values)))
-                at_least_one_field_has_nans = False
-                if num_field1_nans != 0:
-                    nan_counter[field1] = True
-                    at_least_one_field_has_nans = True
-                if num_field2_nans != 0:
-                    nan_counter[field2] = True
-                    at_least_one_field_has_nans = True
-                if at_least_one_field_has_nans:
-                    continue
-
-                if len(field1_values) == len(field2_values):
-                    if len(set(field1_values)) == 1 or len(set(field2_values)) == 1:
-                        logging.debug(
-                            f"Not calculating correlation for fields {field1} and {field2} because at least one of "
-                            f"the fields has all the same values for the {num_common_samples} common samples.",
-                        )
-                        continue
-                    corr = np.corrcoef(field1_values, field2_values)[1, 0]
-                    if not math.isnan(corr):
-                        table_rows.append([field1, field2, corr, corr * corr, num_common_samples])
-                    else:
-                        logging.warning(f"Pearson correlation for fields {field1} and {field2} is NaN.")
-                else:
-                    logging.debug(
-                        f"Not calculating correlation for fields '{field1}' and '{field2}' "
-                        f"because they have different number of values ({len(field1_values)} vs. {len(field2_values)}).",
-                    )
-        else:
-            continue
-
-    # Note: NaNs mess up sorting unless they are handled specially by a custom sorting function
-    sorted_table_rows = sorted(table_rows, key=operator.itemgetter(2), reverse=True)
-    logging.info(f"Total number of correlations: {len(sorted_table_rows)}")
-
-    fields_with_nans = nan_counter.keys()
-    if len(fields_with_nans) != 0:
-        logging.warning(f"The {len(fields_with_nans)} fields containing NaNs are: {', '.join(fields_with_nans)}.")
-
+    table = correlation_table(stats, min_samples, method, block_size)
+    logging.info(f"Total number of correlations: {len(table)}")
     table_path = os.path.join(output_folder_path, output_file_name + CSV_EXT)
-    table_header = ["Field 1", "Field 2", "Pearson R", "Pearson R^2",  "Sample Size"]
-    df = pd.DataFrame(sorted_table_rows, columns=table_header)
-    df.to_csv(table_path, index=False)
+    table.to_csv(table_path, index=False)
 
     logging.info(f"Saved correlations table at: {table_path}")
 
@@ -635,7 +590,7 @@ def _collect_continuous_stats_from_tensor_files(
 ) -> Tuple[DefaultDict[str, DefaultDict[str, List[float]]], int]:
     if not os.path.exists(tensor_folder):
         raise ValueError('Source directory does not exist: ', tensor_folder)
-    all_tensor_files = list(filter(lambda file: file.endswith(TENSOR_EXT), os.listdir(tensor_folder)))
+    all_tensor_files = [os.path.basename(path) for path in sample_paths(tensor_folder)]
     if max_samples is not None:
         if len(all_tensor_files) < max_samples:
             logging.warning(
@@ -692,7 +647,7 @@ def _collect_continuous_stats_from_tensor_file(
                 stats[field_meaning][sample_id].append(field_value)
     tensor_file_path = os.path.join(tensor_folder, tensor_file)
     sample_id = os.path.splitext(tensor_file)[0]
-    with h5py.File(tensor_file_path, 'r') as hd5_handle:
+    with open_hd5(tensor_file_path) as hd5_handle:
         hd5_handle.visititems(_field_meaning_to_values_dict)
 
 
@@ -707,107 +662,221 @@ def _categorical_explore_header(tm: TensorMap, channel: str) -> str:
     return f'{channel}'
 
 
+def _explore_tensors_of_path(tmaps: List[TensorMap], path: str, gen_name: str) -> List[Dict]:
+    """The explore rows of one hd5, one for each tensor of multi-tensor tmaps, with the error each tmap raised if any"""
+    try:
+        with open_hd5(path) as hd5:
+            dict_of_tensor_dicts = defaultdict(dict)
+            # Iterate through each tmap
+            for tm in tmaps:
+                shape = tm.shape if tm.shape[0] is not None else tm.shape[1:]
+                try:
+                    tensors = tm.tensor_from_file(tm, hd5)
+                    if tm.shape[0] is not None:
+                        # If not a multi-tensor tensor, wrap in array to loop through
+                        tensors = np.array([tensors])
+                    for i, tensor in enumerate(tensors):
+                        if tensor is None:
+                            break
+
+                        error_type = ''
+                        try:
+                            tensor = tm.rescale(tm.postprocess_tensor(tensor, augment=False, hd5=hd5))
+                            # Append tensor to dict
+                            if tm.channel_map:
+                                for cm in tm.channel_map:
+                                    dict_of_tensor_dicts[i][f'{cm}'] = tensor[tm.channel_map[cm]]
+                            else:
+                                # If tensor is a scalar, isolate the value in the array;
+                                # otherwise, retain the value as array
+                                if shape[0] == 1:
+                                    if type(tensor) == np.ndarray:
+                                        tensor = tensor.item()
+                                dict_of_tensor_dicts[i][tm.name] = tensor
+                        except (IndexError, KeyError, ValueError, OSError, RuntimeError) as e:
+                            if tm.channel_map:
+                                for cm in tm.channel_map:
+                                    dict_of_tensor_dicts[i][f'{cm}'] = np.nan
+                            else:
+                                dict_of_tensor_dicts[i][tm.name] = np.full(shape, np.nan)[0]
+                            error_type = type(e).__name__
+                        dict_of_tensor_dicts[i][f'error_type_{tm.name}'] = error_type
+
+                except (IndexError, KeyError, ValueError, OSError, RuntimeError) as e:
+                    # Most likely error came from tensor_from_file and dict_of_tensor_dicts is empty
+                    if tm.channel_map:
+                        for cm in tm.channel_map:
+                            dict_of_tensor_dicts[0][f'{cm}'] = np.nan
+                    else:
+                        dict_of_tensor_dicts[0][tm.name] = np.full(shape, np.nan)[0]
+                    dict_of_tensor_dicts[0][f'error_type_{tm.name}'] = type(e).__name__
+
+            for i in dict_of_tensor_dicts:
+                dict_of_tensor_dicts[i]['fpath'] = os.path.basename(path).split('.')[0]
+                dict_of_tensor_dicts[i]['generator'] = gen_name
+            return list(dict_of_tensor_dicts.values())
+    except OSError as e:
+        logging.info(f"OSError {e}")
+        return []
+
+
+def _explore_schema(tmaps: List[TensorMap]) -> pa.Schema:
+    """
+    The columns of explore rows: a float or string column per tmap or channel, an error type per tmap, and the hd5 and its generator.
+    Tmaps without a channel map whose tensors are not scalars get string columns, holding each tensor as text like the csv did.
+    """
+    columns = {}
+    for tm in tmaps:
+        tensor_shape = tm.shape[1:] if tm.shape[0] is None else tm.shape
+        is_array = not tm.channel_map and int(np.prod(tensor_shape)) != 1
+        value_type = pa.string() if tm.is_language() or is_array else pa.float64()
+        for name in ([f'{cm}' for cm in tm.channel_map] if tm.channel_map else [tm.name]):
+            columns.setdefault(name, value_type)
+        columns.setdefault(f'error_type_{tm.name}', pa.string())
+    columns.setdefault('fpath', pa.string())
+    columns.setdefault('generator', pa.string())
+    return pa.schema(list(columns.items()))
+
+
+def _is_missing_value(value) -> bool:
+    return value is None or (np.ndim(value) == 0 and pd.isna(value))
+
+
+def _explore_record_batch(rows: List[Dict], schema: pa.Schema) -> pa.RecordBatch:
+    """
+    Typed columns of explore rows. Missing values and empty strings are null.
+    Values that are not numbers in float columns are NaN, and how many there were is logged.
+    """
+    arrays = []
+    for field in schema:
+        values = [row.get(field.name) for row in rows]
+        if field.type == pa.string():
+            values = [None if _is_missing_value(value) or (isinstance(value, str) and value == '') else str(value) for value in values]
+            arrays.append(pa.array(values, type=pa.string()))
+        else:
+            numbers = pd.to_numeric(pd.Series(values, dtype=object), errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+            not_numbers = sum(np.isnan(number) and not _is_missing_value(value) for number, value in zip(numbers, values))
+            if not_numbers:
+                logging.warning(f'{not_numbers} values of {field.name} are not numbers, explore wrote them as NaN.')
+            arrays.append(pa.array(numbers, type=pa.float64()))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+_explore_worker_tmaps: List[TensorMap] = []
+
+
+def _init_explore_worker(tmaps: List[TensorMap]):
+    # tmaps are handed to forked workers once instead of pickled with every chunk, many of their tensor_from_files are closures
+    global _explore_worker_tmaps
+    _explore_worker_tmaps = tmaps
+
+
+def _explore_chunk(paths: List[Tuple[str, str]]) -> pa.RecordBatch:
+    rows = [row for path, gen_name in paths for row in _explore_tensors_of_path(_explore_worker_tmaps, path, gen_name)]
+    return _explore_record_batch(rows, _explore_schema(_explore_worker_tmaps))
+
+
 class ExploreParallelWrapper():
-    def __init__(self, tmaps, paths,  num_workers, output_folder, run_id):
+    """
+    Explores hd5s in a pool of processes, chunk_size paths at a time, each chunk coming back as one typed arrow record batch.
+    The batches are written in path order into a parquet dataset directory of files of at most file_rows rows,
+    with a manifest of the files that read_explore_dataset reads them back from.
+    """
+
+    def __init__(
+        self, tmaps, paths, num_workers, output_folder, run_id,
+        chunk_size: int = EXPLORE_CHUNK_SIZE, file_rows: int = EXPLORE_FILE_ROWS, row_group_size: int = INFERENCE_ROW_GROUP_SIZE,
+    ):
         self.tmaps = tmaps
         self.paths = paths
         self.num_workers = num_workers
         self.total = len(paths)
-        self.output_folder = output_folder
-        self.run_id = run_id
-        self.chunksize = self.total // num_workers
-        self.counter = mp.Value('l', 1)
-
-    def _hd5_to_disk(self, path, gen_name):
-        with self.counter.get_lock():
-            i = self.counter.value
-            if i % 500 == 0:
-                logging.info(f"Parsing {i}/{self.total} ({i/self.total*100:.1f}%) done")
-            self.counter.value += 1
-
-        # each worker should write to it's own file
-        pid = mp.current_process().pid
-        fpath = os.path.join(self.output_folder, self.run_id, f'tensors_all_union_{pid}.csv')
-        write_header = not os.path.isfile(fpath)
-
+        self.directory = os.path.join(output_folder, run_id, EXPLORE_DATASET)
+        self.chunk_size = max(1, chunk_size)
+        self.file_rows = file_rows
+        self.row_group_size = row_group_size
+        self.schema = _explore_schema(tmaps)
+        self.files: List[Dict] = []
+        self.writer: Optional[pq.ParquetWriter] = None
+        self.buffer: List[pa.RecordBatch] = []
+        self.buffered_rows = 0
+
+    def _new_file(self):
+        if self.writer is not None:
+            self.writer.close()
+        name = f'part_{len(self.files):05d}.parquet'
+        self.writer = pq.ParquetWriter(os.path.join(self.directory, name), self.schema)
+        self.files.append({'path': name, 'rows': 0, 'row_groups': 0})
+
+    def _flush(self, final: bool = False):
+        """Write buffered rows a row group at a time, keeping back a last partial row group unless it ends a file or this is the final flush"""
+        table = pa.Table.from_batches(self.buffer, schema=self.schema)
+        while len(table) > 0:
+            if self.writer is None or self.files[-1]['rows'] >= self.file_rows:
+                self._new_file()
+            left_in_file = self.file_rows - self.files[-1]['rows']
+            rows = min(len(table), self.row_group_size, left_in_file)
+            if rows < min(self.row_group_size, left_in_file) and not final:
+                break
+            self.writer.write_table(table.slice(0, rows), row_group_size=rows)
+            self.files[-1]['rows'] += rows
+            self.files[-1]['row_groups'] += 1
+            table = table.slice(rows)
+        self.buffer, self.buffered_rows = table.to_batches(), len(table)
+
+    def _write(self, batch: pa.RecordBatch):
+        self.buffer.append(batch)
+        self.buffered_rows += batch.num_rows
+        if self.buffered_rows >= self.row_group_size:
+            self._flush()
+
+    def _clear_directory(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.startswith('part_') or name == INFERENCE_MANIFEST:
+                os.remove(os.path.join(self.directory, name))
+
+    def run(self) -> str:
+        self._clear_directory()
+        chunks = [self.paths[start:start + self.chunk_size] for start in range(0, self.total, self.chunk_size)]
+        if self.num_workers > 0 and len(chunks) > 1:
+            pool = mp.get_context('fork').Pool(min(self.num_workers, len(chunks)), initializer=_init_explore_worker, initargs=(self.tmaps,))
+            batches = pool.imap(_explore_chunk, chunks)
+        else:
+            pool = None
+            _init_explore_worker(self.tmaps)
+            batches = map(_explore_chunk, chunks)
         try:
-            with h5py.File(path, "r") as hd5:
-                dict_of_tensor_dicts = defaultdict(dict)
-                # Iterate through each tmap
-                for tm in self.tmaps:
-                    shape = tm.shape if tm.shape[0] is not None else tm.shape[1:]
-                    try:
-                        tensors = tm.tensor_from_file(tm, hd5)
-                        if tm.shape[0] is not None:
-                            # If not a multi-tensor tensor, wrap in array to loop through
-                            tensors = np.array([tensors])
-                        for i, tensor in enumerate(tensors):
-                            if tensor is None:
-                                break
-
-                            error_type = ''
-                            try:
-                                tensor = tm.rescale(tm.postprocess_tensor(tensor, augment=False, hd5=hd5))
-                                # Append tensor to dict
-                                if tm.channel_map:
-                                    for cm in tm.channel_map:
-                                        dict_of_tensor_dicts[i][f'{cm}'] = tensor[tm.channel_map[cm]]
-                                else:
-                                    # If tensor is a scalar, isolate the value in the array;
-                                    # otherwise, retain the value as array
-                                    if shape[0] == 1:
-                                        if type(tensor) == np.ndarray:
-                                            tensor = tensor.item()
-                                    dict_of_tensor_dicts[i][tm.name] = tensor
-                            except (IndexError, KeyError, ValueError, OSError, RuntimeError) as e:
-                                if tm.channel_map:
-                                    for cm in tm.channel_map:
-                                        dict_of_tensor_dicts[i][f'{cm}'] = np.nan
-                                else:
-                                    dict_of_tensor_dicts[i][tm.name] = np.full(shape, np.nan)[0]
-                                error_type = type(e).__name__
-                            dict_of_tensor_dicts[i][f'error_type_{tm.name}'] = error_type
-
-                    except (IndexError, KeyError, ValueError, OSError, RuntimeError) as e:
-                        # Most likely error came from tensor_from_file and dict_of_tensor_dicts is empty
-                        if tm.channel_map:
-                            for cm in tm.channel_map:
-                                dict_of_tensor_dicts[0][f'{cm}'] = np.nan
-                        else:
-                            dict_of_tensor_dicts[0][tm.name] = np.full(shape, np.nan)[0]
-                        dict_of_tensor_dicts[0][f'error_type_{tm.name}'] = type(e).__name__
-
-                for i in dict_of_tensor_dicts:
-                    dict_of_tensor_dicts[i]['fpath'] = os.path.basename(path).split('.')[0]
-                    dict_of_tensor_dicts[i]['generator'] = gen_name
-
-                # write tdicts to disk
-                if len(dict_of_tensor_dicts) > 0:
-                    keys = dict_of_tensor_dicts[0].keys()
-                    with open(fpath, 'a') as output_file:
-                        dict_writer = csv.DictWriter(output_file, keys)
-                        if write_header:
-                            dict_writer.writeheader()
-                        dict_writer.writerows(dict_of_tensor_dicts.values())
-        except OSError as e:
-            logging.info(f"OSError {e}")
-
-    def mp_worker(self, worker_idx):
-        start = worker_idx * self.chunksize
-        end = start + self.chunksize
-        if worker_idx == self.num_workers - 1:
-            end = self.total
-        for path, gen in self.paths[start:end]:
-            self._hd5_to_disk(path, gen)
-
-    def run(self):
-        workers = []
-        for i in range(self.num_workers):
-            worker = mp.Process(target=self.mp_worker, args=(i,))
-            worker.start()
-            workers.append(worker)
-        for worker in workers:
-            worker.join()
+            parsed = 0
+            for chunk, batch in zip(chunks, batches):
+                self._write(batch)
+                if (parsed + len(chunk)) // 500 > parsed // 500:
+                    logging.info(f"Parsing {parsed + len(chunk)}/{self.total} ({(parsed + len(chunk)) / self.total * 100:.1f}%) done")
+                parsed += len(chunk)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        if self.buffered_rows > 0:
+            self._flush(final=True)
+        if self.writer is not None:
+            self.writer.close()
+        manifest = pd.DataFrame(self.files, columns=['path', 'rows', 'row_groups'])
+        manifest.to_parquet(os.path.join(self.directory, INFERENCE_MANIFEST), index=False)
+        logging.info(f"Wrote {manifest['rows'].sum()} explored tensors in {len(self.files)} files to {self.directory}")
+        return self.directory
+
+
+def read_explore_dataset(directory: str) -> pd.DataFrame:
+    """The explore rows written by ExploreParallelWrapper, read from the files in its manifest, with its string columns as pandas strings"""
+    manifest = pd.read_parquet(os.path.join(directory, INFERENCE_MANIFEST))
+    tables = [pq.read_table(os.path.join(directory, name)) for name in manifest['path']]
+    if not tables:
+        return pd.DataFrame()
+    table = pa.concat_tables(tables)
+    df = table.to_pandas()
+    str_cols = {field.name: 'string' for field in table.schema if field.type == pa.string()}
+    return df.astype(str_cols)
 
 
 def _tensors_to_df(args):
@@ -816,35 +885,9 @@ def _tensors_to_df(args):
     paths = []
     for gen, name in zip(generators, ["train", "valid", "test"]):
         paths += [(path, name) for path in gen.paths]  # TODO: relies on leaky abstraction of TensorGenerator
-    ExploreParallelWrapper(tmaps, paths, args.num_workers, args.output_folder, args.id).run()
-
-    # get columns that should have dtype 'string' instead of dtype 'O'
-    str_cols = ['fpath', 'generator']
-    for tm in tmaps:
-        if tm.interpretation == Interpretation.LANGUAGE:
-            str_cols.extend([f'{tm.name} {cm}' for cm in tm.channel_map] if tm.channel_map else [tm.name])
-        str_cols.append(f'error_type_{tm.name}')
-    str_cols = {key: 'string' for key in str_cols}
-
-    # read all temporary files to df
-    df = pd.DataFrame()
-    base = os.path.join(args.output_folder, args.id)
-    temp_files = []
-    for name in os.listdir(base):
-        if 'tensors_all_union_' in name:
-            fpath = os.path.join(base, name)
-            _df = pd.read_csv(fpath, dtype=str_cols)
-            logging.debug(f'Loaded {fpath} into memory')
-            df = df.append(_df, ignore_index=True)
-            logging.debug(f'Appended {fpath} to overall dataframe')
-            temp_files.append(fpath)
-
+    directory = ExploreParallelWrapper(tmaps, paths, args.num_workers, args.output_folder, args.id, args.explore_chunk_size).run()
+    df = read_explore_dataset(directory)
     logging.info(f"Extracted {len(tmaps)} tmaps from {len(df)} tensors across {len(paths)} hd5 files into DataFrame")
-
-    # remove temporary files
-    for fpath in temp_files:
-        os.remove(fpath)
-    logging.debug(f'Deleted {len(temp_files)} temporary files')
     return df
 
 
@@ -898,11 +941,12 @@ def explore(args):
         df.insert(0, 'FID', fid)
         df.insert(1, 'IID', fid)
     # Save dataframe to CSV
-    fpath = os.path.join(args.output_folder, args.id, f"tensors_all_union.{out_ext}")
-    df.to_csv(fpath, index=False, sep=out_sep)
-    fpath = os.path.join(args.output_folder, args.id, f"tensors_all_intersect.{out_ext}")
-    df.dropna().to_csv(fpath, index=False, sep=out_sep)
-    logging.info(f"Saved dataframe of tensors (union and intersect) to {fpath}")
+    if not args.explore_skip_csv:
+        fpath = os.path.join(args.output_folder, args.id, f"tensors_all_union.{out_ext}")
+        df.to_csv(fpath, index=False, sep=out_sep)
+        fpath = os.path.join(args.output_folder, args.id, f"tensors_all_intersect.{out_ext}")
+        df.dropna().to_csv(fpath, index=False, sep=out_sep)
+        logging.info(f"Saved dataframe of tensors (union and intersect) to {fpath}")
 
     # Check if any tmaps are categorical
     if Interpretation.CATEGORICAL in [tm.interpretation for tm in tmaps]:
@@ -1400,8 +1444,14 @@ def pca_on_matrix(matrix, pca_components, scree_path=None):
 
 
 def pca_on_tsv(tsv_file, columns, index_column, pca_components):
-    df = pd.read_csv(tsv_file, sep='\t')
-    matrix = df[columns].to_numpy()
+    """PCA of columns of a tsv, or of embeddings exported as npy shards if tsv_file is their directory"""
+    if is_embedding_shards(tsv_file):
+        sample_ids, matrix = load_embeddings(tsv_file)
+        df = pd.DataFrame({index_column: sample_ids})
+        tsv_file = tsv_file.rstrip(os.sep) + '.tsv'
+    else:
+        df = pd.read_csv(tsv_file, sep='\t')
+        matrix = df[columns].to_numpy()
     pca, reduced = pca_on_matrix(matrix, pca_components, tsv_file.replace('.tsv', f'_scree_{pca_components}.png'))
     reduced_df = pd.DataFrame(reduced)
     reduced_df.index = df[index_column]
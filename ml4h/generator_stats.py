@@ -0,0 +1,110 @@
+# generator_stats.py
+#
+# Epoch statistics of TensorGenerator workers.
+# At the end of each of its epochs a worker puts its counters on a queue and carries on without waiting.
+# The generator drains the queue between batches and merges the counters of an epoch once every worker has sent them.
+# Besides the counters used for the printed summary, workers count per TensorMap metrics
+# keyed by (TensorMap name, metric), which are written as JSON lines for dashboards.
+
+import os
+import json
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Optional, Tuple
+
+from ml4h.tensor_map_profiler import TensorMapProfiler
+
+TENSOR_MAP_ERROR_PREFIX = 'error:'
+TENSOR_MAP_METRICS = ['tensors', 'cache_hits', 'cache_misses', 'read_seconds', 'postprocess_seconds']
+WORKER_METRICS = ['Tensors presented', 'skipped_paths', 'cache_hits', 'cache_misses', 'seconds']
+
+WorkerStats = Tuple[Counter, Counter]  # a worker's epoch stats and its per TensorMap stats
+
+
+def merge_worker_stats(worker_stats: Iterable[Counter]) -> Counter:
+    """Sum counters, except keys with _max or _min, which take the max or min over workers"""
+    stats = Counter()
+    for i, worker in enumerate(worker_stats):
+        for k, v in worker.items():
+            if i == 0 and ('_max' in k or '_min' in k):
+                stats[k] = v
+            elif '_max' in k:
+                stats[k] = max(stats[k], v)
+            elif '_min' in k:
+                stats[k] = min(stats[k], v)
+            else:
+                stats[k] += v
+    return stats
+
+
+def error_counts(tensor_map_stats: Counter) -> Counter:
+    """Errors by exception type in per TensorMap stats"""
+    errors = Counter()
+    for (_, metric), count in tensor_map_stats.items():
+        if metric.startswith(TENSOR_MAP_ERROR_PREFIX):
+            errors[metric[len(TENSOR_MAP_ERROR_PREFIX):]] += count
+    return errors
+
+
+class EpochStats:
+    """The stats every worker sent for one epoch"""
+
+    def __init__(self, epoch: int, workers: Dict[str, WorkerStats], profile: Optional[TensorMapProfiler] = None):
+        self.epoch = epoch
+        self.workers = workers
+        self.profile = profile  # the merged TensorMap stage profiles of the workers, if they profile
+        self.merged = merge_worker_stats(stats for stats, _ in workers.values())
+        self.tensor_map_stats = sum((tm_stats for _, tm_stats in workers.values()), Counter())
+
+    def metrics(self, generator_name: str) -> Dict:
+        """Structured per worker and per TensorMap metrics that can be dumped as JSON"""
+        tensor_maps = defaultdict(lambda: {'errors': {}})
+        for (tm_name, metric), value in sorted(self.tensor_map_stats.items()):
+            if metric.startswith(TENSOR_MAP_ERROR_PREFIX):
+                tensor_maps[tm_name]['errors'][metric[len(TENSOR_MAP_ERROR_PREFIX):]] = value
+            else:
+                tensor_maps[tm_name][metric] = value
+        for tm_metrics in tensor_maps.values():
+            for metric in TENSOR_MAP_METRICS:
+                tm_metrics.setdefault(metric, 0)
+        return {
+            'generator': generator_name,
+            'epoch': self.epoch,
+            'time': time.time(),
+            'workers': {
+                worker: {
+                    **{metric: stats[metric] for metric in WORKER_METRICS},
+                    'errors': dict(error_counts(tm_stats)),
+                }
+                for worker, (stats, tm_stats) in sorted(self.workers.items())
+            },
+            'tensor_maps': dict(tensor_maps),
+        }
+
+
+class EpochStatsAggregator:
+    """Collects the stats workers send and hands back each epoch's stats once all workers have sent theirs"""
+
+    def __init__(self, num_workers: int, metrics_path: Optional[str] = None):
+        self.num_workers = num_workers
+        self.metrics_path = metrics_path
+        self.pending: Dict[int, Dict[str, WorkerStats]] = defaultdict(dict)
+        self.pending_profiles: Dict[int, TensorMapProfiler] = {}
+
+    def add(
+        self, worker: str, epoch: int, stats: Counter, tensor_map_stats: Counter, profile: Optional[TensorMapProfiler] = None,
+    ) -> Optional[EpochStats]:
+        self.pending[epoch][worker] = stats, tensor_map_stats
+        if profile is not None:
+            self.pending_profiles.setdefault(epoch, TensorMapProfiler()).merge(profile)
+        if len(self.pending[epoch]) < self.num_workers:
+            return None
+        return EpochStats(epoch, self.pending.pop(epoch), self.pending_profiles.pop(epoch, None))
+
+    def write(self, metrics: Dict):
+        """Append metrics to the metrics file as one JSON line"""
+        if self.metrics_path is None:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.metrics_path)), exist_ok=True)
+        with open(self.metrics_path, 'a') as metrics_file:
+            metrics_file.write(json.dumps(metrics) + '\n')
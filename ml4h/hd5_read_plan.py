@@ -0,0 +1,193 @@
+# hd5_read_plan.py
+#
+# Fused hd5 reads for all the TensorMaps of one sample.
+# Hd5View wraps an open h5py.File so that group lookups, membership tests, group listings and full dataset reads
+# happen at most once per sample, no matter how many TensorMaps repeat them.
+# Hd5ReadPlan learns which datasets the TensorMaps read from the first samples,
+# then prefetches those datasets in file order as soon as each later sample is opened.
+
+from collections import Counter
+from typing import Dict, List, Optional, Set
+
+import h5py
+import numpy as np
+
+from ml4h.packed_hd5 import open_hd5
+
+HD5_READ_PLAN_SAMPLES = 8  # samples observed before the read plan is fixed
+
+
+def _absolute(parent: str, name: str) -> str:
+    path = name if name.startswith('/') else f'{parent}/{name}'
+    return '/' + '/'.join(part for part in path.split('/') if part)
+
+
+def _is_everything(arg) -> bool:
+    return arg is Ellipsis or (isinstance(arg, slice) and arg == slice(None))
+
+
+def _reads_everything(args) -> bool:
+    if isinstance(args, tuple):
+        return all(_is_everything(arg) for arg in args)
+    return _is_everything(args)
+
+
+class _DatasetView(h5py.Dataset):
+    """A Dataset that keeps its contents in memory after the first full read"""
+
+    def __init__(self, bind, root: 'Hd5View', path: str):
+        super().__init__(bind, readonly=True)
+        self._root = root
+        self._path = path
+        self._data = None
+
+    def _load(self):
+        if self._data is None:
+            self._data = super().__getitem__(())
+            self._root.datasets_read.add(self._path)
+        return self._data
+
+    def __getitem__(self, args, new_dtype=None):
+        if new_dtype is None and not isinstance(args, str) and (self._data is not None or _reads_everything(args)):
+            data = self._load()
+            if isinstance(data, np.ndarray):
+                value = data[args]
+                return value.copy() if isinstance(value, np.ndarray) else value
+            if isinstance(args, tuple) and args == ():
+                return data
+        return super().__getitem__(args, new_dtype)
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(self._load(), dtype=dtype)
+
+
+class _GroupViewMixin:
+    """Memoizes lookups, membership tests and listings of an h5py.Group in the Hd5View of its sample"""
+
+    def _init_view(self, root: 'Hd5View', path: str):
+        self._root = root
+        self._path = path
+        self._keys: Optional[List[str]] = None
+
+    def __getitem__(self, name):
+        if not isinstance(name, str):
+            return super().__getitem__(name)
+        path = _absolute(self._path, name)
+        views = self._root.views
+        if path not in views:
+            node = super().__getitem__(name)
+            if isinstance(node, h5py.Dataset):
+                node = _DatasetView(node.id, self._root, path)
+            elif isinstance(node, h5py.Group):
+                node = _GroupView(node.id, self._root, path)
+            views[path] = node
+        return views[path]
+
+    def __contains__(self, name):
+        if not isinstance(name, str):
+            return super().__contains__(name)
+        path = _absolute(self._path, name)
+        contains = self._root.contains
+        if path not in contains:
+            contains[path] = path in self._root.views or super().__contains__(name)
+        return contains[path]
+
+    def __iter__(self):
+        if self._keys is None:
+            self._keys = list(super().__iter__())
+        return iter(self._keys)
+
+
+class _GroupView(_GroupViewMixin, h5py.Group):
+
+    def __init__(self, bind, root: 'Hd5View', path: str):
+        super().__init__(bind)
+        self._init_view(root, path)
+
+
+class Hd5View:
+    """
+    An open hd5 file whose groups and datasets are read at most once.
+    It wraps the h5py.File and acts like it, its groups are h5py.Groups and its datasets are h5py.Datasets,
+    so tensor_from_file callbacks use it unchanged. Closing the view closes the file.
+    """
+
+    def __init__(self, hd5: h5py.File):
+        self.hd5 = hd5
+        self.views: Dict[str, h5py.HLObject] = {}
+        self.contains: Dict[str, bool] = {}
+        self.datasets_read: Set[str] = set()
+        self.root = _GroupView(hd5['/'].id, self, '/')
+
+    def __getattr__(self, name):
+        # Group methods like get and keys go through the memoized root group, File methods like close to the file
+        try:
+            return getattr(self.root, name)
+        except AttributeError:
+            return getattr(self.hd5, name)
+
+    def __getitem__(self, name):
+        return self.root[name]
+
+    def __contains__(self, name):
+        return name in self.root
+
+    def __iter__(self):
+        return iter(self.root)
+
+    def __len__(self):
+        return len(self.root)
+
+    def __bool__(self):
+        return bool(self.hd5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.hd5.close()
+
+    def prefetch(self, paths: List[str]):
+        """Read the datasets at paths that exist in this file in one pass, ordered by their position in the file"""
+        datasets = [self[path] for path in paths if path in self]
+        datasets = [dataset for dataset in datasets if isinstance(dataset, _DatasetView)]
+        datasets.sort(key=lambda dataset: dataset.id.get_offset() or 0)  # chunked datasets have no single offset
+        for dataset in datasets:
+            dataset._load()
+
+
+class Hd5ReadPlan:
+    """
+    The datasets read in full by a fixed set of TensorMaps.
+    Learned from the first samples, keeping datasets read in at least half of them,
+    so paths that vary by sample, like dates, are not prefetched.
+    """
+
+    def __init__(self, samples_to_learn: int = HD5_READ_PLAN_SAMPLES):
+        self.samples_to_learn = samples_to_learn
+        self.samples_seen = 0
+        self.reads = Counter()
+        self.datasets: Optional[List[str]] = None
+
+    def open(self, path: str, hd5: Optional[h5py.File] = None) -> Hd5View:
+        """A view of the sample at path, or of hd5 if it is already open"""
+        view = Hd5View(open_hd5(path) if hd5 is None else hd5)
+        if self.datasets is not None:
+            view.prefetch(self.datasets)
+        return view
+
+    def learn(self, view: Hd5View):
+        if self.datasets is not None:
+            return
+        self.reads.update(view.datasets_read)
+        self.samples_seen += 1
+        if self.samples_seen >= self.samples_to_learn:
+            self.datasets = sorted(path for path, count in self.reads.items() if 2 * count >= self.samples_seen)
+
+    def __str__(self):
+        if self.datasets is None:
+            return f'Learning which datasets to prefetch, {self.samples_seen} of {self.samples_to_learn} samples seen.'
+        return f'Prefetching {len(self.datasets)} datasets for each sample.'
@@ -0,0 +1,281 @@
+# inference_writer.py
+#
+# Sinks that write batches of inference columns to disk, and a writer that runs them in background threads.
+# A batch is an ordered dict of column name to a numpy array with one value per sample.
+# The tsv sink writes one file in the format the inference recipes have always written.
+# The parquet and arrow sinks write typed columns: float32 values and int64 sample ids when every id is numeric.
+# Their rows are buffered into row groups, optionally split into files by sample id range,
+# and each parallel writer writes its own files, so writers never share a file.
+# A manifest of the files they wrote is saved with them once every writer is closed.
+
+import os
+import csv
+import queue
+import logging
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from ml4h.defines import INFERENCE_FORMATS
+
+INFERENCE_EXTENSIONS = {'tsv': '.tsv', 'parquet': '.parquet', 'arrow': '.arrow'}
+INFERENCE_ID_COLUMNS = ['sample_id', 'FID', 'IID']
+INFERENCE_MANIFEST = '_manifest.parquet'  # readers of the directory like pd.read_parquet skip files starting with _
+INFERENCE_MANIFEST_COLUMNS = ['path', 'writer', 'partition', 'rows', 'row_groups', 'min_sample_id', 'max_sample_id']
+INFERENCE_ROW_GROUP_SIZE = 65536
+INFERENCE_WRITER_MAX_PENDING = 8  # batches the writers may fall behind by
+
+Columns = Dict[str, np.ndarray]
+Hd5Tensors = List[Tuple[str, Dict[str, np.ndarray]]]
+
+
+class InferenceSink:
+    """Writes batches of columns. close returns a manifest row for each file written."""
+
+    def write(self, columns: Columns):
+        raise NotImplementedError
+
+    def close(self) -> List[Dict]:
+        raise NotImplementedError
+
+
+class TsvInferenceSink(InferenceSink):
+    """One tab separated file with a header row. Missing values are written as NA."""
+
+    def __init__(self, path: str, header: List[str]):
+        self.path = path
+        self.header = header
+        self.rows = 0
+        self.file = open(path, mode='w')
+        self.writer = csv.writer(self.file, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow(header)
+
+    def write(self, columns: Columns):
+        text = []
+        for name in self.header:
+            values = columns[name]
+            if values.dtype.kind == 'f':
+                text.append(['NA' if np.isnan(value) else str(value) for value in values])
+            else:
+                text.append([str(value) for value in values])
+        self.writer.writerows(zip(*text))
+        self.rows += len(columns[self.header[0]])
+
+    def close(self) -> List[Dict]:
+        self.file.close()
+        return [{'path': os.path.basename(self.path), 'writer': 0, 'partition': 0, 'rows': self.rows, 'row_groups': 0}]
+
+
+class ArrowInferenceSink(InferenceSink):
+    """
+    Files of typed columns in a directory, parquet files by default or arrow IPC files.
+    Rows are buffered and written row_group_size at a time.
+    If partition_size is positive, samples are split into files by sample id range, [k * partition_size, (k + 1) * partition_size),
+    which needs numeric sample ids. Files are named <partition>_<writer><extension>, so parallel writers never share a file.
+    Sample ids are int64 if numeric_ids, otherwise strings. If it is not set, it is decided by the first batch,
+    so parallel writers should be given it to be sure all their files have the same schema.
+    """
+
+    def __init__(
+        self, directory: str, writer_id: int = 0, file_format: str = 'parquet',
+        row_group_size: int = INFERENCE_ROW_GROUP_SIZE, partition_size: int = 0, numeric_ids: Optional[bool] = None,
+    ):
+        if file_format not in ('parquet', 'arrow'):
+            raise ValueError(f'Unknown columnar inference format {file_format}, it must be parquet or arrow.')
+        self.directory = directory
+        self.writer_id = writer_id
+        self.file_format = file_format
+        self.row_group_size = row_group_size
+        self.partition_size = partition_size
+        self.schema: Optional[pa.Schema] = None
+        self.numeric_ids = numeric_ids
+        self.buffers: Dict[int, List[pa.Table]] = {}
+        self.buffered_rows: Dict[int, int] = {}
+        self.writers: Dict[int, object] = {}
+        self.files: Dict[int, Dict] = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _table(self, columns: Columns) -> pa.Table:
+        if self.numeric_ids is None:
+            self.numeric_ids = all(str(value).isdigit() for name in INFERENCE_ID_COLUMNS if name in columns for value in columns[name])
+        arrays = {}
+        for name, values in columns.items():
+            if name in INFERENCE_ID_COLUMNS:
+                values = np.asarray(values).astype(np.int64 if self.numeric_ids else str)
+            elif values.dtype.kind == 'f':
+                values = values.astype(np.float32)
+            arrays[name] = values
+        table = pa.table(arrays)
+        if self.schema is None:
+            self.schema = table.schema
+        return table.cast(self.schema)
+
+    def _partitions(self, table: pa.Table) -> Dict[int, pa.Table]:
+        if self.partition_size <= 0:
+            return {0: table}
+        if not self.numeric_ids:
+            raise ValueError('Inference can only be partitioned by sample id range when every sample id is numeric.')
+        partitions = table.column(0).to_numpy() // self.partition_size
+        order = np.argsort(partitions, kind='stable')
+        keys, starts = np.unique(partitions[order], return_index=True)
+        sorted_table = table.take(order)
+        ends = list(starts[1:]) + [len(order)]
+        return {int(key): sorted_table.slice(start, end - start) for key, start, end in zip(keys, starts, ends)}
+
+    def _path(self, partition: int) -> str:
+        return os.path.join(self.directory, f'{partition:06d}_{self.writer_id:03d}{INFERENCE_EXTENSIONS[self.file_format]}')
+
+    def _flush(self, partition: int):
+        table = pa.concat_tables(self.buffers.pop(partition))
+        self.buffered_rows.pop(partition)
+        if partition not in self.writers:
+            path = self._path(partition)
+            if self.file_format == 'parquet':
+                self.writers[partition] = pq.ParquetWriter(path, self.schema)
+            else:
+                self.writers[partition] = pa.ipc.new_file(path, self.schema)
+            self.files[partition] = {
+                'path': os.path.basename(path), 'writer': self.writer_id, 'partition': partition,
+                'rows': 0, 'row_groups': 0, 'min_sample_id': None, 'max_sample_id': None,
+            }
+        if self.file_format == 'parquet':
+            self.writers[partition].write_table(table, row_group_size=self.row_group_size)
+        else:
+            self.writers[partition].write_table(table, max_chunksize=self.row_group_size)
+        ids = table.column(0).to_numpy(zero_copy_only=False)
+        record = self.files[partition]
+        record['rows'] += len(table)
+        record['row_groups'] += -(-len(table) // self.row_group_size)
+        record['min_sample_id'] = min(ids.min(), record['min_sample_id']) if record['min_sample_id'] is not None else ids.min()
+        record['max_sample_id'] = max(ids.max(), record['max_sample_id']) if record['max_sample_id'] is not None else ids.max()
+
+    def write(self, columns: Columns):
+        for partition, table in self._partitions(self._table(columns)).items():
+            self.buffers.setdefault(partition, []).append(table)
+            self.buffered_rows[partition] = self.buffered_rows.get(partition, 0) + len(table)
+            if self.buffered_rows[partition] >= self.row_group_size:
+                self._flush(partition)
+
+    def close(self) -> List[Dict]:
+        for partition in list(self.buffers):
+            self._flush(partition)
+        for writer in self.writers.values():
+            writer.close()
+        return [self.files[partition] for partition in sorted(self.files)]
+
+
+def write_inference_manifest(directory: str, files: List[Dict]) -> str:
+    """Save one row per file written to a directory of columnar inference, sorted by partition then writer"""
+    manifest = pd.DataFrame(files, columns=INFERENCE_MANIFEST_COLUMNS).sort_values(['partition', 'writer'])
+    path = os.path.join(directory, INFERENCE_MANIFEST)
+    manifest.to_parquet(path, index=False)
+    return path
+
+
+def inference_sinks(
+    path: str, header: List[str], file_format: str = 'tsv', writers: int = 1,
+    row_group_size: int = INFERENCE_ROW_GROUP_SIZE, partition_size: int = 0, numeric_ids: Optional[bool] = None,
+) -> List[InferenceSink]:
+    """
+    The sinks of an inference output: one tsv sink writing the file at path,
+    or a parquet or arrow sink for each parallel writer, writing into the directory at path.
+    """
+    if file_format == 'tsv':
+        if writers > 1:
+            logging.warning('Only one writer can write a tsv, so inference is written by one writer.')
+        return [TsvInferenceSink(path, header)]
+    if file_format not in INFERENCE_FORMATS:
+        raise ValueError(f'Unknown inference format {file_format}, choose from {INFERENCE_FORMATS}.')
+    return [ArrowInferenceSink(path, i, file_format, row_group_size, partition_size, numeric_ids) for i in range(writers)]
+
+
+class AsyncInferenceWriter:
+    """
+    Writes batches of inference columns to sinks, and inferred tensors to hd5s, in one background thread per sink.
+    Batches go to whichever writer is free, so the model never waits on disk.
+    At most max_pending batches are queued, so memory stays bounded when writing is slower than inference.
+    Errors raised while writing are raised again by write or close.
+    When a directory is given, close saves a manifest of every file the sinks wrote there.
+    """
+
+    def __init__(self, sinks: List[InferenceSink], directory: Optional[str] = None, max_pending: int = INFERENCE_WRITER_MAX_PENDING):
+        self.sinks = sinks
+        self.directory = directory
+        self.q = queue.Queue(max_pending)
+        self.error = None
+        self.files = []
+        self.lock = threading.Lock()
+        self.threads = [
+            threading.Thread(target=self._run, args=(sink,), name=f'inference_writer_{i}', daemon=True)
+            for i, sink in enumerate(sinks)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, sink: InferenceSink):
+        while True:
+            batch = self.q.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue  # keep draining so write never blocks on a full queue
+            columns, hd5_tensors = batch
+            try:
+                sink.write(columns)
+                _write_hd5_tensors(hd5_tensors)
+            except Exception as e:  # any error, a dead thread would leave write blocked on a full queue
+                self.error = e
+        try:
+            files = sink.close()
+        except Exception as e:
+            self.error = e
+            return
+        with self.lock:
+            self.files.extend(files)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, columns: Columns, hd5_tensors: Optional[Hd5Tensors] = None):
+        self._raise_error()
+        self.q.put((columns, hd5_tensors or []))
+
+    def close(self):
+        for _ in self.threads:
+            self.q.put(None)
+        for thread in self.threads:
+            thread.join()
+        self._raise_error()
+        if self.directory is not None:
+            write_inference_manifest(self.directory, self.files)
+
+
+def _write_hd5_tensors(hd5_tensors: Hd5Tensors):
+    for hd5_path, tensors in hd5_tensors:
+        os.makedirs(os.path.dirname(hd5_path), exist_ok=True)
+        with h5py.File(hd5_path, 'a') as hd5:
+            for name, tensor in tensors.items():
+                hd5.create_dataset(name, data=tensor, compression='gzip')
+
+
+def read_inference(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read inference written by any sink, from a tsv file or a directory of parquet or arrow files"""
+    if os.path.isfile(path):
+        return pd.read_csv(path, sep='\t', usecols=columns)
+    manifest = pd.read_parquet(os.path.join(path, INFERENCE_MANIFEST))
+    frames = []
+    for file_name in manifest['path']:
+        file_path = os.path.join(path, file_name)
+        if file_name.endswith(INFERENCE_EXTENSIONS['arrow']):
+            with pa.memory_map(file_path) as source:
+                table = pa.ipc.open_file(source).read_all()
+            frames.append(table.select(columns).to_pandas() if columns else table.to_pandas())
+        else:
+            frames.append(pd.read_parquet(file_path, columns=columns))
+    return pd.concat(frames, ignore_index=True)
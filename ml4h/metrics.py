@@ -533,111 +533,97 @@ def log_pearson_coefficients(coefs, label):
 def _unpack_truth_into_events(truth, intervals):
     event_time = np.argmin(np.diff(truth[:, :intervals]), axis=-1)
     event_time[truth[:, intervals-1] == 1] = intervals-1  # If the sample is never censored set event time to max time
-    event_indicator = np.sum(truth[:, intervals:], axis=-1).astype(np.bool)
+    event_indicator = np.sum(truth[:, intervals:], axis=-1).astype(bool)
     return event_indicator, event_time
 
 
-def _get_comparable(event_indicator, event_time, order):
+def _count_ranks_at_most(point_keys, offsets, ranks):
+    """For each query, the number of sorted point_keys in (offset, offset + rank]"""
+    return np.searchsorted(point_keys, offsets + ranks, side='right') - np.searchsorted(point_keys, offsets, side='right')
+
+
+def _concordance_counts(event_indicator, event_time, estimate, tied_tol=1e-8):
+    """
+    Counts of the comparable pairs of each event in O(n log n log t) for n samples with t distinct times.
+    An event is comparable to every sample with a later time and to censored samples at the same time.
+    Samples are numbered by their group of tied time, and pairs of an event and a later sample are counted
+    at the highest bit where their group numbers differ: for each bit, samples with the bit set are sorted
+    by their higher bits then estimate rank, and each event without the bit counts those sharing its higher bits
+    with a binary search. So each event's comparable samples with estimates above, below
+    and within tied_tol of its own are counted with a few sorts and searches per bit instead of pair by pair.
+
+    :return: the indices of the events, and for each event the number of comparable samples,
+             of those with estimates higher by more than tied_tol and lower by more than tied_tol,
+             and of censored samples at the same time, and whether any event has comparable samples
+    """
+    event_indicator = np.asarray(event_indicator, dtype=bool)
+    event_time = np.asarray(event_time)
+    estimate = np.asarray(estimate, dtype=np.float64)
     n_samples = len(event_time)
-    tied_time = 0
-    comparable = {}
-    i = 0
-    while i < n_samples - 1:
-        time_i = event_time[order[i]]
-        start = i + 1
-        end = start
-        while end < n_samples and event_time[order[end]] == time_i:
-            end += 1
-
-        # check for tied event times
-        event_at_same_time = event_indicator[order[i:end]]
-        censored_at_same_time = ~event_at_same_time
-        for j in range(i, end):
-            if event_indicator[order[j]]:
-                mask = np.zeros(n_samples, dtype=bool)
-                mask[end:] = True
-                # an event is comparable to censored samples at same time point
-                mask[i:end] = censored_at_same_time
-                comparable[j] = mask
-                tied_time += censored_at_same_time.sum()
-        i = end
-
-    return comparable, tied_time
+    order = np.argsort(event_time, kind='stable')
+    sorted_time = event_time[order]
+    new_group = np.r_[True, sorted_time[1:] != sorted_time[:-1]] if n_samples else np.array([], dtype=bool)
+    group = np.empty(n_samples, dtype=np.int64)
+    group[order] = np.cumsum(new_group) - 1
+    group_ends = np.r_[np.flatnonzero(new_group)[1:], n_samples]
+    values = np.unique(estimate)
+    rank = np.searchsorted(values, estimate, side='left') + 1
+    stride = len(values) + 1
+
+    events = np.flatnonzero(event_indicator)
+    event_group = group[events]
+    above = np.searchsorted(values, estimate[events] + tied_tol, side='right')
+    below = np.searchsorted(values, estimate[events] - tied_tol, side='left')
+    later = n_samples - group_ends[event_group] if len(events) else np.zeros(0, dtype=np.int64)
+    later_at_most_above = np.zeros(len(events), dtype=np.int64)
+    later_at_most_below = np.zeros(len(events), dtype=np.int64)
+    for bit in range(int(max(len(group_ends) - 1, 0)).bit_length()):
+        is_set = (group >> bit) & 1 == 1
+        points = np.sort((group[is_set] >> (bit + 1)) * stride + rank[is_set])
+        queries = (event_group >> bit) & 1 == 0
+        offsets = (event_group[queries] >> (bit + 1)) * stride
+        later_at_most_above[queries] += _count_ranks_at_most(points, offsets, above[queries])
+        later_at_most_below[queries] += _count_ranks_at_most(points, offsets, below[queries])
+
+    censored = ~event_indicator
+    points = np.sort(group[censored] * stride + rank[censored])
+    offsets = event_group * stride
+    tied_time = _count_ranks_at_most(points, offsets, stride - 1)
+    comparable = later + tied_time
+    higher = later - later_at_most_above + tied_time - _count_ranks_at_most(points, offsets, above)
+    lower = later_at_most_below + _count_ranks_at_most(points, offsets, below)
+
+    # events alone at the latest time have no comparable samples
+    has_comparable = bool(event_indicator[order[:n_samples - 1]].any() or (n_samples > 1 and event_indicator[order[-1]] and not new_group[-1]))
+    return events, comparable, higher, lower, tied_time, has_comparable
 
 
 def concordance_index(prediction, truth, tied_tol=1e-8):
     intervals = truth.shape[-1] // 2
     event_indicator, event_time = _unpack_truth_into_events(truth, intervals)
     estimate = np.cumprod(prediction[:, :intervals], axis=-1)[:, -1]
-    order = np.argsort(event_time)
-    comparable, tied_time = _get_comparable(event_indicator, event_time, order)
-
-    concordant = 0
-    discordant = 0
-    tied_risk = 0
-    numerator = 0.0
-    denominator = 0.0
-    for ind, mask in comparable.items():
-        est_i = estimate[order[ind]]
-        event_i = event_indicator[order[ind]]
-
-        est = estimate[order[mask]]
-
-        assert event_i, 'got censored sample at index %d, but expected uncensored' % order[ind]
-
-        ties = np.absolute(est - est_i) <= tied_tol
-        n_ties = ties.sum()
-
-        # an event should have a higher score
-        con = est > est_i
-        n_con = con[~ties].sum()
-
-        numerator += n_con + 0.5 * n_ties
-        denominator += mask.sum()
-
-        tied_risk += n_ties
-        concordant += n_con
-        discordant += est.size - n_con - n_ties
+    _, comparable, higher, lower, tied_time, _ = _concordance_counts(event_indicator, event_time, estimate, tied_tol)
 
+    # an event should have a lower survival estimate than the samples it is compared to
+    n_ties = comparable - higher - lower
+    numerator = higher.sum() + 0.5 * n_ties.sum()
+    denominator = np.float64(comparable.sum())
     cindex = numerator / denominator
-    return cindex, concordant, discordant, tied_risk, tied_time
+    return cindex, higher.sum(), lower.sum(), n_ties.sum(), tied_time.sum()
 
 
 def _estimate_concordance_index(event_indicator, event_time, estimate, weights, tied_tol=1e-8):
-    order = np.argsort(event_time)
-    comparable, tied_time = _get_comparable(event_indicator, event_time, order)
-    if len(comparable) == 0:
+    events, comparable, higher, lower, tied_time, has_comparable = _concordance_counts(event_indicator, event_time, estimate, tied_tol)
+    if not has_comparable:
         raise ValueError("Data has no comparable pairs, cannot estimate concordance index.")
 
-    concordant = 0
-    discordant = 0
-    tied_risk = 0
-    numerator = 0.0
-    denominator = 0.0
-    for ind, mask in comparable.items():
-        est_i = estimate[order[ind]]
-        event_i = event_indicator[order[ind]]
-        w_i = weights[order[ind]]
-
-        est = estimate[order[mask]]
-
-        assert event_i, 'got censored sample at index %d, but expected uncensored' % order[ind]
-
-        ties = np.absolute(est - est_i) <= tied_tol
-        n_ties = ties.sum()
-        # an event should have a higher score
-        con = est < est_i
-        n_con = con[~ties].sum()
-
-        numerator += w_i * n_con + 0.5 * w_i * n_ties
-        denominator += w_i * mask.sum()
-
-        tied_risk += n_ties
-        concordant += n_con
-        discordant += est.size - n_con - n_ties
-
+    # an event should have a higher risk estimate than the samples it is compared to
+    w = np.asarray(weights)[events]
+    n_ties = comparable - higher - lower
+    numerator = (w * lower).sum() + 0.5 * (w * n_ties).sum()
+    denominator = (w * comparable).sum()
     cindex = numerator / denominator
-    return cindex, concordant, discordant, tied_risk, tied_time
+    return cindex, lower.sum(), higher.sum(), n_ties.sum(), tied_time.sum()
 
 
 def concordance_index_censored(event_indicator, event_time, estimate, tied_tol=1e-8):
@@ -0,0 +1,194 @@
+import logging
+import multiprocessing as mp
+from typing import Callable, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+from ml4ht.data.data_loader import EXCEPTIONS
+
+from ml4h.TensorMap import TensorMap
+from ml4h.packed_hd5 import open_hd5
+
+STRATIFY_BINS = 5  # continuous labels are stratified by their quantiles
+LABEL_CHUNK_SIZE = 256  # paths each label reading process reads at a time
+MISSING_LABEL = -1
+
+
+class EpochSampler:
+    """
+    Orders the indices of the samples for each epoch.
+    Every epoch's order depends only on the seed and the epoch number,
+    so each data loader worker can compute it independently and reruns see the same orders.
+    """
+
+    def __init__(self, num_samples: int, seed: Optional[int] = None):
+        self.num_samples = num_samples
+        self.seed = int(np.random.randint(2**31)) if seed is None else seed
+
+    def rng(self, epoch: int) -> np.random.Generator:
+        return np.random.default_rng((self.seed, epoch))
+
+    def epoch(self, epoch: int) -> np.ndarray:
+        raise NotImplementedError
+
+    def __len__(self):
+        return self.num_samples
+
+
+class ShuffleSampler(EpochSampler):
+    """Every sample once per epoch, in a random order"""
+
+    def epoch(self, epoch: int) -> np.ndarray:
+        return self.rng(epoch).permutation(self.num_samples)
+
+
+class WeightedSampler(EpochSampler):
+    """
+    Draws samples with replacement so that each group of samples is drawn in proportion to its weight,
+    and the samples within a group are equally likely.
+
+    :param groups: the group of each sample
+    :param group_weights: relative weight of each group, groups without a weight are never drawn
+    :param num_samples: samples drawn per epoch, defaults to the number of samples
+    """
+
+    def __init__(self, groups: Sequence[int], group_weights: Sequence[float], num_samples: Optional[int] = None, seed: Optional[int] = None):
+        groups = np.asarray(groups)
+        super().__init__(len(groups) if num_samples is None else num_samples, seed)
+        group_weights = np.asarray(group_weights, dtype=np.float64)
+        group_sizes = np.bincount(groups[groups >= 0], minlength=len(group_weights))
+        sample_weights = np.zeros(len(groups))
+        drawn = (groups >= 0) & (groups < len(group_weights))
+        sample_weights[drawn] = group_weights[groups[drawn]] / group_sizes[groups[drawn]]
+        if sample_weights.sum() <= 0:
+            raise ValueError('WeightedSampler needs at least one sample with a positive weight.')
+        self.cdf = np.cumsum(sample_weights)
+
+    def epoch(self, epoch: int) -> np.ndarray:
+        return np.searchsorted(self.cdf, self.rng(epoch).random(self.num_samples) * self.cdf[-1], side='right')
+
+
+class ClassBalancedSampler(WeightedSampler):
+    """Draws samples with replacement so that every label is equally likely. Samples missing a label are never drawn."""
+
+    def __init__(self, labels: Sequence[int], num_samples: Optional[int] = None, seed: Optional[int] = None):
+        labels = np.asarray(labels)
+        group_weights = np.bincount(labels[labels != MISSING_LABEL], minlength=labels.max() + 1) > 0
+        super().__init__(labels, group_weights.astype(np.float64), num_samples, seed)
+
+
+class StratifiedSampler(EpochSampler):
+    """
+    Every sample once per epoch, shuffled within each label and interleaved,
+    so every stretch of the epoch, and so every batch, has close to the overall label proportions.
+    """
+
+    def __init__(self, labels: Sequence[int], seed: Optional[int] = None):
+        super().__init__(len(labels), seed)
+        labels = np.asarray(labels)
+        self.order = np.argsort(labels, kind='stable')  # samples grouped by label
+        _, starts, counts = np.unique(labels[self.order], return_index=True, return_counts=True)
+        self.label_starts = np.repeat(starts, counts)
+        self.label_counts = np.repeat(counts, counts)
+
+    def epoch(self, epoch: int) -> np.ndarray:
+        rng = self.rng(epoch)
+        # Each sample gets a random rank within its label, which is spread evenly across the epoch with some jitter
+        shuffled = np.lexsort((rng.random(self.num_samples), self.label_starts))
+        within_label = np.empty(self.num_samples, dtype=np.int64)
+        within_label[shuffled] = np.arange(self.num_samples) - self.label_starts[shuffled]
+        positions = (within_label + rng.random(self.num_samples)) / self.label_counts
+        return self.order[np.argsort(positions, kind='stable')]
+
+
+_label_tm: Optional[TensorMap] = None
+
+
+def _init_label_worker(tm: TensorMap):
+    # the TensorMap is handed to forked workers once instead of pickled with every chunk, its tensor_from_file may be a closure
+    global _label_tm
+    _label_tm = tm
+
+
+def _label_values(paths: List[str]) -> np.ndarray:
+    """The index of the largest channel of categorical labels or the mean of others, NaN where a sample cannot be read"""
+    values = np.full(len(paths), np.nan)
+    for i, path in enumerate(paths):
+        try:
+            with open_hd5(path) as hd5:
+                tensor = _label_tm.tensor_from_file(_label_tm, hd5, {})
+            values[i] = np.argmax(tensor) if _label_tm.is_categorical() else np.mean(tensor)
+        except EXCEPTIONS as e:
+            logging.debug(f'Could not read label {_label_tm.name} from {path}: {e}')
+    return values
+
+
+def tensor_map_labels(paths: List[str], tm: TensorMap, num_workers: int = 0) -> np.ndarray:
+    """
+    The label of each sample according to a TensorMap, read once.
+    Categorical TensorMaps give the index of their largest channel, others the quantile bin of their mean.
+    Samples that cannot be read get MISSING_LABEL.
+    If num_workers is positive, labels are read LABEL_CHUNK_SIZE paths at a time by a pool of that many processes.
+    """
+    chunks = [paths[start:start + LABEL_CHUNK_SIZE] for start in range(0, len(paths), LABEL_CHUNK_SIZE)]
+    if num_workers > 0 and len(chunks) > 1:
+        with mp.get_context('fork').Pool(min(num_workers, len(chunks)), initializer=_init_label_worker, initargs=(tm,)) as pool:
+            values = np.concatenate(pool.map(_label_values, chunks))
+    else:
+        _init_label_worker(tm)
+        values = _label_values(paths)
+    labels = np.full(len(paths), MISSING_LABEL, dtype=np.int64)
+    found = ~np.isnan(values)
+    if tm.is_categorical():
+        labels[found] = values[found]
+    elif found.any():
+        edges = np.quantile(values[found], np.linspace(0, 1, STRATIFY_BINS + 1)[1:-1])
+        labels[found] = np.digitize(values[found], edges)
+    logging.info(f'Read {tm.name} labels for {found.sum()} of {len(paths)} samples.')
+    return labels
+
+
+class SampledPathsDataset(IterableDataset):
+    """
+    Yields the samples of the paths a sampler picks for the current epoch.
+    Data loader workers each take every num_workers-th sample of the epoch.
+    Samples that raise errors are skipped. A ValueError is raised if the main process finds no valid samples in an epoch,
+    a worker that finds none only logs it since the others may have.
+    If set, on_epoch_end is called with the epoch and the worker id, 0 in the main process, when a worker finishes its samples.
+    """
+
+    def __init__(
+        self, paths: List[str], sample_getter: Callable, sampler: EpochSampler,
+        on_epoch_end: Optional[Callable[[int, int], None]] = None,
+    ):
+        super().__init__()
+        self.paths = paths
+        self.sample_getter = sample_getter
+        self.sampler = sampler
+        self.on_epoch_end = on_epoch_end
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        indices = self.sampler.epoch(self.epoch)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            indices = indices[worker_info.id::worker_info.num_workers]
+        successful = 0
+        for index in indices:
+            try:
+                sample = self.sample_getter(self.paths[index])
+            except EXCEPTIONS as e:
+                logging.debug(f'Could not get sample {self.paths[index]}: {e}')
+                continue
+            successful += 1
+            yield sample
+        if self.on_epoch_end is not None:
+            self.on_epoch_end(self.epoch, 0 if worker_info is None else worker_info.id)
+        if len(indices) and not successful:
+            if worker_info is None:
+                raise ValueError(f'Visited all {len(indices)} samples of epoch {self.epoch} without finding any valid samples.')
+            # other workers may have found samples, the data loader raises if none of them did
+            logging.warning(f'Worker {worker_info.id} found no valid samples among its {len(indices)} samples of epoch {self.epoch}.')
@@ -1,62 +1,122 @@
 import logging
-from typing import List
+from functools import partial
+from typing import List, Optional, Union
 
+import numpy as np
 from torch.utils.data import DataLoader
-from ml4ht.data.data_loader import SampleGetterIterableDataset, numpy_collate_fn
+from ml4ht.data.data_loader import numpy_collate_fn
 
 from ml4h.TensorMap import TensorMap
+from ml4h.tensor_map_profiler import TensorMapProfiler, write_worker_profile
 from ml4h.defines import TensorGeneratorABC
+from ml4h.tensor_cache import SharedTensorMapCache, PersistentTensorCache
+from ml4h.batch_functions import batch_function_collate, pick_batch_function
 from ml4h.ml4ht_integration.tensor_map import TensorMapSampleGetter
+from ml4h.ml4ht_integration.sampler import EpochSampler, ShuffleSampler, WeightedSampler, ClassBalancedSampler, StratifiedSampler
+from ml4h.ml4ht_integration.sampler import SampledPathsDataset, tensor_map_labels
 
 
 class TensorMapDataLoader(TensorGeneratorABC):
     def __init__(
         self, batch_size: int, input_maps: List[TensorMap], output_maps: List[TensorMap],
-        paths: List[str], num_workers: int,
+        paths: Union[List[str], List[List[str]]], num_workers: int,
+        weights: Optional[List[float]] = None,
         keep_paths: bool = False,
         drop_last: bool = True,
         augment: bool = False,
+        cache_size: float = 0,
+        shared_cache: bool = False,
+        tensor_cache_dir: Optional[str] = None,
+        mixup_alpha: float = 0.0,
+        siamese: bool = False,
+        sampler: str = 'shuffle',
+        sampler_label: Optional[str] = None,
+        seed: Optional[int] = None,
+        name: str = 'worker',
+        profile_dir: Optional[str] = None,
+        prefetch_factor: Optional[int] = None,
         **kwargs,
     ):
+        """
+        :param paths: If weights is provided, paths should be a list of path lists the same length as weights
+        :param weights: If set, samples are drawn with replacement so each list of paths is drawn in proportion to its weight
+        :param sampler: how samples are picked each epoch when there are no weights, one of SAMPLERS.
+                        'shuffle' visits every sample once, 'class_balanced' draws every label equally often,
+                        'stratified' visits every sample once with each label spread evenly through the epoch
+        :param sampler_label: name of the output TensorMap labels are read from, defaults to the first categorical output
+        :param seed: each epoch's sample order depends only on this seed and the epoch, drawn from np.random if not set
+        :param mixup_alpha: If positive, mixup batches and use this value as shape parameter alpha
+        :param siamese: if True yield left and right inputs for every input TensorMap and whether their outputs differ
+        :param cache_size: size in bytes of maximum cache for EACH worker, only used if shared_cache is True
+        :param shared_cache: If True, workers share one least recently used cache of cache_size * num_workers bytes in shared memory
+        :param tensor_cache_dir: If set, postprocessed tensors of cacheable TensorMaps are kept in a persistent cache in this directory
+        :param name: name of the data loader, used for profile files
+        :param profile_dir: If set, each data loader worker histograms the time, output, allocated and read bytes of every TensorMap stage,
+                            and logs and appends its summary to <name>_<worker id>_tensor_map_profile.tsv here every epoch
+        :param prefetch_factor: batches each worker loads ahead, torch's default if not set. Only used with workers
+        """
+        groups = None
+        if weights is not None:
+            groups = np.concatenate([np.full(len(group_paths), i) for i, group_paths in enumerate(paths)])
+            paths = [path for group_paths in paths for path in group_paths]
         self.paths = paths
         self.input_maps = input_maps
         self.output_maps = output_maps
         self.keep_paths = keep_paths
+        batch_function, batch_function_kwargs, samples_per_row = pick_batch_function(mixup_alpha, siamese)
+        self.cache = None
+        if shared_cache and cache_size > 0:
+            self.cache = SharedTensorMapCache(cache_size * max(num_workers, 1), input_maps, output_maps, max_rows=len(paths))
+        self.profiler = TensorMapProfiler() if profile_dir is not None else None
         self.sample_getter = TensorMapSampleGetter(
             input_maps, output_maps, augment,
-            return_path=keep_paths,
-        )
-        self.dset = SampleGetterIterableDataset(
-            paths, self.sample_getter,
-            get_epoch=SampleGetterIterableDataset.shuffle_get_epoch,
+            return_path=keep_paths, cache=self.cache,
+            persistent_cache=PersistentTensorCache(tensor_cache_dir, input_maps + output_maps) if tensor_cache_dir else None,
+            profiler=self.profiler,
         )
+        self.sampler = self._make_sampler(groups, weights, sampler, sampler_label, seed, num_workers)
+        # Workers get copies of the profiler and the sample getter that uses it, so each writes its own profile
+        on_epoch_end = None if self.profiler is None else partial(write_worker_profile, self.profiler, profile_dir, name)
+        self.dset = SampledPathsDataset(paths, self.sample_getter, self.sampler, on_epoch_end)
         self.data_loader = DataLoader(
-            self.dset, batch_size=batch_size, num_workers=num_workers,
-            collate_fn=self._collate_fn, drop_last=drop_last,
+            self.dset, batch_size=batch_size * samples_per_row, num_workers=num_workers,
+            collate_fn=batch_function_collate(numpy_collate_fn, batch_function, keep_paths, **batch_function_kwargs),
+            drop_last=drop_last, prefetch_factor=prefetch_factor if num_workers else None,
         )
         self.iter_loader = iter(self.data_loader)
 
-
-    def _collate_fn(self, batches):
-        if self.keep_paths:
-            return numpy_collate_fn([batch[:2] for batch in batches]) + ([batch[2] for batch in batches],)
-        return numpy_collate_fn(batches)
+    def _make_sampler(
+        self, groups, weights, sampler: str, sampler_label: Optional[str], seed: Optional[int], num_workers: int,
+    ) -> EpochSampler:
+        if weights is not None:
+            return WeightedSampler(groups, weights, seed=seed)
+        if sampler == 'shuffle':
+            return ShuffleSampler(len(self.paths), seed)
+        label_maps = [tm for tm in self.output_maps if tm.name == sampler_label or (sampler_label is None and tm.is_categorical())]
+        if not label_maps:
+            raise ValueError(f'{sampler} sampling needs an output TensorMap to read labels from, but found none named {sampler_label}.')
+        labels = tensor_map_labels(self.paths, label_maps[0], num_workers)  # read before the data loader's workers start
+        if sampler == 'class_balanced':
+            return ClassBalancedSampler(labels, seed=seed)
+        if sampler == 'stratified':
+            return StratifiedSampler(labels, seed)
+        raise ValueError(f'Unknown sampler {sampler}.')
+
+    def _next_epoch(self):
+        self.dset.epoch += 1
+        self.iter_loader = iter(self.data_loader)
 
     @staticmethod
     def can_apply(paths, weights, mixup, siamese, **kwargs):
         """Can you substitute this TensorGenerator for the ml4h legacy TensorGenerator"""
-        if isinstance(paths[0], list):
+        if isinstance(paths[0], list) and weights is None:
             raise NotImplementedError(
-                "TensorMapDataLoader cannot sample from multiple lists of paths. Pass a list of paths for the paths argument",
+                "TensorMapDataLoader needs weights to sample from multiple lists of paths.",
             )
-        if weights is not None:
+        if weights is not None and len(weights) != len(paths):
             raise NotImplementedError(
-                "TensorMapDataLoader cannot sample from multiple lists of paths. Do not pass 'weights' argument.",
+                "TensorMapDataLoader needs one weight for each list of paths.",
             )
-        if mixup:
-            raise NotImplementedError("Mixup not implemented for TensorMapDataLoader")
-        if siamese:
-            raise NotImplementedError("Siamese not implemented for TensorMapDataLoader")
 
     def __iter__(self):
         return self
@@ -66,20 +126,27 @@ class TensorMapDataLoader(TensorGeneratorABC):
         try:
             return next(self.iter_loader)
         except StopIteration:
-            self.iter_loader = iter(self.data_loader)
+            self._next_epoch()
             logging.info("Completed one epoch.")
+            if self.cache is not None:
+                logging.info(str(self.cache))
+        try:
             return next(self.iter_loader)
+        except StopIteration:
+            raise ValueError(f'Epoch {self.dset.epoch} of {len(self.paths)} paths did not yield any batches, no worker found enough valid samples.')
 
     def __call__(self):
         try:
             next(self.iter_loader)
         except StopIteration:
-            self.iter_loader = iter(self.data_loader)
+            self._next_epoch()
         return self
 
     def kill_workers(self):
         """necessary for legacy compatibility"""
-        pass
+        if self.cache is not None:
+            self.cache.unlink()
+            self.cache = None
 
 
 class TensorMapDataLoaderFromDataset(TensorGeneratorABC):
@@ -1,8 +1,11 @@
-from typing import Callable, List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 import h5py
 
 from ml4h.TensorMap import TensorMap, Interpretation
+from ml4h.tensor_cache import SharedTensorMapCache, PersistentTensorCache
+from ml4h.packed_hd5 import open_hd5
+from ml4h.tensor_map_profiler import TensorMapProfiler
 from ml4ht.data.data_description import DataDescription
 from ml4ht.data.defines import SampleID, LoadingOption, Tensor, Batch
 
@@ -14,6 +17,9 @@ class TensorMapSampleGetter:
             tensor_maps_out: List[TensorMap],
             augment: bool = False,
             return_path: bool = False,
+            cache: Optional[SharedTensorMapCache] = None,
+            persistent_cache: Optional[PersistentTensorCache] = None,
+            profiler: Optional[TensorMapProfiler] = None,
     ):
         """
         A SampleGetter that is built from TensorMaps.
@@ -23,6 +29,10 @@ class TensorMapSampleGetter:
         :param tensor_maps_out: tensor maps to use to get output data for a model
         :param augment: whether to apply the TensorMaps' data augmentations.
                         This should be true for training and false for testing.
+        :param return_path: whether to also return the path of the sample
+        :param cache: optional cache shared by data loader workers, cacheable TensorMaps are read from it when possible
+        :param persistent_cache: optional on disk cache of postprocessed tensors that is kept between runs
+        :param profiler: optional TensorMapProfiler that records the time, output, allocated and read bytes of every TensorMap stage
 
         Example preparing TensorMaps for use in ml4h model:
         ```
@@ -61,22 +71,38 @@ class TensorMapSampleGetter:
         self.tensor_maps_out = tensor_maps_out
         self.augment = augment
         self.return_path = return_path
+        self.cache = cache
+        self.persistent_cache = persistent_cache
+        self.profiler = profiler
+
+    def _get_tensor(self, tm: TensorMap, name: str, path: str, hd5: h5py.File, dependents) -> Tensor:
+        use_cache = self.cache is not None and tm.cacheable
+        if use_cache:
+            cached = self.cache.get((path, name))
+            if cached is not None:
+                return cached
+        if self.persistent_cache is not None:
+            def cached(_):
+                return self.persistent_cache.tensor(tm, path, self.augment, lambda: hd5, dependents)
+            tensor = cached(None) if self.profiler is None else self.profiler.run(tm.name, 'persistent_cache', cached, None)
+        else:
+            tensor = tm.postprocess_tensor(
+                tm.tensor_from_file(tm, hd5, dependents) if self.profiler is None else self.profiler.read(tm, hd5, dependents),
+                augment=self.augment, hd5=hd5, profiler=self.profiler,
+            )
+        if use_cache:
+            self.cache[path, name] = tensor
+        return tensor
 
     def __call__(self, path: str) -> Batch:
         dependents = {}
-        with h5py.File(path, 'r') as hd5:
+        with open_hd5(path) as hd5:
             in_batch = {}
             for tm in self.tensor_maps_in:
-                in_batch[tm.input_name()] = tm.postprocess_tensor(
-                    tm.tensor_from_file(tm, hd5, dependents),
-                    augment=self.augment, hd5=hd5,
-                )
+                in_batch[tm.input_name()] = self._get_tensor(tm, tm.input_name(), path, hd5, dependents)
             out_batch = {}
             for tm in self.tensor_maps_out:
-                out_batch[tm.output_name()] = tm.postprocess_tensor(
-                    tm.tensor_from_file(tm, hd5, dependents),
-                    augment=self.augment, hd5=hd5,
-                )
+                out_batch[tm.output_name()] = self._get_tensor(tm, tm.output_name(), path, hd5, dependents)
         if self.return_path:
             return in_batch, out_batch, path
         return in_batch, out_batch
@@ -64,8 +64,8 @@ def train_model_from_generators(
         plot_and_time_model(model, generate_train, generate_valid, batch_size, training_steps, inspect_show_labels, image_p)
 
     history = model.fit(
-        generate_train, steps_per_epoch=training_steps, epochs=epochs, verbose=1,
-        validation_steps=validation_steps, validation_data=generate_valid,
+        getattr(generate_train, 'dataset', generate_train), steps_per_epoch=training_steps, epochs=epochs, verbose=1,
+        validation_steps=validation_steps, validation_data=getattr(generate_valid, 'dataset', generate_valid),
         callbacks=_get_callbacks(patience, model_file, save_last_model),
     )
 
@@ -0,0 +1,153 @@
+# packed_hd5.py
+#
+# Datasets of many sample hd5 files packed into a few large shard files.
+# Each sample's hd5 file is copied byte for byte into a shard, starting at a multiple of PACKED_ALIGNMENT bytes.
+# A parquet manifest records the shard, offset and length of each sample and the dataset paths it contains.
+# Samples of a packed dataset at /path/to/packed have virtual paths like /path/to/packed/<sample_id>.hd5,
+# so code that takes the sample id from the file name works unchanged, and open_hd5 opens them from their shard.
+
+import io
+import os
+from typing import Dict, Iterator, List, Optional
+
+import h5py
+import pandas as pd
+
+from ml4h.defines import TENSOR_EXT
+
+PACKED_MANIFEST = 'manifest.parquet'
+PACKED_SHARD_EXT = '.hd5pack'
+PACKED_ALIGNMENT = 4096
+PACKED_SHARD_BYTES = 2**30
+MANIFEST_COLUMNS = ['sample_id', 'shard', 'offset', 'length', 'keys']
+
+
+def is_packed_dataset(directory: str) -> bool:
+    return os.path.isfile(os.path.join(directory, PACKED_MANIFEST))
+
+
+class PackedHd5Dataset:
+    """Reads samples from the shards of a packed dataset. Each process opens its own shard file descriptors."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        manifest = pd.read_parquet(os.path.join(directory, PACKED_MANIFEST), columns=MANIFEST_COLUMNS[:-1])
+        self.locations = {
+            str(sample_id): (shard, int(offset), int(length))
+            for sample_id, shard, offset, length in manifest.itertuples(index=False)
+        }
+        self._fds: Dict[str, int] = {}
+        self._pid = None
+
+    def __contains__(self, sample_id: str) -> bool:
+        return sample_id in self.locations
+
+    def __len__(self):
+        return len(self.locations)
+
+    def paths(self) -> List[str]:
+        """Virtual paths of every sample, in manifest order"""
+        return [os.path.join(self.directory, f'{sample_id}{TENSOR_EXT}') for sample_id in self.locations]
+
+    def keys(self) -> pd.DataFrame:
+        """Sample ids and the hd5 dataset paths available in each sample"""
+        return pd.read_parquet(os.path.join(self.directory, PACKED_MANIFEST), columns=['sample_id', 'keys'])
+
+    def _fd(self, shard: str) -> int:
+        if self._pid != os.getpid():  # forked workers must not share file offsets or close their parent's files
+            self._fds, self._pid = {}, os.getpid()
+        if shard not in self._fds:
+            fd = os.open(os.path.join(self.directory, shard), os.O_RDONLY)
+            if self._fds.setdefault(shard, fd) != fd:  # another read ahead thread opened it first
+                os.close(fd)
+        return self._fds[shard]
+
+    def read(self, sample_id: str) -> bytes:
+        """The bytes of a sample's hd5 file in one read"""
+        shard, offset, length = self.locations[sample_id]
+        return os.pread(self._fd(shard), length, offset)
+
+    def open(self, sample_id: str) -> h5py.File:
+        return open_hd5_bytes(self.read(sample_id))
+
+    def version(self, sample_id: str) -> str:
+        shard, offset, length = self.locations[sample_id]
+        return f'{os.stat(os.path.join(self.directory, shard)).st_mtime_ns}\0{offset}\0{length}'
+
+
+_PACKED_DATASETS: Dict[str, Optional[PackedHd5Dataset]] = {}
+
+
+def packed_dataset(directory: str) -> Optional[PackedHd5Dataset]:
+    """The packed dataset in directory, or None if directory is not one. Manifests are read once per process."""
+    directory = os.path.abspath(directory)
+    if directory not in _PACKED_DATASETS:
+        _PACKED_DATASETS[directory] = PackedHd5Dataset(directory) if is_packed_dataset(directory) else None
+    return _PACKED_DATASETS[directory]
+
+
+def _packed_sample(path: str):
+    if os.path.exists(path):
+        return None, None
+    directory, file_name = os.path.split(path)
+    dataset = packed_dataset(directory)
+    sample_id = os.path.splitext(file_name)[0]
+    if dataset is None or sample_id not in dataset:
+        return None, None
+    return dataset, sample_id
+
+
+def open_hd5(path: str) -> h5py.File:
+    """Open a sample's hd5 for reading, whether it is a file or a virtual path into a packed dataset"""
+    dataset, sample_id = _packed_sample(path)
+    if dataset is None:
+        return h5py.File(path, 'r')
+    return dataset.open(sample_id)
+
+
+def read_hd5_bytes(path: str) -> bytes:
+    """The bytes of a sample's hd5 in one read, whether it is a file or a virtual path into a packed dataset"""
+    dataset, sample_id = _packed_sample(path)
+    if dataset is None:
+        with open(path, 'rb') as hd5_file:
+            return hd5_file.read()
+    return dataset.read(sample_id)
+
+
+def open_hd5_bytes(data: bytes) -> h5py.File:
+    return h5py.File(io.BytesIO(data), 'r')
+
+
+def sample_version(path: str) -> str:
+    """Changes whenever the sample's hd5 is rewritten"""
+    dataset, sample_id = _packed_sample(path)
+    if dataset is None:
+        stat = os.stat(path)
+        return f'{stat.st_mtime_ns}\0{stat.st_size}'
+    return dataset.version(sample_id)
+
+
+def tensor_paths(tensors: str) -> Iterator[str]:
+    """Paths of every hd5 under the directory tensors, or the virtual paths of the samples if it is a packed dataset"""
+    dataset = packed_dataset(tensors)
+    if dataset is not None:
+        yield from dataset.paths()
+        return
+    for root, dirs, files in os.walk(tensors):
+        for name in files:
+            if os.path.splitext(name)[-1].lower() == TENSOR_EXT:
+                yield os.path.join(root, name)
+
+
+def sample_paths(directory: str) -> List[str]:
+    """
+    Paths of the hd5s directly in directory, not in its subdirectories, sorted,
+    or the virtual paths of the samples if it is a packed dataset
+    """
+    dataset = packed_dataset(directory)
+    if dataset is not None:
+        return sorted(dataset.paths())
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if os.path.splitext(name)[-1].lower() == TENSOR_EXT
+    )
@@ -59,6 +59,7 @@ import ml4h.tensormap.mgb.ecg
 from ml4h.tensormap.mgb.dynamic import make_waveform_maps
 from ml4h.TensorMap import TensorMap
 from ml4h.metrics import concordance_index, concordance_index_censored, coefficient_of_determination
+from ml4h.bootstrap import bootstrap, bootstrap_interval
 from ml4h.defines import (
     IMAGE_EXT,
     JOIN_CHAR,
@@ -681,9 +682,8 @@ def bootstrap_confidence_interval(
         max_n: int = 1000000, metric_fxn: Callable = _pearson_wrapper,
 ) -> Tuple[float, Tuple[float, float]]:
     n = min(max_n, len(truth))
-    sample_idxs = np.random.randint(n, size=(n_boot, n_boot))
-    r2s = [metric_fxn(truth[idx], prediction[idx]) for idx in sample_idxs]
-    return np.mean(r2s), np.percentile(r2s, [bottom, top])
+    metric = 'pearson' if metric_fxn is _pearson_wrapper else metric_fxn
+    return bootstrap_interval(truth[:n], prediction[:n], metric, n_boot, bottom, top)
 
 
 def plot_scatter(
@@ -831,7 +831,7 @@ def subplot_pearson_per_class(
         truth,
         protected,
         axes,
-        metric=coefficient_of_determination,
+        metric='r2',
         metric_name="$R^2$",
     )
 
@@ -2362,19 +2362,15 @@ def plot_counter(counts, title, prefix="./figures/"):
 def _bootstrap_performance(
     truth: np.ndarray,
     prediction: np.ndarray,
-    metric: Callable[[np.ndarray, np.ndarray], float],
+    metric: Union[str, Callable[[np.ndarray, np.ndarray], float]],
     n_samples: int = 1000,
 ) -> List[float]:
-    performance = []
-    for _ in range(n_samples):
-        idx = np.random.randint(0, truth.shape[0], size=truth.shape[0])
-        performance.append(metric(truth[idx], prediction[idx]))
-    return performance
+    return bootstrap(truth, prediction, metric, n_samples).tolist()
 
 
 def _performance_by_index(
     separated_metric_inputs: List[Tuple[np.ndarray, np.ndarray]],
-    metric: Callable[[np.ndarray, np.ndarray], float],
+    metric: Union[str, Callable[[np.ndarray, np.ndarray], float]],
 ) -> List[List[float]]:
     """
     Input dictionary {name: (truth, predicted)} and performance metric
@@ -2391,7 +2387,7 @@ def _protected_subplots(
     truth: np.ndarray,
     protected: Dict[TensorMap, np.ndarray],
     axes: np.ndarray,
-    metric: Callable[[np.ndarray, np.ndarray], float],
+    metric: Union[str, Callable[[np.ndarray, np.ndarray], float]],
     metric_name: str,
     continuous_quantiles: Tuple[float, ...] = (1 / 3, 2 / 3),
 ):
@@ -2463,7 +2459,7 @@ def subplot_roc_per_class(
         rows, cols, figsize=(cols * SUBPLOT_SIZE, rows * SUBPLOT_SIZE),
     )
     _protected_subplots(
-        prediction, truth, protected, axes, metric=roc_auc_score, metric_name="ROC AUC",
+        prediction, truth, protected, axes, metric='roc_auc', metric_name="ROC AUC",
     )
     fpr, tpr, roc_auc = get_fpr_tpr_roc_pred(prediction, truth, labels)
 
@@ -5,16 +5,18 @@ import os
 import csv
 import copy
 import h5py
-import glob
 import logging
 import numpy as np
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 from collections import Counter, defaultdict
+from typing import Dict, List, Tuple
 
 from ml4h.arguments import parse_args
 from ml4h.models.inspect import saliency_map
 from ml4h.optimizers import find_learning_rate
+from ml4h.TensorMap import TensorMap
 from ml4h.defines import TENSOR_EXT, MODEL_EXT
 from ml4h.models.train import train_model_from_generators
 from ml4h.tensormap.tensor_map_maker import write_tensor_maps
@@ -22,9 +24,13 @@ from ml4h.tensorize.tensor_writer_mgb import write_tensors_mgb
 from ml4h.models.model_factory import block_make_multimodal_multitask_model
 from ml4h.tensor_generators import BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX, BATCH_PATHS_INDEX
 from ml4h.explorations import mri_dates, ecg_dates, predictions_to_pngs, sample_from_language_model, pca_on_tsv
-from ml4h.explorations import plot_while_learning, plot_histograms_of_tensors_in_pdf, cross_reference
+from ml4h.explorations import plot_while_learning, plot_histograms_of_tensors_in_pdf, cross_reference, tabulate_correlations_of_tensors
 from ml4h.explorations import test_labels_to_label_map, infer_with_pixels, explore, latent_space_dataframe
 from ml4h.tensor_generators import TensorGenerator, test_train_valid_tensor_generators, big_batch_from_minibatch_generator
+from ml4h.ml4ht_integration.tensor_generator import TensorMapDataLoader
+from ml4h.inference_writer import AsyncInferenceWriter, TsvInferenceSink, inference_sinks
+from ml4h.embedding_export import EmbeddingShardWriter
+from ml4h.packed_hd5 import sample_paths
 from ml4h.metrics import get_roc_aucs, get_precision_recall_aucs, get_pearson_coefficients, log_aucs, log_pearson_coefficients
 from ml4h.plots import evaluate_predictions, plot_scatters, plot_rocs, plot_precision_recalls, subplot_roc_per_class, plot_tsne, plot_survival
 from ml4h.plots import plot_reconstruction, plot_hit_to_miss_transforms, plot_saliency_maps, plot_partners_ecgs, plot_ecg_rest_mp
@@ -84,6 +90,8 @@ def run(args):
             ecg_dates(args.tensors, args.output_folder, args.id)
         elif 'plot_histograms' == args.mode:
             plot_histograms_of_tensors_in_pdf(args.id, args.tensors, args.output_folder, args.max_samples)
+        elif 'tabulate_correlations' == args.mode:
+            tabulate_correlations_of_tensors(args.id, args.tensors, args.output_folder, args.min_samples, args.max_samples, args.correlation_method)
         elif 'plot_resting_ecgs' == args.mode:
             plot_ecg_rest_mp(args.tensors, args.min_sample_id, args.max_sample_id, args.output_folder, args.num_workers)
         elif 'plot_partners_ecgs' == args.mode:
@@ -253,102 +261,122 @@ def _make_tmap_nan_on_fail(tmap):
     return new_tmap
 
 
-def inference_file_name(output_folder: str, id_: str) -> str:
-    return os.path.join(output_folder, id_, 'inference_' + id_ + '.tsv')
+def inference_file_name(output_folder: str, id_: str, inference_format: str = 'tsv') -> str:
+    """The inference tsv, or for columnar formats the directory of inference files"""
+    name = os.path.join(output_folder, id_, 'inference_' + id_)
+    return name + '.tsv' if inference_format == 'tsv' else name
+
+
+def _inference_header(model_output_names: List[str], output_maps: Dict[str, TensorMap], tsv_style_is_genetics: bool) -> List[str]:
+    header = ['FID', 'IID'] if tsv_style_is_genetics else ['sample_id']
+    for ot in model_output_names:
+        otm = output_maps[ot]
+        logging.info(f"Got ot  {ot} and otm {otm}  ot and otm {otm.name} ot  and otm {otm.channel_map} channel_map and otm {otm.interpretation}.")
+        if len(otm.shape) == 1 and otm.is_continuous():
+            header.extend([otm.name + '_prediction', otm.name + '_actual'])
+        elif len(otm.shape) == 1 and otm.is_categorical():
+            channel_columns = []
+            for k in otm.channel_map:
+                channel_columns.append(otm.name + '_' + k + '_prediction')
+                channel_columns.append(otm.name + '_' + k + '_actual')
+            header.extend(channel_columns)
+        elif otm.is_survival_curve():
+            header.extend([otm.name + '_prediction', otm.name + '_actual', otm.name + '_follow_up'])
+    return header
+
+
+def _inference_columns(
+    sample_ids: List[str], predictions: Dict[str, np.ndarray], output_data: Dict[str, np.ndarray],
+    output_maps: Dict[str, TensorMap], tsv_style_is_genetics: bool, hd5_folder: str,
+) -> Tuple[Dict[str, np.ndarray], List[Tuple[str, Dict[str, np.ndarray]]]]:
+    """
+    The inference columns of a batch of predictions, named like _inference_header,
+    and the tensors to write to each sample's hd5 for outputs with more than one axis.
+    Actual values that are missing, NaN or the TensorMap's sentinel, are NaN.
+    """
+    sample_ids = np.array(sample_ids)
+    columns = {'FID': sample_ids, 'IID': sample_ids} if tsv_style_is_genetics else {'sample_id': sample_ids}
+    hd5_tensors = []
+    for ot, y in predictions.items():
+        otm = output_maps[ot]
+        actual = output_data[otm.output_name()]
+        if len(otm.shape) == 1 and otm.is_continuous():
+            columns[otm.name + '_prediction'] = otm.rescale(y)[:, 0]
+            missing = np.isnan(actual[:, 0])
+            if otm.sentinel is not None:
+                missing |= actual[:, 0] == otm.sentinel
+            columns[otm.name + '_actual'] = np.where(missing, np.nan, otm.rescale(actual)[:, 0])
+        elif len(otm.shape) == 1 and otm.is_categorical():
+            for k, i in otm.channel_map.items():
+                if i >= y.shape[-1] or i >= actual.shape[-1]:
+                    logging.debug(f'index error at {otm.name} item {i} key {k} with cm: {otm.channel_map} y is {y.shape}')
+                    columns[otm.name + '_' + k + '_prediction'] = columns[otm.name + '_' + k + '_actual'] = np.full(len(sample_ids), np.nan)
+                    continue
+                columns[otm.name + '_' + k + '_prediction'] = y[:, i]
+                columns[otm.name + '_' + k + '_actual'] = actual[:, i]
+        elif otm.is_survival_curve():
+            intervals = otm.shape[-1] // 2
+            days_per_bin = 1 + otm.days_window // intervals
+            predicted_survivals = np.cumprod(y[:, :intervals], axis=1)
+            columns[otm.name + '_prediction'] = 1 - predicted_survivals[:, -1]
+            columns[otm.name + '_actual'] = np.sum(actual[:, intervals:], axis=-1)
+            columns[otm.name + '_follow_up'] = np.cumsum(actual[:, :intervals], axis=-1)[:, -1] * days_per_bin
+        elif otm.axes() > 1:
+            for i, sample_id in enumerate(sample_ids):
+                hd5_tensors.append((
+                    os.path.join(hd5_folder, f'{sample_id}{TENSOR_EXT}'),
+                    {f'{otm.name}_truth': otm.rescale(actual[i]), f'{otm.name}_prediction': otm.rescale(y[i])},
+                ))
+    return columns, hd5_tensors
 
 
 def infer_multimodal_multitask(args):
+    """
+    Write the model's predictions for every sample, with their actual values when they can be read.
+    Samples are read by args.num_workers data loader workers in batches of args.batch_size, and the model predicts a batch at a time.
+    Samples whose output TensorMaps fail get NaN actual values, so they are still inferred,
+    only samples whose input TensorMaps fail are skipped.
+    Predictions are written to a tsv, or with args.inference_format parquet or arrow,
+    to a directory of files written by args.inference_writers parallel writers, with a manifest of the files.
+    """
     stats = Counter()
-    tensor_paths_inferred = set()
-    inference_tsv = inference_file_name(args.output_folder, args.id)
+    inference_path = inference_file_name(args.output_folder, args.id, args.inference_format)
     tsv_style_is_genetics = 'genetics' in args.tsv_style
 
     model = make_multimodal_multitask_model(**args.__dict__)
     no_fail_tmaps_out = [_make_tmap_nan_on_fail(tmap) for tmap in args.tensor_maps_out]
     tensor_paths = _tensor_paths_from_sample_csv(args.tensors, args.sample_csv)
-    # hard code batch size to 1 so we can iterate over file names and generated tensors together in the tensor_paths for loop
-    generate_test = TensorGenerator(
-        1, args.tensor_maps_in, no_fail_tmaps_out, tensor_paths, num_workers=0,
-        cache_size=0, keep_paths=True, mixup_alpha=args.mixup_alpha,
-    )
-
     logging.info(f"Found {len(tensor_paths)} tensor paths.")
-    generate_test.set_worker_paths(tensor_paths)
+    generate_test = TensorMapDataLoader(
+        args.batch_size, args.tensor_maps_in, no_fail_tmaps_out, tensor_paths, num_workers=args.num_workers,
+        keep_paths=True, drop_last=False, name='inference_worker',
+    )
     output_maps = {tm.output_name(): tm for tm in no_fail_tmaps_out}
-    with open(inference_tsv, mode='w') as inference_file:
-        # TODO: csv.DictWriter is much nicer for this
-        inference_writer = csv.writer(inference_file, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        header = ['sample_id']
-        if tsv_style_is_genetics:
-            header = ['FID', 'IID']
-        for ot in model.output_names:
-            otm = output_maps[ot]
-            logging.info(f"Got ot  {ot} and otm {otm}  ot and otm {otm.name} ot  and otm {otm.channel_map} channel_map and otm {otm.interpretation}.")
-            if len(otm.shape) == 1 and otm.is_continuous():
-                header.extend([otm.name + '_prediction', otm.name + '_actual'])
-            elif len(otm.shape) == 1 and otm.is_categorical():
-                channel_columns = []
-                for k in otm.channel_map:
-                    channel_columns.append(otm.name + '_' + k + '_prediction')
-                    channel_columns.append(otm.name + '_' + k + '_actual')
-                header.extend(channel_columns)
-            elif otm.is_survival_curve():
-                header.extend([otm.name + '_prediction', otm.name + '_actual', otm.name + '_follow_up'])
-        inference_writer.writerow(header)
-
-        while True:
-            batch = next(generate_test)
-            input_data, output_data, tensor_paths = batch[BATCH_INPUT_INDEX], batch[BATCH_OUTPUT_INDEX], batch[BATCH_PATHS_INDEX]
-            if tensor_paths[0] in tensor_paths_inferred:
-                next(generate_test)  # this prints end of epoch info
-                logging.info(f"Inference on {stats['count']} tensors finished. Inference TSV file at: {inference_tsv}")
-                break
-            prediction = model.predict(input_data, verbose=0)
-            if len(no_fail_tmaps_out) == 1:
+    sinks = inference_sinks(
+        inference_path, _inference_header(model.output_names, output_maps, tsv_style_is_genetics), args.inference_format,
+        args.inference_writers, args.inference_row_group_size, args.inference_partition_size,
+        numeric_ids=all(os.path.basename(path).replace(TENSOR_EXT, '').isdigit() for path in tensor_paths),
+    )
+    writer = AsyncInferenceWriter(sinks, None if args.inference_format == 'tsv' else inference_path)
+    hd5_folder = os.path.join(args.output_folder, args.id, 'inferred_hd5s')
+    try:
+        # one pass of the iterator the loader already started visits every sample once, and yields a smaller last batch
+        for batch in generate_test.iter_loader:
+            input_data, output_data, paths = batch[BATCH_INPUT_INDEX], batch[BATCH_OUTPUT_INDEX], batch[BATCH_PATHS_INDEX]
+            prediction = model.predict_on_batch(input_data)
+            if len(model.output_names) == 1:
                 prediction = [prediction]
-            predictions_dict = {name: pred for name, pred in zip(model.output_names, prediction)}
-            sample_id = os.path.basename(tensor_paths[0]).replace(TENSOR_EXT, '')
-            csv_row = [sample_id]
-            if tsv_style_is_genetics:
-                csv_row *= 2
-            for ot in model.output_names:
-                y = predictions_dict[ot]
-                otm = output_maps[ot]
-                if len(otm.shape) == 1 and otm.is_continuous():
-                    csv_row.append(str(otm.rescale(y)[0][0]))  # first index into batch then index into the 1x1 structure
-                    if ((otm.sentinel is not None and otm.sentinel == output_data[otm.output_name()][0][0])
-                            or np.isnan(output_data[otm.output_name()][0][0])):
-                        csv_row.append("NA")
-                    else:
-                        csv_row.append(str(otm.rescale(output_data[otm.output_name()])[0][0]))
-                elif len(otm.shape) == 1 and otm.is_categorical():
-                    for k, i in otm.channel_map.items():
-                        try:
-                            csv_row.append(str(y[0][otm.channel_map[k]]))
-                            actual = output_data[otm.output_name()][0][i]
-                            csv_row.append("NA" if np.isnan(actual) else str(actual))
-                        except IndexError:
-                            logging.debug(f'index error at {otm.name} item {i} key {k} with cm: {otm.channel_map} y is {y.shape} y is {y}')
-                elif otm.is_survival_curve():
-                    intervals = otm.shape[-1] // 2
-                    days_per_bin = 1 + otm.days_window // intervals
-                    predicted_survivals = np.cumprod(y[:, :intervals], axis=1)
-                    #predicted_survivals = np.cumprod(y[:, :10], axis=1) 2 year probability
-                    csv_row.append(str(1 - predicted_survivals[0, -1]))
-                    sick = np.sum(output_data[otm.output_name()][:, intervals:], axis=-1)
-                    follow_up = np.cumsum(output_data[otm.output_name()][:, :intervals], axis=-1)[:, -1] * days_per_bin
-                    csv_row.extend([str(sick[0]), str(follow_up[0])])
-                elif otm.axes() > 1:
-                    hd5_path = os.path.join(args.output_folder, args.id, 'inferred_hd5s', f'{sample_id}{TENSOR_EXT}')
-                    os.makedirs(os.path.dirname(hd5_path), exist_ok=True)
-                    with h5py.File(hd5_path, 'a') as hd5:
-                        hd5.create_dataset(f'{otm.name}_truth', data=otm.rescale(output_data[otm.output_name()][0]), compression='gzip')
-                        hd5.create_dataset(f'{otm.name}_prediction', data=otm.rescale(y[0]), compression='gzip')
-            inference_writer.writerow(csv_row)
-            tensor_paths_inferred.add(tensor_paths[0])
-            stats['count'] += 1
-            if stats['count'] % 250 == 0:
-                logging.info(f"Wrote:{stats['count']} rows of inference.  Last tensor:{tensor_paths[0]}")
+            predictions_dict = {name: np.asarray(pred) for name, pred in zip(model.output_names, prediction)}
+            sample_ids = [os.path.basename(path).replace(TENSOR_EXT, '') for path in paths]
+            writer.write(*_inference_columns(sample_ids, predictions_dict, output_data, output_maps, tsv_style_is_genetics, hd5_folder))
+            previous_count = stats['count']
+            stats['count'] += len(paths)
+            if stats['count'] // 250 > previous_count // 250:
+                logging.info(f"Wrote:{stats['count']} rows of inference.  Last tensor:{paths[-1]}")
+    finally:
+        writer.close()
+        generate_test.kill_workers()
+    logging.info(f"Inference on {stats['count']} tensors finished. Inference written to: {inference_path}")
 
 
 def _tensor_paths_from_sample_csv(tensors, sample_csv):
@@ -358,7 +386,7 @@ def _tensor_paths_from_sample_csv(tensors, sample_csv):
             sample_ids = [row[0] for row in csv.reader(csv_file)]
             sample_set = set(sample_ids[1:])
     tensor_paths = [
-        file for file in glob.glob(os.path.join(tensors, f"*{TENSOR_EXT}"))
+        file for file in sample_paths(tensors)
         if sample_set is None or os.path.splitext(os.path.basename(file))[0] in sample_set
     ]
     return tensor_paths
@@ -369,48 +397,56 @@ def _hidden_file_name(output_folder: str, prefix_: str, id_: str, extension_: st
 
 
 def infer_hidden_layer_multimodal_multitask(args):
+    """
+    Write the embeddings of every sample at args.hidden_layer.
+    Samples are read by args.num_workers data loader workers in batches of args.batch_size, and embedded a batch at a time.
+    With args.embedding_format tsv, embeddings are written as latent_<i> columns of a tsv.
+    With npy, they are written as args.embedding_dtype matrices in memory mappable shards with a sample id index,
+    see ml4h.embedding_export.load_embeddings.
+    """
     stats = Counter()
-    args.num_workers = 0
-    inference_tsv = _hidden_file_name(args.output_folder, args.hidden_layer, args.id, '.tsv')
+    extension = '.tsv' if args.embedding_format == 'tsv' else ''
+    inference_path = _hidden_file_name(args.output_folder, args.hidden_layer, args.id, extension)
     tsv_style_is_genetics = 'genetics' in args.tsv_style
     tensor_paths = _tensor_paths_from_sample_csv(args.tensors, args.sample_csv)
-    # hard code batch size to 1 so we can iterate over file names and generated tensors together in the tensor_paths for loop
-    generate_test = TensorGenerator(
-        1, args.tensor_maps_in, args.tensor_maps_out, tensor_paths, num_workers=0,
-        cache_size=args.cache_size, keep_paths=True, mixup_alpha=args.mixup_alpha,
+    generate_test = TensorMapDataLoader(
+        args.batch_size, args.tensor_maps_in, args.tensor_maps_out, tensor_paths, num_workers=args.num_workers,
+        keep_paths=True, drop_last=False, name='embedding_worker',
     )
-    generate_test.set_worker_paths(tensor_paths)
     full_model = make_multimodal_multitask_model(**args.__dict__)
     embed_model = make_hidden_layer_model(full_model, args.tensor_maps_in, args.hidden_layer)
     embed_model.save(_hidden_file_name(args.output_folder, f'{args.hidden_layer}_encoder_', args.id, '.h5'))
     dummy_input = {tm.input_name(): np.zeros((1,) + full_model.get_layer(tm.input_name()).input_shape[0][1:]) for tm in args.tensor_maps_in}
     dummy_out = embed_model.predict(dummy_input)
     latent_dimensions = int(np.prod(dummy_out.shape[1:]))
-    logging.info(f'Dummy output shape is: {dummy_out.shape} latent dimensions: {latent_dimensions} Will write inferences to: {inference_tsv}')
-    with open(inference_tsv, mode='w') as inference_file:
-        inference_writer = csv.writer(inference_file, delimiter='\t', quotechar='"', quoting=csv.QUOTE_MINIMAL)
-        header = ['FID', 'IID'] if tsv_style_is_genetics else ['sample_id']
-        header += [f'latent_{i}' for i in range(latent_dimensions)]
-        inference_writer.writerow(header)
-
-        while True:
-            batch = next(generate_test)
-            input_data, tensor_paths = batch[BATCH_INPUT_INDEX], batch[BATCH_PATHS_INDEX]
-            if tensor_paths[0] in stats:
-                next(generate_test)  # this prints end of epoch info
-                logging.info(f"Latent space inference on {stats['count']} tensors finished. Inference TSV file at: {inference_tsv}")
-                break
-
-            sample_id = os.path.basename(tensor_paths[0]).replace(TENSOR_EXT, '')
-            prediction = embed_model.predict(input_data, verbose=0)
-            prediction = np.reshape(prediction, (latent_dimensions,))
-            csv_row = [sample_id, sample_id] if tsv_style_is_genetics else [sample_id]
-            csv_row += [f'{prediction[i]}' for i in range(latent_dimensions)]
-            inference_writer.writerow(csv_row)
-            stats[tensor_paths[0]] += 1
-            stats['count'] += 1
-            if stats['count'] % 500 == 0:
-                logging.info(f"Wrote:{stats['count']} rows of latent space inference.  Last tensor:{tensor_paths[0]}")
+    logging.info(f'Dummy output shape is: {dummy_out.shape} latent dimensions: {latent_dimensions} Will write inferences to: {inference_path}')
+    latent_columns = [f'latent_{i}' for i in range(latent_dimensions)]
+    if args.embedding_format == 'tsv':
+        header = (['FID', 'IID'] if tsv_style_is_genetics else ['sample_id']) + latent_columns
+        writer = AsyncInferenceWriter([TsvInferenceSink(inference_path, header)])
+    else:
+        writer = EmbeddingShardWriter(inference_path, latent_dimensions, args.embedding_dtype, args.embedding_shard_size)
+    try:
+        # one pass of the iterator the loader already started visits every sample once, and yields a smaller last batch
+        for batch in generate_test.iter_loader:
+            input_data, paths = batch[BATCH_INPUT_INDEX], batch[BATCH_PATHS_INDEX]
+            sample_ids = [os.path.basename(path).replace(TENSOR_EXT, '') for path in paths]
+            embeddings = np.reshape(embed_model.predict_on_batch(input_data), (len(paths), latent_dimensions))
+            if args.embedding_format == 'tsv':
+                ids = np.array(sample_ids)
+                columns = {'FID': ids, 'IID': ids} if tsv_style_is_genetics else {'sample_id': ids}
+                columns.update(zip(latent_columns, embeddings.T))
+                writer.write(columns)
+            else:
+                writer.write(sample_ids, embeddings)
+            previous_count = stats['count']
+            stats['count'] += len(paths)
+            if stats['count'] // 500 > previous_count // 500:
+                logging.info(f"Wrote:{stats['count']} rows of latent space inference.  Last tensor:{paths[-1]}")
+    finally:
+        writer.close()
+        generate_test.kill_workers()
+    logging.info(f"Latent space inference on {stats['count']} tensors finished. Inference written to: {inference_path}")
 
 
 def train_shallow_model(args):
@@ -488,8 +524,8 @@ def infer_encoders_block_multimodal_multitask(args):
         logging.info(f'Will write encodings from {e.name} to: {inference_tsv}')
         # hard code batch size to 1 so we can iterate over file names and generated tensors together in the tensor_paths for loop
         tensor_paths = [
-            os.path.join(args.tensors, tp) for tp in sorted(os.listdir(args.tensors))
-            if os.path.splitext(tp)[-1].lower() == TENSOR_EXT and (sample_set is None or os.path.splitext(tp)[0] in sample_set)
+            tp for tp in sample_paths(args.tensors)
+            if sample_set is None or os.path.splitext(os.path.basename(tp))[0] in sample_set
         ]
         generate_test = TensorGenerator(
             1, [e], [], tensor_paths, num_workers=0,
@@ -708,9 +744,43 @@ def _get_predictions(args, models_inputs_outputs, input_data, outputs, input_pre
     return predictions
 
 
+class _PreallocatedRows:
+    """Arrays of rows filled a batch at a time, allocated on the first batch for the expected number of rows and doubled if it is exceeded"""
+
+    def __init__(self, rows: int):
+        self.expected_rows = rows
+        self.arrays: Dict[str, np.ndarray] = {}
+
+    def put(self, key, start: int, values: np.ndarray):
+        values = np.asarray(values)
+        if key not in self.arrays:
+            self.arrays[key] = np.empty((max(self.expected_rows, len(values)),) + values.shape[1:], dtype=values.dtype)
+        while start + len(values) > len(self.arrays[key]):
+            self.arrays[key] = np.concatenate([self.arrays[key], np.empty_like(self.arrays[key])])
+        self.arrays[key][start:start + len(values)] = values
+
+    def get(self, key, rows: int) -> np.ndarray:
+        return self.arrays[key][:rows]
+
+
+def _predict_batch(model, input_data: Dict[str, np.ndarray], output_maps: List[TensorMap], scalar_maps: List[TensorMap], predictions: _PreallocatedRows, start: int):
+    # We can feed the model the entire input data because it knows what subset to use
+    y_predictions = model.predict_on_batch(input_data)
+    if not isinstance(y_predictions, list):  # When models have a single output it returns a ndarray otherwise it returns a list
+        y_predictions = [y_predictions]
+    for y, tm in zip(y_predictions, output_maps):
+        if tm in scalar_maps:
+            predictions.put(tm, start, y)
+
+
 def _scalar_predictions_from_generator(args, models_inputs_outputs, generator, steps, outputs, input_prefix, output_prefix):
     """Makes multi-modal scalar predictions for a given number of models.
 
+    Each batch is read once, while the previous batch is predicted, and then predicted by every model in parallel threads,
+    at most args.comparison_threads at a time. TensorFlow releases the GIL while models run, so the models overlap,
+    though they share TensorFlow's pool of intra-op threads.
+    Labels and predictions are filled into arrays preallocated for steps batches.
+
     Returns:
         dict: The nested dictionary of predicted values.
 
@@ -728,9 +798,10 @@ def _scalar_predictions_from_generator(args, models_inputs_outputs, generator, s
             }
     """
     models = {}
+    output_maps = {}
+    scalar_maps = {}
     test_paths = []
-    scalar_predictions = {}
-    test_labels = {tm.output_name(): [] for tm in args.tensor_maps_out if len(tm.shape) == 1}
+    test_labels = [tm.output_name() for tm in args.tensor_maps_out if len(tm.shape) == 1]
 
     for model_file in models_inputs_outputs:
         args.model_file = model_file
@@ -739,34 +810,46 @@ def _scalar_predictions_from_generator(args, models_inputs_outputs, generator, s
         model = make_multimodal_multitask_model(**args.__dict__)
         model_name = os.path.basename(model_file).replace(MODEL_EXT, '')
         models[model_name] = model
-        scalar_predictions[model_name] = [tm for tm in models_inputs_outputs[model_file][output_prefix] if len(tm.shape) == 1]
-
+        output_maps[model_name] = models_inputs_outputs[model_file][output_prefix]
+        scalar_maps[model_name] = [tm for tm in output_maps[model_name] if len(tm.shape) == 1]
+
+    threads = min(args.comparison_threads or len(models), len(models))
+    labels = None
+    model_predictions = {}
+    rows = 0
+    with ThreadPoolExecutor(1) as loader, ThreadPoolExecutor(threads) as predictors:
+        next_batch = loader.submit(next, generator)
+        for j in range(steps):
+            batch = next_batch.result()
+            if j + 1 < steps:
+                next_batch = loader.submit(next, generator)
+            input_data, output_data, tensor_paths = batch[BATCH_INPUT_INDEX], batch[BATCH_OUTPUT_INDEX], batch[BATCH_PATHS_INDEX]
+            batch_rows = len(next(iter(input_data.values())))
+            if labels is None:
+                labels = _PreallocatedRows(steps * batch_rows)
+                model_predictions = {model_name: _PreallocatedRows(steps * batch_rows) for model_name in models}
+            test_paths.extend(tensor_paths)
+            for tl in test_labels:
+                labels.put(tl, rows, output_data[tl])
+            futures = [
+                predictors.submit(_predict_batch, model, input_data, output_maps[model_name], scalar_maps[model_name], model_predictions[model_name], rows)
+                for model_name, model in models.items()
+            ]
+            for future in futures:
+                future.result()
+            rows += batch_rows
+
+    logging.info(f'Predicted {rows} samples with {len(models)} models in {threads} threads.')
+    test_labels = {tl: labels.get(tl, rows) for tl in test_labels} if labels is not None else {}
     predictions = defaultdict(dict)
-    for j in range(steps):
-        batch = next(generator)
-        input_data, output_data, tensor_paths = batch[BATCH_INPUT_INDEX], batch[BATCH_OUTPUT_INDEX], batch[BATCH_PATHS_INDEX]
-        test_paths.extend(tensor_paths)
-        for tl in test_labels:
-            test_labels[tl].extend(np.copy(output_data[tl]))
-
-        for model_name, model_file in zip(models, models_inputs_outputs):
-            # We can feed 'model.predict()' the entire input data because it knows what subset to use
-            y_predictions = models[model_name].predict(input_data)
-
-            for y, tm in zip(y_predictions, models_inputs_outputs[model_file][output_prefix]):
-                if not isinstance(y_predictions, list):  # When models have a single output model.predict returns a ndarray otherwise it returns a list
-                    y = y_predictions
-                if j == 0 and tm in scalar_predictions[model_name]:
-                    predictions[tm][model_name] = []
-                if tm in scalar_predictions[model_name]:
-                    predictions[tm][model_name].extend(np.copy(y))
-
+    for model_name in models:
+        for tm in scalar_maps[model_name]:
+            if tm in model_predictions[model_name].arrays:
+                predictions[tm][model_name] = model_predictions[model_name].get(tm, rows)
     for tm in predictions:
         logging.info(f"{tm.output_name()} labels: {len(test_labels[tm.output_name()])}")
-        test_labels[tm.output_name()] = np.array(test_labels[tm.output_name()])
         for m in predictions[tm]:
             logging.info(f"{tm.output_name()} model: {m} prediction length:{len(predictions[tm][m])}")
-            predictions[tm][m] = np.array(predictions[tm][m])
 
     return predictions, test_labels, test_paths
 
@@ -0,0 +1,116 @@
+# sample_index.py
+#
+# An index of what each sample hd5 contains, so samples are found and prefiltered without walking or opening files.
+# The index is a parquet table with one row per dataset per sample: the dataset's path, shape, dtype and any date in its path.
+# Samples whose files have not changed since the last build are not rescanned.
+
+import os
+import re
+import logging
+from multiprocessing import Pool
+from typing import Dict, Iterable, List, Set, Tuple
+
+import h5py
+import pandas as pd
+
+from ml4h.TensorMap import TensorMap
+from ml4h.packed_hd5 import open_hd5, sample_version, tensor_paths
+
+SAMPLE_INDEX_COLUMNS = ['sample_id', 'path', 'version', 'dataset', 'shape', 'dtype', 'date']
+SAMPLE_INDEX_CHUNK_SIZE = 64
+DATE_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}')
+
+
+def _scan_sample(path_and_version: Tuple[str, str]) -> List[Tuple]:
+    """One row per dataset in the sample, or one row without a dataset if it has none or cannot be read"""
+    path, version = path_and_version
+    sample_id = os.path.splitext(os.path.basename(path))[0]
+    rows = []
+
+    def _row(name, obj):
+        if isinstance(obj, h5py.Dataset):
+            dataset = f'/{name}'
+            date = DATE_PATTERN.search(dataset)
+            shape = ','.join(map(str, obj.shape))
+            rows.append((sample_id, path, version, dataset, shape, str(obj.dtype), date.group() if date else None))
+    try:
+        with open_hd5(path) as hd5:
+            hd5.visititems(_row)
+    except OSError as e:
+        logging.warning(f'Could not index {path}: {e}')
+        rows = []
+    return rows or [(sample_id, path, version, None, None, None, None)]
+
+
+def build_sample_index(tensors: str, index_path: str, num_workers: int = os.cpu_count()) -> pd.DataFrame:
+    """
+    Index every sample hd5 under tensors, or update an existing index at index_path.
+    Only samples that are new or whose files changed are opened, in parallel with num_workers processes.
+
+    :param tensors: directory of hd5s or packed dataset to index
+    :param index_path: parquet file to read the previous index from and write the new index to
+    :param num_workers: number of processes used to read new or changed samples
+    :return: the index as a DataFrame
+    """
+    previous = pd.read_parquet(index_path) if os.path.exists(index_path) else pd.DataFrame(columns=SAMPLE_INDEX_COLUMNS)
+    previous_versions = dict(zip(previous['path'], previous['version']))
+    current = [(path, sample_version(path)) for path in tensor_paths(tensors)]
+    changed = [(path, version) for path, version in current if previous_versions.get(path) != version]
+    unchanged = {path for path, version in current} - {path for path, _ in changed}
+    logging.info(f'Indexing {len(changed)} new or changed samples, keeping {len(unchanged)} from {index_path}.')
+
+    rows = []
+    if num_workers > 1 and len(changed) > SAMPLE_INDEX_CHUNK_SIZE:
+        with Pool(num_workers) as pool:
+            for sample_rows in pool.imap_unordered(_scan_sample, changed, chunksize=SAMPLE_INDEX_CHUNK_SIZE):
+                rows.extend(sample_rows)
+    else:
+        for path_and_version in changed:
+            rows.extend(_scan_sample(path_and_version))
+    index = pd.concat(
+        [previous[previous['path'].isin(unchanged)], pd.DataFrame(rows, columns=SAMPLE_INDEX_COLUMNS)],
+        ignore_index=True,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+    index.to_parquet(index_path, index=False)
+    logging.info(f"Saved index of {index['path'].nunique()} samples and {index['dataset'].count()} datasets at {index_path}.")
+    return index
+
+
+class SampleIndex:
+    """The samples in a sample index and the hd5 groups and datasets each one has"""
+
+    def __init__(self, index: pd.DataFrame):
+        self.index = index
+        self.sample_paths = list(dict.fromkeys(index['path']))
+        self.keys: Dict[str, Set[str]] = {path: set() for path in self.sample_paths}
+        for path, dataset in zip(index['path'], index['dataset']):
+            if not isinstance(dataset, str):
+                continue
+            keys = self.keys[path]
+            while dataset and dataset not in keys:  # a dataset's groups are keys too
+                keys.add(dataset)
+                dataset = dataset.rsplit('/', 1)[0]
+
+    @classmethod
+    def load(cls, index_path: str) -> 'SampleIndex':
+        return cls(pd.read_parquet(index_path, columns=['path', 'dataset']))
+
+    def paths(self, tensor_maps: Iterable[TensorMap] = ()) -> List[str]:
+        """
+        Paths of samples that have the hd5 keys every TensorMap requires.
+        TensorMaps that do not declare or imply hd5 keys do not filter any samples.
+        """
+        requirements = []
+        for tm in tensor_maps:
+            keys = tm.required_hd5_keys()
+            if keys is not None:
+                requirements.append({key.rstrip('/') for key in keys})
+        if not requirements:
+            return self.sample_paths
+        paths = [
+            path for path in self.sample_paths
+            if all(not self.keys[path].isdisjoint(required) for required in requirements)
+        ]
+        logging.info(f'{len(paths)} of {len(self.sample_paths)} samples in the index have the hd5 keys of {len(requirements)} TensorMaps.')
+        return paths
@@ -0,0 +1,478 @@
+# tensor_cache.py
+#
+# Caches of tensors made by TensorMaps that are shared by data loading worker processes.
+# Caches are created in the parent process before workers start,
+# so every TensorGenerator or TensorMapDataLoader worker reads and writes the same memory.
+# PersistentTensorCache keeps postprocessed tensors on disk so they are reused across epochs and experiments.
+
+import os
+import glob
+import uuid
+import types
+import hashlib
+import logging
+import functools
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import h5py
+import numpy as np
+
+from ml4h.TensorMap import TensorMap
+from ml4h.packed_hd5 import sample_version
+
+CacheKey = Tuple[str, str]  # file path, TensorMap input or output name
+
+EMPTY_KEY = 0
+# Indices into the shared counters of a cache group
+HITS, MISSES, EVICTIONS, CLOCK, SLOTS_USED, HAND = range(6)
+NUM_COUNTERS = 6
+COUNTER_NAMES = {HITS: 'cache_hits', MISSES: 'cache_misses', EVICTIONS: 'cache_evictions'}
+EVICTION_SAMPLES = 8  # slots compared to find one to evict, so eviction is O(1) under the lock
+
+PERSISTENT_CACHE_VERSION = 2  # bump when the layout of the persistent cache or the meaning of its fingerprints changes
+PERSISTENT_CACHE_SHARD_BYTES = 256 * 2**20
+SHARD_EXT = '.bin'
+INDEX_EXT = '.index'
+
+
+def _hash_key(key: CacheKey) -> int:
+    """Stable non-zero 64 bit hash of a cache key, the same in every process"""
+    digest = hashlib.blake2b(f'{key[0]}\0{key[1]}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True) or 1
+
+
+class _SharedCacheGroup:
+    """
+    Fixed size slots for the tensors of one TensorMap, an open addressing hash table from key hash to slot,
+    and the last time each slot was used, all in one block of shared memory.
+    When every slot is full, a clock hand sweeps the slots EVICTION_SAMPLES at a time,
+    and the least recently used of those is evicted, approximating LRU without scanning every slot.
+    """
+
+    def __init__(self, shape: Tuple[int, ...], num_slots: int):
+        self.shape = shape
+        self.num_slots = num_slots
+        self.table_size = 1 << int(np.ceil(np.log2(max(2 * num_slots, 2))))
+        self.mask = self.table_size - 1
+        slot_bytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        size = 8 * (NUM_COUNTERS + 2 * self.table_size + 2 * num_slots) + slot_bytes * num_slots
+        self.shm = SharedMemory(create=True, size=size)
+        self.lock = Lock()
+        self._make_views()
+        self.counters[:] = 0
+        self.table_keys[:] = EMPTY_KEY
+        self.slot_keys[:] = EMPTY_KEY
+
+    def _make_views(self):
+        offset = 0
+
+        def _view(shape, dtype):
+            nonlocal offset
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            offset += array.nbytes
+            return array
+        self.counters = _view((NUM_COUNTERS,), np.int64)
+        self.table_keys = _view((self.table_size,), np.int64)
+        self.table_slots = _view((self.table_size,), np.int64)
+        self.slot_keys = _view((self.num_slots,), np.int64)
+        self.last_used = _view((self.num_slots,), np.int64)
+        self.data = _view((self.num_slots,) + self.shape, np.float32)
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if not isinstance(v, np.ndarray)}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_views()
+
+    def _find(self, key_hash: int) -> int:
+        """Index of key_hash in the hash table or -1, must hold the lock"""
+        i = key_hash & self.mask
+        while self.table_keys[i] != EMPTY_KEY:
+            if self.table_keys[i] == key_hash:
+                return i
+            i = (i + 1) & self.mask
+        return -1
+
+    def _remove(self, key_hash: int):
+        """Backward shift deletion keeps linear probing chains intact without tombstones, must hold the lock"""
+        i = self._find(key_hash)
+        if i == -1:
+            return
+        self.table_keys[i] = EMPTY_KEY
+        j = i
+        while True:
+            j = (j + 1) & self.mask
+            if self.table_keys[j] == EMPTY_KEY:
+                return
+            home = int(self.table_keys[j]) & self.mask
+            if (i < j and i < home <= j) or (i > j and (home > i or home <= j)):
+                continue  # entry at j is still reachable from its home
+            self.table_keys[i], self.table_slots[i] = self.table_keys[j], self.table_slots[j]
+            self.table_keys[j] = EMPTY_KEY
+            i = j
+
+    def _touch(self, slot: int):
+        self.counters[CLOCK] += 1
+        self.last_used[slot] = self.counters[CLOCK]
+
+    def _evictee(self) -> int:
+        """The least recently used of the next EVICTION_SAMPLES slots from the clock hand, must hold the lock"""
+        samples = min(EVICTION_SAMPLES, self.num_slots)
+        candidates = (self.counters[HAND] + np.arange(samples)) % self.num_slots
+        self.counters[HAND] = (self.counters[HAND] + samples) % self.num_slots
+        return int(candidates[np.argmin(self.last_used[candidates])])
+
+    def get(self, key_hash: int) -> Optional[np.ndarray]:
+        with self.lock:
+            i = self._find(key_hash)
+            if i == -1:
+                self.counters[MISSES] += 1
+                return None
+            slot = self.table_slots[i]
+            self._touch(slot)
+            self.counters[HITS] += 1
+            return self.data[slot].copy()
+
+    def contains(self, key_hash: int) -> bool:
+        with self.lock:
+            return self._find(key_hash) != -1
+
+    def put(self, key_hash: int, value: np.ndarray):
+        with self.lock:
+            i = self._find(key_hash)
+            if i != -1:
+                slot = self.table_slots[i]
+            else:
+                if self.counters[SLOTS_USED] < self.num_slots:
+                    slot = self.counters[SLOTS_USED]
+                    self.counters[SLOTS_USED] += 1
+                else:
+                    slot = self._evictee()
+                    self._remove(int(self.slot_keys[slot]))
+                    self.counters[EVICTIONS] += 1
+                i = key_hash & self.mask
+                while self.table_keys[i] != EMPTY_KEY:
+                    i = (i + 1) & self.mask
+                self.table_keys[i], self.table_slots[i] = key_hash, slot
+                self.slot_keys[slot] = key_hash
+            self.data[slot] = value
+            self._touch(slot)
+
+    def unlink(self):
+        self.counters = self.table_keys = self.table_slots = self.slot_keys = self.last_used = self.data = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedTensorMapCache:
+    """
+    Caches numpy arrays created by tensor maps in shared memory up to a maximum number of bytes shared by all workers.
+    Unlike TensorMapArrayCache, full caches evict their least recently used tensors.
+    Hits, misses and evictions are counted in shared memory so the totals are visible from any process.
+    """
+
+    def __init__(self, max_size: float, input_tms: List[TensorMap], output_tms: List[TensorMap], max_rows: Optional[int] = np.inf):
+        input_tms = [tm for tm in input_tms if tm.cacheable]
+        output_tms = [tm for tm in output_tms if tm.cacheable]
+        self.max_size = max_size
+        self.row_size = sum(np.zeros(tm.static_shape(), dtype=np.float32).nbytes for tm in set(input_tms + output_tms))
+        self.nrows = int(min(int(max_size / self.row_size), max_rows)) if self.row_size else 0
+        self.autoencode_names: Dict[str, str] = {}
+        self.groups: Dict[str, _SharedCacheGroup] = {}
+        if self.nrows > 0:
+            for tm in input_tms:
+                self.groups[tm.input_name()] = _SharedCacheGroup(tm.static_shape(), self.nrows)
+            for tm in output_tms:
+                if tm in input_tms:  # Useful for autoencoders
+                    self.autoencode_names[tm.output_name()] = tm.input_name()
+                else:
+                    self.groups[tm.output_name()] = _SharedCacheGroup(tm.static_shape(), self.nrows)
+        self.failed_paths: Set[str] = set()  # not shared, each worker only skips the paths it failed on
+
+    def _fix_key(self, key: CacheKey) -> Tuple[Optional[_SharedCacheGroup], int]:
+        file_path, name = key
+        name = self.autoencode_names.get(name, name)
+        return self.groups.get(name), _hash_key((file_path, name))
+
+    def get(self, key: CacheKey) -> Optional[np.ndarray]:
+        """The cached tensor or None, counts a hit or a miss"""
+        group, key_hash = self._fix_key(key)
+        if group is None:
+            return None
+        return group.get(key_hash)
+
+    def __setitem__(self, key: CacheKey, value: np.ndarray) -> bool:
+        """
+        :param key: should be a tuple file_path, name
+        """
+        group, key_hash = self._fix_key(key)
+        if group is None or np.shape(value) != group.shape:
+            return False
+        group.put(key_hash, value)
+        return True
+
+    def __getitem__(self, key: CacheKey) -> np.ndarray:
+        value = self.get(key)
+        if value is None:
+            raise KeyError(f'{key} is not in the cache.')
+        return value
+
+    def __contains__(self, key: CacheKey) -> bool:
+        group, key_hash = self._fix_key(key)
+        return group is not None and group.contains(key_hash)
+
+    def __len__(self):
+        return int(sum(group.counters[SLOTS_USED] for group in self.groups.values()))
+
+    def stats(self) -> Counter:
+        """Hits, misses and evictions summed over all workers since the cache was made"""
+        stats = Counter()
+        for group in self.groups.values():
+            for index, name in COUNTER_NAMES.items():
+                stats[name] += int(group.counters[index])
+        return stats
+
+    def average_fill(self):
+        return len(self) / (self.nrows * len(self.groups)) if self.groups else 0
+
+    def unlink(self):
+        for group in self.groups.values():
+            group.unlink()
+        self.groups = {}
+
+    def __str__(self):
+        stats = self.stats()
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        hit_rate = stats['cache_hits'] / lookups if lookups else 0
+        return (
+            f"The shared cache has had {stats['cache_hits']} hits, {stats['cache_misses']} misses ({hit_rate:.1%} hit rate) "
+            f"and {stats['cache_evictions']} evictions. It is {self.average_fill():.1%} full with {self.nrows} rows of {self.row_size / 1e6:.2f}MB."
+        )
+
+
+FINGERPRINT_DEPTH = 4  # nested functions and containers followed when fingerprinting a tensor_from_file
+
+
+def _code_fingerprint(code: types.CodeType) -> str:
+    """The bytecode, names and constants of a function, constants that are code of nested functions included"""
+    consts = [
+        _code_fingerprint(const) if isinstance(const, types.CodeType)
+        else repr(sorted(map(repr, const))) if isinstance(const, frozenset)  # string hashes, so set order, change across runs
+        else repr(const)
+        for const in code.co_consts
+    ]
+    return hashlib.blake2b(repr((code.co_code, code.co_names, consts)).encode(), digest_size=8).hexdigest()
+
+
+def _cell_contents(cell, function: types.FunctionType):
+    try:
+        contents = cell.cell_contents
+    except ValueError:  # a variable the function captured before it was assigned
+        return None
+    return 'self' if contents is function else contents
+
+
+def _value_fingerprint(value, depth: int = 0) -> str:
+    """
+    A description of a value that is the same across processes and runs.
+    Functions are described by their name, code, defaults and the values their closures captured,
+    so TensorMaps made by the same factory with different parameters, or from edited code, differ.
+    Objects without a stable repr are described by their type.
+    """
+    if depth > FINGERPRINT_DEPTH:
+        return '...'
+    if isinstance(value, functools.partial):
+        return f'partial({_value_fingerprint((value.func, value.args, value.keywords), depth + 1)})'
+    if isinstance(value, types.MethodType):
+        return f'{type(value.__self__).__qualname__}.{_value_fingerprint(value.__func__, depth + 1)}'
+    if isinstance(value, types.FunctionType):
+        cells = [_cell_contents(cell, value) for cell in value.__closure__ or ()]
+        captured = _value_fingerprint((value.__defaults__, value.__kwdefaults__, cells), depth + 1)
+        return f'{value.__module__}.{value.__qualname__}:{_code_fingerprint(value.__code__)}:{captured}'
+    if isinstance(value, np.ndarray):
+        return f'array({value.dtype}, {value.shape}, {hashlib.blake2b(value.tobytes(), digest_size=8).hexdigest()})'
+    if isinstance(value, (list, tuple)):
+        return repr([_value_fingerprint(item, depth + 1) for item in value])
+    if isinstance(value, dict):
+        return repr(sorted((repr(key), _value_fingerprint(item, depth + 1)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return repr(sorted(_value_fingerprint(item, depth + 1) for item in value))
+    description = repr(value)
+    return type(value).__qualname__ if ' at 0x' in description else description
+
+
+def tensor_map_fingerprint(tm: TensorMap) -> str:
+    """
+    Stable hash of everything in a TensorMap's definition that changes the tensors it makes, apart from augmentations.
+    Whether the TensorMap has augmentations is included, because then the cache stores tensors from before augmentation.
+    """
+    normalization = None
+    if tm.normalization is not None:
+        normalization = type(tm.normalization).__name__, sorted((k, repr(v)) for k, v in vars(tm.normalization).items())
+    tensor_from_file = _value_fingerprint(tm.tensor_from_file)
+    description = repr((
+        PERSISTENT_CACHE_VERSION, tm.name, tm.shape, str(tm.interpretation),
+        sorted((tm.channel_map or {}).items()), normalization, tm.path_prefix, tm.storage_type,
+        tm.discretization_bounds, tm.time_series_limit, tm.time_series_order, tm.days_window,
+        tensor_from_file, tm.augmentations is not None,
+    ))
+    return hashlib.blake2b(description.encode(), digest_size=8).hexdigest()
+
+
+def _sample_key(path: str) -> str:
+    """Key of a sample file that changes whenever the file is rewritten"""
+    return hashlib.blake2b(f'{os.path.abspath(path)}\0{sample_version(path)}'.encode(), digest_size=12).hexdigest()
+
+
+class _ShardWriter:
+    """Appends raw tensors to the shards of one TensorMap directory owned by a single process"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.name = f'{uuid.uuid4().hex}_{os.getpid()}'
+        self.shard_count = 0
+        self.shard, self.index = None, None
+        self.offset = 0
+        self._next_shard()
+
+    def _next_shard(self):
+        self.close()
+        shard_name = f'{self.name}_{self.shard_count}'
+        self.shard_count += 1
+        self.shard = open(os.path.join(self.directory, shard_name + SHARD_EXT), 'ab')
+        self.index = open(os.path.join(self.directory, shard_name + INDEX_EXT), 'a')
+        self.offset = 0
+
+    def write(self, key: str, tensor: np.ndarray) -> Tuple[str, int]:
+        if self.offset > 0 and self.offset + tensor.nbytes > PERSISTENT_CACHE_SHARD_BYTES:
+            self._next_shard()
+        offset = self.offset
+        self.shard.write(np.ascontiguousarray(tensor).tobytes())
+        self.shard.flush()  # data goes to disk before the index line that points at it
+        shape = ','.join(map(str, tensor.shape))
+        self.index.write(f'{key}\t{offset}\t{shape}\t{tensor.dtype.str}\n')
+        self.index.flush()
+        self.offset += tensor.nbytes
+        return self.shard.name, offset
+
+    def close(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.index.close()
+
+
+class PersistentTensorCache:
+    """
+    Stores tensors made by cacheable TensorMaps in memory mapped shards on disk so later epochs and experiments skip
+    reading and postprocessing them. There is one directory per TensorMap fingerprint,
+    so changing a TensorMap's definition starts a new cache instead of reading stale tensors.
+    Samples are keyed by path, modification time and size, so rewritten hd5s miss.
+
+    TensorMaps without augmentations are stored fully postprocessed.
+    TensorMaps with augmentations are stored after validation, and augmentation, normalization and discretization run live.
+
+    Each process appends to its own shards and index files, so no locking is needed.
+    Indices are read when the cache is made, so tensors written by other processes are seen on the next run.
+    """
+
+    def __init__(self, cache_dir: str, tensor_maps: List[TensorMap]):
+        self.cache_dir = cache_dir
+        self.directories: Dict[str, str] = {}
+        self.index: Dict[str, Dict[str, Tuple[str, int, Tuple[int, ...], str]]] = {}
+        for tm in tensor_maps:
+            if not tm.cacheable or tm.dependent_map is not None or tm.name in self.directories:
+                continue  # dependent TensorMaps are filled in by tensor_from_file, which cache hits skip
+            directory = os.path.join(cache_dir, f'{tm.name}_{tensor_map_fingerprint(tm)}')
+            os.makedirs(directory, exist_ok=True)
+            self.directories[tm.name] = directory
+            self.index[tm.name] = self._read_index(directory)
+        self.stats = Counter()
+        self._writers: Dict[str, _ShardWriter] = {}
+        self._writer_pid = None
+        self._maps: Dict[str, np.memmap] = {}
+        logging.info(f'Persistent tensor cache at {cache_dir} has {sum(map(len, self.index.values()))} tensors for {len(self.index)} TensorMaps.')
+
+    @staticmethod
+    def _read_index(directory: str) -> Dict[str, Tuple[str, int, Tuple[int, ...], str]]:
+        index = {}
+        for index_path in glob.glob(os.path.join(directory, f'*{INDEX_EXT}')):
+            shard_path = index_path[:-len(INDEX_EXT)] + SHARD_EXT
+            with open(index_path) as index_file:
+                for line in index_file:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) != 4:  # a writer was stopped part way through a line
+                        continue
+                    key, offset, shape, dtype = fields
+                    shape = tuple(int(size) for size in shape.split(',') if size)
+                    index[key] = shard_path, int(offset), shape, dtype
+        return index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_writers'], state['_maps'], state['_writer_pid'] = {}, {}, None
+        return state
+
+    def _read(self, name: str, key: str) -> Optional[np.ndarray]:
+        entry = self.index[name].get(key)
+        if entry is None:
+            return None
+        shard_path, offset, shape, dtype = entry
+        dtype = np.dtype(dtype)
+        end = offset + int(np.prod(shape)) * dtype.itemsize
+        shard = self._maps.get(shard_path)
+        if shard is None or len(shard) < end:  # shards this process is writing grow after they are mapped
+            shard = self._maps[shard_path] = np.memmap(shard_path, dtype=np.uint8, mode='r')
+        return np.array(shard[offset:end].view(dtype).reshape(shape))
+
+    def _write(self, name: str, key: str, tensor: np.ndarray):
+        if self._writer_pid != os.getpid():  # forked workers must not append to their parent's shards
+            self._writers, self._writer_pid = {}, os.getpid()
+        try:
+            if name not in self._writers:
+                self._writers[name] = _ShardWriter(self.directories[name])
+            shard_path, offset = self._writers[name].write(key, tensor)
+        except OSError as e:
+            logging.warning(f'Could not write {name} to the persistent tensor cache, it will not be cached: {e}')
+            self.directories.pop(name)
+            return
+        self.index[name][key] = shard_path, offset, tensor.shape, tensor.dtype.str
+        self.stats['persistent_cache_writes'] += 1
+
+    def tensor(
+        self, tm: TensorMap, path: str, augment: bool, get_hd5: Callable[[], h5py.File], dependents: Dict,
+    ) -> np.ndarray:
+        """
+        The tensor tm makes from the sample at path, read from the cache or computed and cached.
+        Equivalent to tm.postprocess_tensor(tm.tensor_from_file(tm, hd5, dependents), augment, hd5)
+
+        :param get_hd5: called to open the hd5 only when the tensor is not in the cache
+        """
+        if tm.name not in self.directories:
+            hd5 = get_hd5()
+            return tm.postprocess_tensor(tm.tensor_from_file(tm, hd5, dependents), augment=augment, hd5=hd5)
+        key = _sample_key(path)
+        tensor = self._read(tm.name, key)
+        if tensor is not None:
+            self.stats['persistent_cache_hits'] += 1
+        else:
+            self.stats['persistent_cache_misses'] += 1
+            hd5 = get_hd5()
+            tensor = tm.tensor_from_file(tm, hd5, dependents)
+            if tm.augmentations is None:
+                tensor = tm.postprocess_tensor(tensor, augment=False, hd5=hd5)
+                self._write(tm.name, key, np.asarray(tensor))
+                return tensor
+            tm.validator(tm, tensor, hd5)
+            self._write(tm.name, key, np.asarray(tensor))
+        if tm.augmentations is None:
+            return tensor
+        return tm.discretize(tm.normalize(tm.apply_augmentations(tensor, augment)))
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.close()
+        self._writers = {}
@@ -14,20 +14,31 @@ import os
 import csv
 import math
 import h5py
+import queue
 import time
 import logging
 import traceback
 import numpy as np
 import pandas as pd
-from collections import Counter
-from multiprocessing import Process, Queue
+from collections import Counter, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import Process, Queue, SimpleQueue
+from multiprocessing.shared_memory import SharedMemory
 from itertools import chain
 from typing import List, Dict, Tuple, Set, Optional, Iterator, Callable, Any, Union, Type
 
 import tensorflow as tf
 from ml4h.defines import TENSOR_EXT, TensorGeneratorABC
 from ml4h.ml4ht_integration.tensor_generator import TensorMapDataLoader
+from ml4h.tf_dataset import TensorMapTfDataset
 from ml4h.TensorMap import TensorMap
+from ml4h.tensor_cache import SharedTensorMapCache, PersistentTensorCache
+from ml4h.hd5_read_plan import Hd5ReadPlan
+from ml4h.packed_hd5 import open_hd5, open_hd5_bytes, read_hd5_bytes, tensor_paths
+from ml4h.sample_index import SampleIndex, build_sample_index
+from ml4h.generator_stats import EpochStats, EpochStatsAggregator, TENSOR_MAP_ERROR_PREFIX
+from ml4h.tensor_map_profiler import TensorMapProfiler, PROFILE_EXT
+from ml4h.batch_functions import Path, Batch, BatchFunction, _identity_batch, pick_batch_function
 
 np.set_printoptions(threshold=np.inf)
 
@@ -36,15 +47,17 @@ DEFAULT_VALID_RATIO = 0.2
 DEFAULT_TEST_RATIO = 0.1
 
 TENSOR_GENERATOR_TIMEOUT = 64
+TENSOR_GENERATOR_POLL = 1  # seconds between checks that workers are alive while waiting on a SimpleQueue
 TENSOR_GENERATOR_MAX_Q_SIZE = 32
+SHARED_MEMORY_SLOTS_PER_WORKER = 2
+BUFFER_POOL_BUFFERS_PER_WORKER = 2
+READ_AHEAD_THREADS = 4
+SHARED_MEMORY_ALIGNMENT = 64
 
 # TensorGenerator batch indices
 BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX, BATCH_PATHS_INDEX = 0, 1, 2
 
-Path = str
 PathIterator = Iterator[Path]
-Batch = Dict[Path, np.ndarray]
-BatchFunction = Callable[[Batch, Batch, bool, List[Path], 'kwargs'], Any]
 
 
 class _ShufflePaths(Iterator):
@@ -75,7 +88,67 @@ class _WeightedPaths(Iterator):
         return np.random.choice(np.random.choice(self.paths, self.weights))
 
 
-def pick_generator(paths, weights, mixup, siamese) -> Type[TensorGeneratorABC]:
+class _ReadAheadPaths(Iterator):
+    """
+    Yields the paths of a path iterator while threads read the files of the next paths into memory.
+    At most depth files are read ahead, so memory is bounded by depth times the largest file.
+    File reads release the GIL, so they overlap with postprocessing the current sample.
+    """
+
+    def __init__(self, paths: PathIterator, depth: int, needs_read: Callable[[Path], bool]):
+        self.paths = paths
+        self.depth = depth
+        self.needs_read = needs_read
+        self.pool = ThreadPoolExecutor(min(depth, READ_AHEAD_THREADS))
+        self.pending = deque()
+        self.current: Optional[Future] = None
+
+    def _read(self, path: Path) -> Optional[Future]:
+        return self.pool.submit(read_hd5_bytes, path) if self.needs_read(path) else None
+
+    def __next__(self) -> Path:
+        while len(self.pending) <= self.depth:
+            path = next(self.paths)
+            self.pending.append((path, self._read(path)))
+        path, self.current = self.pending.popleft()
+        return path
+
+    def take(self) -> Optional[bytes]:
+        """The bytes of the current path's file, if they were read ahead. Raises the read's error if it failed."""
+        future, self.current = self.current, None
+        return None if future is None else future.result()
+
+    def cancel(self, keep_paths: bool = False):
+        """
+        Cancel pending reads that have not started.
+        Their paths are dropped, for when the paths change, unless keep_paths, when they are read again if they still need reading.
+        """
+        pending, self.pending = self.pending, deque()
+        for path, future in pending:
+            cancelled = future is None or future.cancel()
+            if keep_paths:
+                self.pending.append((path, self._read(path) if cancelled else future))
+        self.current = None
+
+    def shutdown(self):
+        self.cancel()
+        self.pool.shutdown(wait=False)
+
+
+def pick_generator(paths, weights, mixup, siamese, tf_data: bool = False, legacy_options: Optional[List[str]] = None) -> Type[TensorGeneratorABC]:
+    """
+    :param legacy_options: names of the options that are set and only the legacy TensorGenerator implements,
+                           if there are any the legacy TensorGenerator is used so they are not silently ignored
+    """
+    if legacy_options:
+        logging.info(f"Using legacy TensorGenerator because only it implements {', '.join(legacy_options)}.")
+        return TensorGenerator
+    if tf_data:
+        try:
+            TensorMapTfDataset.can_apply(paths, weights, mixup, siamese)
+            return TensorMapTfDataset
+        except NotImplementedError as e:
+            logging.warning(f"Could not use tf.data pipeline because: {repr(e)}.")
     try:
         TensorMapDataLoader.can_apply(paths, weights, mixup, siamese)
         return TensorMapDataLoader
@@ -89,12 +162,39 @@ class TensorGenerator(TensorGeneratorABC):
         self, batch_size: int, input_maps: List[TensorMap], output_maps: List[TensorMap],
         paths: Union[List[str], List[List[str]]], num_workers: int, cache_size: float, weights: List[float] = None,
         keep_paths: bool = False, mixup_alpha: float = 0.0, name: str = 'worker', siamese: bool = False,
-        augment: bool = False,
+        augment: bool = False, shared_memory_transport: bool = False, buffer_pool: bool = False, shared_cache: bool = False,
+        tensor_cache_dir: Optional[str] = None, fused_hd5_reads: bool = False, read_ahead: int = 0,
+        metrics_path: Optional[str] = None, profile_path: Optional[str] = None,
     ):
         """
         :param paths: If weights is provided, paths should be a list of path lists the same length as weights
+        :param cache_size: size in bytes of maximum cache for EACH worker
+        :param shared_memory_transport: If True, workers write batches into a ring of shared memory slabs
+                                        and only slot indices are sent through the queue instead of pickled arrays
+        :param buffer_pool: If True, each worker allocates its batch arrays once and reuses them
+        :param shared_cache: If True, workers share one least recently used cache of cache_size * num_workers bytes in shared memory
+                             instead of each filling its own cache once
+        :param tensor_cache_dir: If set, postprocessed tensors of cacheable TensorMaps are kept in a persistent cache in this directory
+        :param fused_hd5_reads: If True, each worker memoizes hd5 lookups across all TensorMaps of a sample
+                                and prefetches the datasets they read in one pass
+        :param read_ahead: If positive, each worker reads the files of this many upcoming samples into memory in background threads
+        :param metrics_path: If set, per worker and per TensorMap metrics of every epoch are appended to this file as JSON lines
+        :param profile_path: If set, workers histogram the time, output, allocated and read bytes of every TensorMap stage,
+                             and each epoch's summary table is logged and appended to this tsv
         """
         self.augment = augment
+        self.shared_memory_transport = shared_memory_transport
+        self.buffer_pool = buffer_pool
+        self.batch_ring = None
+        self.use_shared_cache = shared_cache
+        self.shared_cache = None
+        self.tensor_cache_dir = tensor_cache_dir
+        self.fused_hd5_reads = fused_hd5_reads
+        self.read_ahead = read_ahead
+        self.metrics_path = metrics_path
+        self.profile_path = profile_path
+        self.stats_aggregator = None
+        self.epoch_metrics = []
         self.paths = sum(paths) if isinstance(paths[0], list) else paths
         self.run_on_main_thread = num_workers == 0
         self.q = None
@@ -121,20 +221,30 @@ class TensorGenerator(TensorGeneratorABC):
             self.true_epoch_lens = [max(map(len, p)) for p in worker_paths]
             self.path_iters = [_WeightedPaths(p, weights) for p in worker_paths]
 
-        self.batch_function_kwargs = {}
-        if mixup_alpha > 0:
-            self.batch_function = _mixup_batch
-            self.batch_size *= 2
-            self.batch_function_kwargs = {'alpha': mixup_alpha}
-        elif siamese:
-            self.batch_function = _make_batch_siamese
-        else:
-            self.batch_function = _identity_batch
+        self.batch_function, self.batch_function_kwargs, samples_per_row = pick_batch_function(mixup_alpha, siamese)
+        self.batch_size *= samples_per_row
 
     def _init_workers(self):
-        self.q = Queue(min(self.batch_size, TENSOR_GENERATOR_MAX_Q_SIZE))
-        self.stats_q = Queue(len(self.worker_instances))
+        self.stats_q = Queue()
+        self.stats_aggregator = EpochStatsAggregator(self.num_workers, self.metrics_path)
         self._started = True
+        if self.shared_memory_transport and not self.run_on_main_thread:
+            self.batch_ring = _SharedMemoryBatchRing(
+                self._batch_shapes(), num_slots=SHARED_MEMORY_SLOTS_PER_WORKER * self.num_workers,
+            )
+        if self.buffer_pool and self.batch_ring is None:
+            # Queue pickles in a feeder thread, so a reused buffer could be overwritten before it is sent.
+            # SimpleQueue pickles during put, so a worker's buffer is free to reuse as soon as put returns.
+            self.q = SimpleQueue()
+        else:
+            self.q = Queue(min(self.batch_size, TENSOR_GENERATOR_MAX_Q_SIZE))
+        if self.use_shared_cache and self.cache_size > 0:
+            self.shared_cache = SharedTensorMapCache(
+                self.cache_size * self.num_workers, self.input_maps, self.output_maps, max_rows=sum(self.true_epoch_lens),
+            )
+        persistent_cache = None
+        if self.tensor_cache_dir is not None:
+            persistent_cache = PersistentTensorCache(self.tensor_cache_dir, self.input_maps + self.output_maps)
         for i, (path_iter, iter_len) in enumerate(zip(self.path_iters, self.true_epoch_lens)):
             name = f'{self.name}_{i}'
             worker_instance = _MultiModalMultiTaskWorker(
@@ -147,6 +257,13 @@ class TensorGenerator(TensorGeneratorABC):
                 self.cache_size,
                 name,
                 self.augment,
+                self.batch_ring,
+                self.buffer_pool,
+                self.shared_cache,
+                persistent_cache,
+                self.fused_hd5_reads,
+                self.read_ahead,
+                self.profile_path is not None,
             )
             self.worker_instances.append(worker_instance)
             if not self.run_on_main_thread:
@@ -157,6 +274,24 @@ class TensorGenerator(TensorGeneratorABC):
                 process.start()
                 self.workers.append(process)
         logging.info(f"Started {i + 1} {self.name.replace('_', ' ')}s with cache size {self.cache_size/1e9}GB.")
+        if self.batch_ring is not None:
+            logging.info(f'{self.name} is using {self.batch_ring}')
+        if self.shared_cache is not None:
+            logging.info(f'{self.name} workers share a cache of {self.shared_cache.nrows} rows of {self.shared_cache.row_size / 1e6:.2f}MB.')
+        if self.buffer_pool:
+            logging.info(f'{self.name} workers each reuse a {self.worker_instances[0].buffer_pool.nbytes() / 1e6:.1f}MB pool of batch buffers.')
+
+    def _batch_shapes(self) -> Tuple[Dict[str, Tuple[Tuple[int, ...], np.dtype]], Dict[str, Tuple[Tuple[int, ...], np.dtype]]]:
+        """Run the batch function on an empty batch to find the names, shapes and dtypes of the batches it yields"""
+        in_batch = _zero_batch(self.batch_size, self.input_maps, True)
+        out_batch = _zero_batch(self.batch_size, self.output_maps, False)
+        random_state = np.random.get_state()  # mixup and siamese batch functions draw random numbers
+        out = self.batch_function(in_batch, out_batch, False, [], **self.batch_function_kwargs)
+        np.random.set_state(random_state)
+        return (
+            {k: (v.shape, v.dtype) for k, v in out[BATCH_INPUT_INDEX].items()},
+            {k: (v.shape, v.dtype) for k, v in out[BATCH_OUTPUT_INDEX].items()},
+        )
 
     def set_worker_paths(self, paths: List[Path]):
         """In the single worker case, set the worker's paths."""
@@ -164,34 +299,50 @@ class TensorGenerator(TensorGeneratorABC):
             self._init_workers()
         if not self.run_on_main_thread:
             raise ValueError('Cannot sort paths of multiprocessing workers. num_workers must be 0.')
-        self.worker_instances[0].path_iter.paths = paths
+        self.worker_instances[0].set_paths(paths)
 
     def __next__(self) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], Optional[List[str]]]:
         if not self._started:
             self._init_workers()
-        if self.stats_q.qsize() == self.num_workers:
-            self.aggregate_and_print_stats()
+        self.aggregate_and_print_stats()
         if self.run_on_main_thread:
             return next(self.worker_instances[0])
+        elif self.batch_ring is not None:
+            return self.batch_ring.read(self.q.get(TENSOR_GENERATOR_TIMEOUT))
+        elif self.buffer_pool:
+            return self._get_from_simple_queue()
         else:
             return self.q.get(TENSOR_GENERATOR_TIMEOUT)
 
+    def _get_from_simple_queue(self):
+        """SimpleQueue.get has no timeout, so wait on its pipe and give up like Queue.get would, or as soon as every worker has died"""
+        waited = 0
+        while not self.q._reader.poll(TENSOR_GENERATOR_POLL):
+            waited += TENSOR_GENERATOR_POLL
+            dead = [worker.name for worker in self.workers if not worker.is_alive()]
+            if len(dead) == len(self.workers) or waited >= TENSOR_GENERATOR_TIMEOUT:
+                raise queue.Empty(f'{self.name} got no batch for {waited}s, dead workers: {dead}')
+        return self.q.get()
+
     def aggregate_and_print_stats(self):
-        stats = Counter()
+        """Take the stats workers have sent without waiting, and print each epoch all the workers have finished"""
+        while True:
+            try:
+                worker, epoch, stats, tensor_map_stats, profile = self.stats_q.get_nowait()
+            except queue.Empty:
+                return
+            epoch_stats = self.stats_aggregator.add(worker, epoch, stats, tensor_map_stats, profile)
+            if epoch_stats is not None:
+                self._print_epoch_stats(epoch_stats)
+
+    def _print_epoch_stats(self, epoch_stats: EpochStats):
+        stats = epoch_stats.merged
         self.true_epochs += 1
-        cur_worker = 0
-        while self.stats_q.qsize() != 0:
-            cur_worker += 1
-            worker_stats = self.stats_q.get().copy()
-            for k in worker_stats:
-                if stats[k] == 0 and cur_worker == 1 and ('_max' in k or '_min' in k):
-                    stats[k] = worker_stats[k]
-                elif '_max' in k:
-                    stats[k] = max(stats[k], worker_stats[k])
-                elif '_min' in k:
-                    stats[k] = min(stats[k], worker_stats[k])
-                else:
-                    stats[k] += worker_stats[k]
+        metrics = epoch_stats.metrics(self.name)
+        self.epoch_metrics.append(metrics)
+        self.stats_aggregator.write(metrics)
+        if epoch_stats.profile is not None:
+            epoch_stats.profile.write(self.profile_path, self.true_epochs, f'{self.name} TensorMap profile')
 
         all_errors = [
             f'[{error}] - {count:.0f}'
@@ -202,6 +353,15 @@ class TensorGenerator(TensorGeneratorABC):
         else:
             error_info = 'No errors raised.'
 
+        lookups = stats['cache_hits'] + stats['cache_misses']
+        cache_info = f"{stats['cache_hits']:.0f} tensors were read from the cache and {stats['cache_misses']:.0f} were not"
+        cache_info = f"{cache_info} ({stats['cache_hits'] / lookups:.1%} hit rate)." if lookups else f'{cache_info}.'
+        if self.shared_cache is not None:
+            cache_info = f'{cache_info} {self.shared_cache}'
+        if self.tensor_cache_dir is not None:
+            cache_info = f"{cache_info} The persistent cache had {stats['persistent_cache_hits']:.0f} hits, " \
+                         f"{stats['persistent_cache_misses']:.0f} misses and wrote {stats['persistent_cache_writes']:.0f} tensors."
+
         eps = 1e-7
         for tm in self.input_maps + self.output_maps:
             if self.true_epochs != 1:
@@ -234,6 +394,7 @@ class TensorGenerator(TensorGeneratorABC):
             f"Generator looped & shuffled over {sum(self.true_epoch_lens)} paths. Epoch: {self.true_epochs:.0f}",
             f"{stats['Tensors presented']:0.0f} tensors were presented.",
             f"{stats['skipped_paths']} paths were skipped because they previously failed.",
+            f"{cache_info}",
             f"{error_info}",
             f"{self.stats_string}",
         ])
@@ -245,6 +406,16 @@ class TensorGenerator(TensorGeneratorABC):
                 worker.terminate()
             logging.info(f'Stopped {len(self.workers)} workers. {self.stats_string}')
         self.workers = []
+        for worker_instance in self.worker_instances:
+            if worker_instance.read_ahead_paths is not None:  # only started in this process when running on the main thread
+                worker_instance.read_ahead_paths.shutdown()
+                worker_instance.read_ahead_paths = None
+        if self.batch_ring is not None:
+            self.batch_ring.unlink()
+            self.batch_ring = None
+        if self.shared_cache is not None:
+            self.shared_cache.unlink()
+            self.shared_cache = None
 
     def __iter__(self):  # This is so python type annotations recognize TensorGenerator as an iterator
         return self
@@ -309,6 +480,9 @@ class TensorMapArrayCache:
     def __contains__(self, key: Tuple[str, str]):
         return self._fix_key(key) in self.key_to_index
 
+    def get(self, key: Tuple[str, str]) -> Optional[np.ndarray]:
+        return self[key] if key in self else None
+
     def __len__(self):
         return sum(self.files_seen.values())
 
@@ -321,6 +495,111 @@ class TensorMapArrayCache:
         return f'{hits} {fullness}.'
 
 
+class _SharedMemoryBatchRing:
+    """
+    A ring of shared memory slabs, each large enough to hold one batch.
+    Workers acquire a free slot, fill its arrays in place and send only the slot index and paths through the queue.
+    The TensorGenerator copies the batch out of the slot and returns the slot to the free list.
+    """
+
+    def __init__(
+        self, batch_shapes: Tuple[Dict[str, Tuple[Tuple[int, ...], np.dtype]], Dict[str, Tuple[Tuple[int, ...], np.dtype]]],
+        num_slots: int,
+    ):
+        self.num_slots = num_slots
+        self.layout = []  # (is_input, name, shape, dtype, offset into slab)
+        offset = 0
+        for batch_index in (BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX):
+            for name, (shape, dtype) in batch_shapes[batch_index].items():
+                dtype = np.dtype(dtype)
+                self.layout.append((batch_index == BATCH_INPUT_INDEX, name, tuple(shape), dtype, offset))
+                offset += int(np.prod(shape)) * dtype.itemsize
+                offset += -offset % SHARED_MEMORY_ALIGNMENT
+        self.slab_size = max(offset, 1)
+        self.slabs = [SharedMemory(create=True, size=self.slab_size) for _ in range(num_slots)]
+        self.free_slots = Queue(num_slots)
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+        self._views = {}
+
+    def views(self, slot: int) -> Tuple[Batch, Batch]:
+        """Numpy arrays backed by the shared memory of a slot"""
+        if slot not in self._views:
+            in_batch, out_batch = {}, {}
+            for is_input, name, shape, dtype, offset in self.layout:
+                batch = in_batch if is_input else out_batch
+                batch[name] = np.ndarray(shape, dtype=dtype, buffer=self.slabs[slot].buf, offset=offset)
+            self._views[slot] = in_batch, out_batch
+        return self._views[slot]
+
+    def acquire(self) -> int:
+        """Block until a slot is free and return its index"""
+        return self.free_slots.get()
+
+    def write(self, slot: int, batch: Tuple) -> Tuple[int, Optional[List[Path]]]:
+        """
+        Copy a batch into a slot, arrays that are already views of the slot are not copied.
+        :return: the message to put on the queue
+        """
+        for shared, arrays in zip(self.views(slot), batch[:BATCH_PATHS_INDEX]):
+            for name, array in arrays.items():
+                if shared[name] is not array:
+                    shared[name][:] = array
+        paths = batch[BATCH_PATHS_INDEX] if len(batch) > BATCH_PATHS_INDEX else None
+        return slot, paths
+
+    def read(self, message: Tuple[int, Optional[List[Path]]]) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray], Optional[List[str]]]:
+        """Copy a batch out of its slot and free the slot for the workers"""
+        slot, paths = message
+        in_batch, out_batch = self.views(slot)
+        in_batch = {name: array.copy() for name, array in in_batch.items()}
+        out_batch = {name: array.copy() for name, array in out_batch.items()}
+        self.free_slots.put(slot)
+        return (in_batch, out_batch) if paths is None else (in_batch, out_batch, paths)
+
+    def unlink(self):
+        self._views = {}
+        for slab in self.slabs:
+            slab.close()
+            slab.unlink()
+        self.slabs = []
+
+    def __str__(self):
+        return f'a shared memory ring of {self.num_slots} slots of {self.slab_size / 1e6:.1f}MB'
+
+
+class _BatchBufferPool:
+    """
+    Batch arrays allocated once per worker in each TensorMap's dtype.
+    Buffers are handed out in rotation, so a batch can still be in flight while the next one is filled.
+    """
+
+    def __init__(self, batch_size: int, input_maps: List[TensorMap], output_maps: List[TensorMap], num_buffers: int = BUFFER_POOL_BUFFERS_PER_WORKER):
+        self.batch_size = batch_size
+        self.input_maps = input_maps
+        self.output_maps = output_maps
+        self.num_buffers = num_buffers
+        self.buffers = []  # allocated on first use so they live in the worker process
+        self.idx = 0
+
+    def next_batch(self) -> Tuple[Batch, Batch]:
+        """The least recently used buffer, zeroed since tensors may not fill the whole static shape"""
+        if not self.buffers:
+            self.buffers = [
+                (_zero_batch(self.batch_size, self.input_maps, True), _zero_batch(self.batch_size, self.output_maps, False))
+                for _ in range(self.num_buffers)
+            ]
+        in_batch, out_batch = self.buffers[self.idx]
+        self.idx = (self.idx + 1) % self.num_buffers
+        for array in chain(in_batch.values(), out_batch.values()):
+            array.fill(0)
+        return in_batch, out_batch
+
+    def nbytes(self) -> int:
+        row_bytes = sum(np.prod(tm.static_shape()) * np.dtype(tm.dtype).itemsize for tm in self.input_maps + self.output_maps)
+        return int(row_bytes * self.batch_size * self.num_buffers)
+
+
 class _MultiModalMultiTaskWorker:
 
     def __init__(
@@ -334,6 +613,13 @@ class _MultiModalMultiTaskWorker:
         cache_size: float,
         name: str,
         augment: bool,
+        batch_ring: Optional[_SharedMemoryBatchRing] = None,
+        buffer_pool: bool = False,
+        shared_cache: Optional[SharedTensorMapCache] = None,
+        persistent_cache: Optional[PersistentTensorCache] = None,
+        fused_hd5_reads: bool = False,
+        read_ahead: int = 0,
+        profile: bool = False,
     ):
         self.q = q
         self.stats_q = stats_q
@@ -349,36 +635,89 @@ class _MultiModalMultiTaskWorker:
         self.cache_size = cache_size
         self.name = name
         self.augment = augment
+        self.batch_ring = batch_ring
+        self.slot = None
+        self.buffer_pool = _BatchBufferPool(batch_size, input_maps, output_maps) if buffer_pool else None
 
         self.stats = Counter()
         self.epoch_stats = Counter()
+        self.tensor_map_stats = Counter()  # keyed by (TensorMap name, metric)
+        self.current_tm = None
+        self.profiler = TensorMapProfiler() if profile else None
         self.start = time.time()
         self.paths_in_batch = []
 
-        self.in_batch = {tm.input_name(): np.zeros((batch_size,) + tm.static_shape()) for tm in input_maps}
-        self.out_batch = {tm.output_name(): np.zeros((batch_size,) + tm.static_shape()) for tm in output_maps}
+        self.in_batch, self.out_batch = None, None  # allocated by the process that fills them
 
-        self.cache = TensorMapArrayCache(cache_size, input_maps, output_maps, true_epoch_len)
+        if shared_cache is not None:
+            self.cache = shared_cache
+        else:
+            self.cache = TensorMapArrayCache(cache_size, input_maps, output_maps, true_epoch_len)
+        self.persistent_cache = persistent_cache
+        self.read_plan = Hd5ReadPlan() if fused_hd5_reads else None
+        self.read_ahead = read_ahead
+        self.read_ahead_paths = None  # threads are started by the process that reads
+        self.hd5 = None
         self.dependents = {}
         self.idx = 0
 
+    def _new_batch(self):
+        if self.batch_ring is not None and self.batch_function is _identity_batch:
+            # The batch is filled in place in shared memory. Slots are reused, so they must be zeroed.
+            self.slot = self.batch_ring.acquire()
+            self.in_batch, self.out_batch = self.batch_ring.views(self.slot)
+            for array in chain(self.in_batch.values(), self.out_batch.values()):
+                array.fill(0)
+        elif self.buffer_pool is not None:
+            self.in_batch, self.out_batch = self.buffer_pool.next_batch()
+        else:
+            self.in_batch = _zero_batch(self.batch_size, self.input_maps, True)
+            self.out_batch = _zero_batch(self.batch_size, self.output_maps, False)
+
+    def _put_batch(self, out: Tuple):
+        if self.batch_ring is None:
+            self.q.put(out)
+            return
+        slot = self.batch_ring.acquire() if self.slot is None else self.slot
+        self.q.put(self.batch_ring.write(slot, out))
+        self.slot = None
+
     def _handle_tm(self, tm: TensorMap, is_input: bool, path: Path) -> h5py.File:
         name = tm.input_name() if is_input else tm.output_name()
         batch = self.in_batch if is_input else self.out_batch
         idx = self.stats['batch_index']
 
+        self.current_tm = tm
+        self.tensor_map_stats[tm.name, 'tensors'] += 1
         if tm in self.dependents:
             batch[name][idx] = self.dependents[tm]
             if tm.cacheable:
                 self.cache[path, name] = self.dependents[tm]
             self._collect_stats(tm, self.dependents[tm])
             return self.hd5
-        if (path, name) in self.cache:
-            batch[name][idx] = self.cache[path, name]
+        cached = self.cache.get((path, name))
+        if cached is not None:
+            batch[name][idx] = cached
+            self.epoch_stats['cache_hits'] += 1
+            self.tensor_map_stats[tm.name, 'cache_hits'] += 1
             return self.hd5
-        if self.hd5 is None:  # Don't open hd5 if everything is in the self.cache
-            self.hd5 = h5py.File(path, 'r')
-        tensor = tm.postprocess_tensor(tm.tensor_from_file(tm, self.hd5, self.dependents), augment=self.augment, hd5=self.hd5)
+        if tm.cacheable and self.cache.nrows:
+            self.epoch_stats['cache_misses'] += 1
+            self.tensor_map_stats[tm.name, 'cache_misses'] += 1
+        start = time.perf_counter()
+        if self.persistent_cache is not None:
+            tensor = self._persistent_cache_tensor(tm, path)
+            read = time.perf_counter()  # the persistent cache reads and postprocesses in one call
+        else:
+            self._open_hd5(path)
+            if self.profiler is None:
+                raw = tm.tensor_from_file(tm, self.hd5, self.dependents)
+            else:
+                raw = self.profiler.read(tm, self.hd5, self.dependents)
+            read = time.perf_counter()
+            tensor = tm.postprocess_tensor(raw, augment=self.augment, hd5=self.hd5, profiler=self.profiler)
+        self.tensor_map_stats[tm.name, 'read_seconds'] += read - start
+        self.tensor_map_stats[tm.name, 'postprocess_seconds'] += time.perf_counter() - read
         slices = tuple(slice(min(tm.static_shape()[i], tensor.shape[i])) for i in range(len(tensor.shape)))
         batch[name][(idx,)+slices] = tensor[slices]
         if tm.cacheable:
@@ -386,6 +725,36 @@ class _MultiModalMultiTaskWorker:
         self._collect_stats(tm, tensor)
         return self.hd5
 
+    def _persistent_cache_tensor(self, tm: TensorMap, path: Path) -> np.ndarray:
+        def tensor(_):
+            return self.persistent_cache.tensor(tm, path, self.augment, lambda: self._open_hd5(path), self.dependents)
+        if self.profiler is None:
+            return tensor(None)
+        return self.profiler.run(tm.name, 'persistent_cache', tensor, None)
+
+    def _open_hd5(self, path: Path) -> h5py.File:
+        if self.hd5 is None:  # Don't open hd5 if everything is in the caches
+            data = self.read_ahead_paths.take() if self.read_ahead_paths is not None else None
+            hd5 = open_hd5(path) if data is None else open_hd5_bytes(data)
+            self.hd5 = hd5 if self.read_plan is None else self.read_plan.open(path, hd5)
+        return self.hd5
+
+    def _needs_read(self, path: Path) -> bool:
+        if path in self.cache.failed_paths:
+            return False
+        names = [tm.input_name() for tm in self.input_maps] + [tm.output_name() for tm in self.output_maps]
+        return not all((path, name) in self.cache for name in names)
+
+    def _paths(self) -> Iterator[Path]:
+        if self.read_ahead > 0 and self.read_ahead_paths is None:
+            self.read_ahead_paths = _ReadAheadPaths(self.path_iter, self.read_ahead, self._needs_read)
+        return self.path_iter if self.read_ahead_paths is None else self.read_ahead_paths
+
+    def set_paths(self, paths: List[Path]):
+        self.path_iter.paths = paths
+        if self.read_ahead_paths is not None:
+            self.read_ahead_paths.cancel()
+
     def _collect_stats(self, tm, tensor):
         if tm.is_time_to_event():
             self.epoch_stats[f'{tm.name}_events'] += tensor[0]
@@ -406,7 +775,6 @@ class _MultiModalMultiTaskWorker:
         self.epoch_stats[f'{tm.name}_sum_squared'] += rescaled * rescaled
 
     def _handle_tensor_path(self, path: Path) -> None:
-        hd5 = None
         if path in self.cache.failed_paths:
             self.epoch_stats['skipped_paths'] += 1
             return
@@ -414,9 +782,11 @@ class _MultiModalMultiTaskWorker:
             self.dependents = {}
             self.hd5 = None
             for tm in self.input_maps:
-                hd5 = self._handle_tm(tm, True, path)
+                self._handle_tm(tm, True, path)
             for tm in self.output_maps:
-                hd5 = self._handle_tm(tm, False, path)
+                self._handle_tm(tm, False, path)
+            if self.read_plan is not None and self.hd5 is not None:
+                self.read_plan.learn(self.hd5)
             self.paths_in_batch.append(path)
             self.stats['Tensors presented'] += 1
             self.epoch_stats['Tensors presented'] += 1
@@ -425,42 +795,55 @@ class _MultiModalMultiTaskWorker:
             error_name = type(e).__name__
             self.stats[f"{error_name} while attempting to generate tensor:\n{traceback.format_exc()}\n"] += 1
             self.epoch_stats[f"{error_name}: {e}"] += 1
+            self.tensor_map_stats[self.current_tm.name, f'{TENSOR_MAP_ERROR_PREFIX}{error_name}'] += 1
             self.cache.failed_paths.add(path)
             _log_first_error(self.stats, path)
         finally:
-            if hd5 is not None:
-                hd5.close()
+            if self.hd5 is not None:
+                self.hd5.close()
+                self.hd5 = None
+            if self.read_ahead_paths is not None:
+                self.read_ahead_paths.current = None  # the read ahead bytes are not needed if the caches had everything
 
     def _on_epoch_end(self):
+        if self.read_ahead_paths is not None:
+            self.read_ahead_paths.cancel(keep_paths=True)  # reads queued last epoch are checked against the caches it filled
         self.stats['epochs'] += 1
         self.epoch_stats['epochs'] = self.stats['epochs']
-        while self.stats_q.qsize() == self.num_workers:
-            continue
-        self.stats_q.put(self.epoch_stats)
+        if self.persistent_cache is not None:
+            self.epoch_stats.update(self.persistent_cache.stats)
+            self.persistent_cache.stats.clear()
+        self.epoch_stats['seconds'] = time.time() - self.start
+        self.stats_q.put((self.name, self.stats['epochs'], self.epoch_stats, self.tensor_map_stats, self.profiler))
         if self.stats['Tensors presented'] == 0:
             logging.error(f"Completed an epoch but did not find any tensors to yield")
         if 'test' in self.name:
             logging.warning(f'Test worker {self.name} completed a full epoch. Test results may be double counting samples.')
         self.start = time.time()
         self.epoch_stats = Counter()
+        self.tensor_map_stats = Counter()
+        if self.profiler is not None:
+            self.profiler = TensorMapProfiler()  # the queue may not have pickled the last one yet
 
     def multiprocessing_worker(self):
-        for i, path in enumerate(self.path_iter):
+        self._new_batch()
+        for i, path in enumerate(self._paths()):
             self._handle_tensor_path(path)
             if self.stats['batch_index'] == self.batch_size:
 
                 out = self.batch_function(self.in_batch, self.out_batch, self.return_paths, self.paths_in_batch, **self.batch_func_kwargs)
-                self.q.put(out)
+                self._put_batch(out)
                 self.paths_in_batch = []
                 self.stats['batch_index'] = 0
-                self.in_batch = {tm.input_name(): np.zeros((self.batch_size,) + tm.static_shape()) for tm in self.input_maps}
-                self.out_batch = {tm.output_name(): np.zeros((self.batch_size,) + tm.static_shape()) for tm in self.output_maps}
+                self._new_batch()
             if i > 0 and i % self.true_epoch_len == 0:
                 self._on_epoch_end()
 
     def __next__(self):
+        if self.in_batch is None or self.buffer_pool is not None:
+            self._new_batch()  # the pool rotates here so the batch returned last call is left intact
         while self.stats['batch_index'] < self.batch_size:
-            path = next(self.path_iter)
+            path = next(self._paths())
             self._handle_tensor_path(path)
             if self.idx > 0 and self.idx % self.true_epoch_len == 0:
                 self._on_epoch_end()
@@ -590,6 +973,8 @@ def get_train_valid_test_paths(
         train_csv: str,
         valid_csv: str,
         test_csv: str,
+        sample_index: str = None,
+        tensor_maps: List[TensorMap] = (),
 ) -> Tuple[List[str], List[str], List[str]]:
     """
     Return 3 disjoint lists of tensor paths.
@@ -598,7 +983,7 @@ def get_train_valid_test_paths(
     If no arguments are given, paths are split into train/valid/test in the ratio 0.7/0.2/0.1.
     Otherwise, at least 2 arguments are required to specify train/valid/test sets.
 
-    :param tensors: path to directory containing tensors
+    :param tensors: path to directory containing tensors, or to a packed dataset made by tensorize/pack_hd5s.py
     :param sample_csv: path to csv containing sample ids, only consider sample ids for splitting
                        into train/valid/test sets if they appear in sample_csv
     :param valid_ratio: rate of tensors in validation list, mutually exclusive with valid_csv
@@ -606,6 +991,10 @@ def get_train_valid_test_paths(
     :param train_csv: path to csv containing sample ids to reserve for training list
     :param valid_csv: path to csv containing sample ids to reserve for validation list, mutually exclusive with valid_ratio
     :param test_csv: path to csv containing sample ids to reserve for testing list, mutually exclusive with test_ratio
+    :param sample_index: path to a sample index parquet file, if given paths are read from it instead of listing tensors.
+                         The random split follows the order of the index and skips filtered samples,
+                         so the same random seed can put samples in different sets than listing tensors does.
+    :param tensor_maps: with sample_index, only keep samples that have the hd5 keys these TensorMaps require
 
     :return: tuple of 3 lists of hd5 tensor file paths
     """
@@ -643,26 +1032,31 @@ def get_train_valid_test_paths(
     if valid_set is not None and test_set is not None and not valid_set.isdisjoint(test_set):
         raise ValueError('validation and test samples overlap')
 
+    if sample_index is not None:
+        paths = SampleIndex.load(sample_index).paths(tensor_maps)
+    else:
+        paths = tensor_paths(tensors)
+
     # find tensors and split them among train/valid/test
-    for root, dirs, files in os.walk(tensors):
-        for name in files:
-            path = os.path.join(root, name)
-            split = os.path.splitext(name)
-            sample_id = split[0]
+    unassigned_paths = []
+    for path in paths:
+        sample_id = os.path.splitext(os.path.basename(path))[0]
 
-            if split[-1].lower() != TENSOR_EXT:
-                continue
-            elif sample_set is not None and sample_id not in sample_set:
-                continue
-            elif train_set is not None and sample_id in train_set:
-                train_paths.append(path)
-            elif valid_set is not None and sample_id in valid_set:
-                valid_paths.append(path)
-            elif test_set is not None and sample_id in test_set:
-                test_paths.append(path)
-            else:
-                choice = np.random.choice([k for k in choices], p=[choices[k][1] for k in choices])
-                choices[choice][0].append(path)
+        if sample_set is not None and sample_id not in sample_set:
+            continue
+        elif train_set is not None and sample_id in train_set:
+            train_paths.append(path)
+        elif valid_set is not None and sample_id in valid_set:
+            valid_paths.append(path)
+        elif test_set is not None and sample_id in test_set:
+            test_paths.append(path)
+        else:
+            unassigned_paths.append(path)
+    # One draw of size n takes the same uniform samples as n draws of one, so a --random_seed splits the same paths the same way.
+    # Paths from a sample index come in the index's order, less any samples it filters out, so they can split differently.
+    random_choices = np.random.choice([k for k in choices], size=len(unassigned_paths), p=[choices[k][1] for k in choices])
+    for path, choice in zip(unassigned_paths, random_choices):
+        choices[choice][0].append(path)
 
     logging.info(f'Found {len(train_paths)} train, {len(valid_paths)} validation, and {len(test_paths)} testing tensors at: {tensors}')
     logging.debug(f'Discarded {len(discard_paths)} tensors due to given ratios')
@@ -685,6 +1079,8 @@ def get_train_valid_test_paths_split_by_csvs(
         train_csv: str,
         valid_csv: str,
         test_csv: str,
+        sample_index: str = None,
+        tensor_maps: List[TensorMap] = (),
 ) -> Tuple[List[List[str]], List[List[str]], List[List[str]]]:
     stats = Counter()
     sample2group = {}
@@ -710,6 +1106,8 @@ def get_train_valid_test_paths_split_by_csvs(
         train_csv=train_csv,
         valid_csv=valid_csv,
         test_csv=test_csv,
+        sample_index=sample_index,
+        tensor_maps=tensor_maps,
     )
 
     for paths, split_list in [(_train, train_paths), (_valid, valid_paths), (_test, test_paths)]:
@@ -755,9 +1153,28 @@ def test_train_valid_tensor_generators(
     test_csv: str = None,
     siamese: bool = False,
     wrap_with_tf_dataset: bool = False,
+    shared_memory_transport: bool = False,
+    buffer_pool: bool = False,
+    shared_cache: bool = False,
+    tensor_cache_dir: Optional[str] = None,
+    fused_hd5_reads: bool = False,
+    read_ahead: int = 0,
+    generator_metrics: bool = False,
+    profile_tensor_maps: bool = False,
+    output_folder: str = None,
+    id: str = None,
+    sample_index: str = None,
+    update_sample_index: bool = False,
+    sampler: str = 'shuffle',
+    sampler_label: str = None,
+    random_seed: int = None,
+    tf_data: bool = False,
+    tf_data_cache: bool = False,
     **kwargs
 ) -> Tuple[TensorGeneratorABC, TensorGeneratorABC, TensorGeneratorABC]:
     """ Get 3 tensor generator functions for training, validation and testing data.
+    Only the legacy TensorGenerator implements shared_memory_transport, buffer_pool, fused_hd5_reads, read_ahead and generator_metrics,
+    so it is used whenever one of them is set.
 
     :param tensor_maps_in: list of TensorMaps that are input names to a model
     :param tensor_maps_out: list of TensorMaps that are output from a model
@@ -781,9 +1198,32 @@ def test_train_valid_tensor_generators(
     :param test_csv: CSV file of sample ids to use for testing, mutually exclusive with test_ratio
     :param siamese: if True generate input for a siamese model i.e. a left and right input tensors for every input TensorMap
     :param wrap_with_tf_dataset: if True will return tf.dataset objects for the 3 generators
+    :param shared_memory_transport: if True multiprocessing workers send batches through shared memory instead of pickling them
+    :param buffer_pool: if True workers reuse preallocated batch arrays
+    :param shared_cache: if True workers share one least recently used cache in shared memory instead of a cache per worker
+    :param tensor_cache_dir: if set, postprocessed tensors are kept in a persistent cache in this directory across epochs and runs
+    :param fused_hd5_reads: if True workers read each hd5 group and dataset once per sample, shared by all TensorMaps
+    :param read_ahead: if positive legacy workers read the files of this many upcoming samples in background threads
+    :param generator_metrics: if True the legacy generators append per worker and per TensorMap metrics of every epoch
+                              to <generator name>_metrics.jsonl in the run's output folder
+    :param profile_tensor_maps: if True legacy generators and data loaders histogram the time, output, allocated and read bytes of every
+                                TensorMap stage and write each epoch's summary to <generator name>*_tensor_map_profile.tsv
+                                in the run's output folder
+    :param output_folder: the output folder of the run, used for generator metrics and profiles
+    :param id: the id of the run, used for generator metrics and profiles
+    :param sample_index: path to a sample index parquet file used to find samples and skip those missing input or output TensorMaps
+    :param update_sample_index: if True rescan new and changed samples into the sample index, it is always built if missing
+    :param sampler: how the training data loader picks samples when not balancing csvs, 'shuffle', 'class_balanced' or 'stratified'
+    :param sampler_label: name of the output TensorMap the class_balanced and stratified samplers read labels from
+    :param random_seed: seeds the data loaders' epoch orders
+    :param tf_data: if True load batches with a native tf.data pipeline when it supports the other options
+    :param tf_data_cache: if True the training and validation tf.data pipelines keep the tensors they read in memory,
+                          training only when none of its TensorMaps have augmentations
     :return: A tuple of three generators. Each yields a Tuple of dictionaries of input and output numpy arrays for training, validation and testing.
     """
     generate_train, generate_valid, generate_test = None, None, None
+    if sample_index is not None and (update_sample_index or not os.path.exists(sample_index)):
+        build_sample_index(tensors, sample_index, max(num_workers, 1))
     if len(balance_csvs) > 0:
         train_paths, valid_paths, test_paths = get_train_valid_test_paths_split_by_csvs(
             tensors=tensors,
@@ -794,6 +1234,8 @@ def test_train_valid_tensor_generators(
             train_csv=train_csv,
             valid_csv=valid_csv,
             test_csv=test_csv,
+            sample_index=sample_index,
+            tensor_maps=tensor_maps_in + tensor_maps_out,
         )
         weights = [1.0/(len(balance_csvs)+1) for _ in range(len(balance_csvs)+1)]
     else:
@@ -805,30 +1247,62 @@ def test_train_valid_tensor_generators(
             train_csv=train_csv,
             valid_csv=valid_csv,
             test_csv=test_csv,
+            sample_index=sample_index,
+            tensor_maps=tensor_maps_in + tensor_maps_out,
         )
         weights = None
 
     num_train_workers = int(training_steps / (training_steps + validation_steps) * num_workers) or (1 if num_workers else 0)
     num_valid_workers = int(validation_steps / (training_steps + validation_steps) * num_workers) or (1 if num_workers else 0)
 
-    generator_class = pick_generator(train_paths, weights, mixup_alpha, siamese)
+    legacy_options = {
+        'shared_memory_transport': shared_memory_transport, 'buffer_pool': buffer_pool, 'fused_hd5_reads': fused_hd5_reads,
+        'read_ahead': read_ahead, 'generator_metrics': generator_metrics,
+    }
+    legacy_options = [option for option, value in legacy_options.items() if value]
+    generator_class = pick_generator(train_paths, weights, mixup_alpha, siamese, tf_data, legacy_options)
+    names = ('train_worker', 'validation_worker', 'test_worker')
+    sampler_kwargs = [{}, {}, {}]
+    if generator_class is not TensorGenerator:
+        sampler_kwargs = [{'seed': None if random_seed is None else random_seed + i} for i in range(3)]
+    elif generator_metrics:
+        sampler_kwargs = [{'metrics_path': os.path.join(output_folder, id, f'{name}_metrics.jsonl')} for name in names]
+    if profile_tensor_maps and generator_class is TensorGenerator:
+        for kwargs, name in zip(sampler_kwargs, names):
+            kwargs['profile_path'] = os.path.join(output_folder, id, f'{name}_tensor_map_profile{PROFILE_EXT}')
+    elif profile_tensor_maps and generator_class is TensorMapDataLoader:
+        for kwargs in sampler_kwargs:
+            kwargs['profile_dir'] = os.path.join(output_folder, id)
+    if generator_class is TensorMapDataLoader:
+        sampler_kwargs[0].update({'sampler': sampler, 'sampler_label': sampler_label})
+    if generator_class is TensorMapTfDataset:
+        for kwargs in sampler_kwargs[:2]:
+            kwargs['cache_tensors'] = tf_data_cache
 
     generate_train = generator_class(
         batch_size=batch_size, input_maps=tensor_maps_in, output_maps=tensor_maps_out,
         paths=train_paths, num_workers=num_train_workers, cache_size=cache_size, weights=weights,
         keep_paths=keep_paths, mixup_alpha=mixup_alpha, name='train_worker', siamese=siamese, augment=True,
+        shared_memory_transport=shared_memory_transport, buffer_pool=buffer_pool, shared_cache=shared_cache,
+        tensor_cache_dir=tensor_cache_dir, fused_hd5_reads=fused_hd5_reads, read_ahead=read_ahead, **sampler_kwargs[0],
     )
     generate_valid = generator_class(
         batch_size=batch_size, input_maps=tensor_maps_in, output_maps=tensor_maps_out,
         paths=valid_paths, num_workers=num_valid_workers, cache_size=cache_size, weights=weights,
         keep_paths=keep_paths, mixup_alpha=0, name='validation_worker', siamese=siamese, augment=False,
+        shared_memory_transport=shared_memory_transport, buffer_pool=buffer_pool, shared_cache=shared_cache,
+        tensor_cache_dir=tensor_cache_dir, fused_hd5_reads=fused_hd5_reads, read_ahead=read_ahead, **sampler_kwargs[1],
     )
     generate_test = generator_class(
         batch_size=batch_size, input_maps=tensor_maps_in, output_maps=tensor_maps_out + tensor_maps_protected,
         paths=test_paths, num_workers=num_train_workers, cache_size=0, weights=weights,
         keep_paths=keep_paths or keep_paths_test, mixup_alpha=0, name='test_worker', siamese=siamese, augment=False,
+        shared_memory_transport=shared_memory_transport, buffer_pool=buffer_pool, shared_cache=shared_cache,
+        tensor_cache_dir=tensor_cache_dir, fused_hd5_reads=fused_hd5_reads, read_ahead=read_ahead, **sampler_kwargs[2],
     )
-    if wrap_with_tf_dataset:
+    if wrap_with_tf_dataset and generator_class is TensorMapTfDataset:
+        return generate_train.dataset, generate_valid.dataset, generate_test.dataset
+    elif wrap_with_tf_dataset:
         in_shapes = {tm.input_name(): (batch_size,) + tm.static_shape() for tm in tensor_maps_in}
         out_shapes = {tm.output_name(): (batch_size,) + tm.static_shape() for tm in tensor_maps_out}
         train_dataset = tf.data.Dataset.from_generator(
@@ -859,51 +1333,9 @@ def _log_first_error(stats: Counter, tensor_path: str):
             logging.debug(f"Got first error: {k}")
 
 
-def _identity_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
-    return (in_batch, out_batch, paths) if return_paths else (in_batch, out_batch)
-
-
-def _mixup_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path], alpha: float = 1.0, permute_first: bool = False):
-    full_batch = in_batch.values().__iter__().__next__().shape[0]
-    half_batch = full_batch // 2
-
-    if permute_first:
-        permuted = np.random.permutation(full_batch)
-        for k in in_batch:
-            in_batch[k] = in_batch[k][permuted, ...]
-        for k in out_batch:
-            out_batch[k] = out_batch[k][permuted, ...]
-
-    mixed_ins = {k: np.zeros((half_batch,) + in_batch[k].shape[1:]) for k in in_batch}
-    mixed_outs = {k: np.zeros((half_batch,) + out_batch[k].shape[1:]) for k in out_batch}
-    for i in range(half_batch):
-        weight0 = np.random.beta(alpha, alpha)
-        weight1 = 1 - weight0
-        for k in in_batch:
-            mixed_ins[k][i] = (in_batch[k][i, ...] * weight0) + (in_batch[k][half_batch + i, ...] * weight1)
-        for k in out_batch:
-            mixed_outs[k][i] = (out_batch[k][i, ...] * weight0) + (out_batch[k][half_batch + i, ...] * weight1)
-
-    return _identity_batch(mixed_ins, mixed_outs, return_paths, paths[:half_batch])
-
-
-def _make_batch_siamese(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
-    full_batch = in_batch.values().__iter__().__next__().shape[0]
-    half_batch = full_batch // 2
-
-    siamese_in = {k+'_left': np.zeros((half_batch,) + in_batch[k].shape[1:]) for k in in_batch}
-    siamese_in.update({k+'_right': np.zeros((half_batch,) + in_batch[k].shape[1:]) for k in in_batch})
-    siamese_out = {'output_siamese': np.zeros((half_batch, 1))}
-
-    for i in range(half_batch):
-        for k in in_batch:
-            siamese_in[k+'_left'][i] = in_batch[k][i, ...]
-            siamese_in[k+'_right'][i] = in_batch[k][half_batch + i, ...]
-        random_task_key = np.random.choice(list(out_batch.keys()))
-        siamese_out['output_siamese'][i] = 0 if np.array_equal(out_batch[random_task_key][i], out_batch[random_task_key][i+half_batch]) else 1
-
-    return _identity_batch(siamese_in, siamese_out, return_paths, paths)
-
-
-def _weighted_batch(in_batch: Batch, out_batch: Batch, return_paths: bool, paths: List[Path]):
-    return (in_batch, out_batch, paths) if return_paths else (in_batch, out_batch)
+def _zero_batch(batch_size: int, tensor_maps: List[TensorMap], is_input: bool) -> Batch:
+    """Batch arrays in each TensorMap's dtype, so batches are the same whether or not workers reuse them from a buffer pool"""
+    return {
+        tm.input_name() if is_input else tm.output_name(): np.zeros((batch_size,) + tm.static_shape(), dtype=tm.dtype)
+        for tm in tensor_maps
+    }
@@ -0,0 +1,186 @@
+# tensor_map_profiler.py
+#
+# Opt in profiling of how long each TensorMap spends in each stage of making a tensor,
+# how many bytes each stage produces, how many bytes it allocates and how many bytes it reads from storage.
+# Allocations are the peak of tracemalloc's traced memory during the stage, above the traced memory when it started,
+# so profiling starts tracemalloc, which numpy reports its array buffers to.
+# Bytes read are the growth of the calling thread's rchar in /proc/thread-self/io, which counts the bytes of the hd5 reads
+# that reach the file system, and stays 0 for hd5s read from memory and on platforms without /proc.
+# Stages are reading the tensor with tensor_from_file, then the postprocessing stages of TensorMap.postprocess_tensor,
+# or one persistent_cache stage for tensors that come from a PersistentTensorCache.
+# Values go into log-linear histograms like HDR histograms: exact below 2 * HISTOGRAM_SUB_BUCKETS,
+# and above that within 1 / HISTOGRAM_SUB_BUCKETS of the true value, in a few hundred buckets at most.
+
+import os
+import time
+import logging
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, Optional, Tuple
+
+import h5py
+import numpy as np
+import pandas as pd
+
+PROFILE_STAGES = ['persistent_cache', 'read', 'validate', 'augment', 'normalize', 'discretize']
+HISTOGRAM_SUB_BUCKET_BITS = 5
+HISTOGRAM_SUB_BUCKETS = 1 << HISTOGRAM_SUB_BUCKET_BITS
+PROFILE_PERCENTILES = [50, 90, 99]
+PROFILE_EXT = '.tsv'
+THREAD_IO_PATH = '/proc/thread-self/io'
+
+
+class LogLinearHistogram:
+    """Counts of non-negative integers in log-linear buckets. Histograms of the same values can be merged."""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    @staticmethod
+    def bucket(value: int) -> int:
+        if value < 2 * HISTOGRAM_SUB_BUCKETS:
+            return value
+        exponent = value.bit_length() - HISTOGRAM_SUB_BUCKET_BITS - 1
+        return exponent * HISTOGRAM_SUB_BUCKETS + (value >> exponent)
+
+    @staticmethod
+    def bucket_value(bucket: int) -> int:
+        """The largest value in the bucket"""
+        if bucket < 2 * HISTOGRAM_SUB_BUCKETS:
+            return bucket
+        exponent = bucket // HISTOGRAM_SUB_BUCKETS - 1
+        return ((bucket - exponent * HISTOGRAM_SUB_BUCKETS + 1) << exponent) - 1
+
+    def record(self, value: int):
+        value = max(int(value), 0)
+        self.counts[self.bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other: 'LogLinearHistogram'):
+        self.counts.update(other.counts)
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, percentile: float) -> int:
+        """The smallest bucket value at or above percentile percent of the recorded values"""
+        if not self.count:
+            return 0
+        rank = percentile / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_value(bucket), self.max)
+        return self.max
+
+
+def _thread_read_counter() -> Tuple[int, int]:
+    """
+    The bytes the calling thread read with read system calls before this call, and the bytes this call read to find out.
+    Both are 0 where /proc/thread-self/io is not available.
+    """
+    try:
+        fd = os.open(THREAD_IO_PATH, os.O_RDONLY)
+        try:
+            counters = os.read(fd, 4096)  # one read, so the counters are from just before it
+        finally:
+            os.close(fd)
+    except OSError:
+        return 0, 0
+    for line in counters.splitlines():
+        if line.startswith(b'rchar:'):
+            return int(line.split()[1]), len(counters)
+    return 0, 0
+
+
+class TensorMapProfiler:
+    """Wall time in nanoseconds, output bytes, allocated bytes and bytes read from storage of each TensorMap stage"""
+
+    def __init__(self):
+        self.nanoseconds: Dict[Tuple[str, str], LogLinearHistogram] = {}
+        self.nbytes: Dict[Tuple[str, str], LogLinearHistogram] = {}
+        self.allocated_bytes: Dict[Tuple[str, str], LogLinearHistogram] = {}
+        self.read_bytes: Dict[Tuple[str, str], LogLinearHistogram] = {}
+
+    def _histograms(self) -> Tuple[Dict[Tuple[str, str], LogLinearHistogram], ...]:
+        return self.nanoseconds, self.nbytes, self.allocated_bytes, self.read_bytes
+
+    def record(self, tm_name: str, stage: str, nanoseconds: int, nbytes: int, allocated_bytes: int = 0, read_bytes: int = 0):
+        for histograms, value in zip(self._histograms(), (nanoseconds, nbytes, allocated_bytes, read_bytes)):
+            histograms.setdefault((tm_name, stage), LogLinearHistogram()).record(value)
+
+    def run(self, tm_name: str, stage: str, transform: Callable[[np.ndarray], np.ndarray], tensor: np.ndarray) -> np.ndarray:
+        """Apply a stage to a tensor, recording its time, the size of the tensor it returns, its peak allocation and the bytes it read"""
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):  # python 3.9 and later, before that the peak is since tracing started
+            tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        read_before, counter_bytes = _thread_read_counter()
+        start = time.perf_counter_ns()
+        tensor = transform(tensor)
+        nanoseconds = time.perf_counter_ns() - start
+        read_bytes = _thread_read_counter()[0] - read_before - counter_bytes
+        allocated_bytes = tracemalloc.get_traced_memory()[1] - traced_before
+        self.record(tm_name, stage, nanoseconds, getattr(tensor, 'nbytes', 0), allocated_bytes, read_bytes)
+        return tensor
+
+    def read(self, tm, hd5: h5py.File, dependents: Dict) -> np.ndarray:
+        return self.run(tm.name, 'read', lambda _: tm.tensor_from_file(tm, hd5, dependents), None)
+
+    def merge(self, other: 'TensorMapProfiler'):
+        for mine, theirs in zip(self._histograms(), other._histograms()):
+            for key, histogram in theirs.items():
+                mine.setdefault(key, LogLinearHistogram()).merge(histogram)
+
+    def clear(self):
+        self.nanoseconds, self.nbytes, self.allocated_bytes, self.read_bytes = {}, {}, {}, {}
+
+    def __len__(self):
+        return len(self.nanoseconds)
+
+    def summary(self) -> pd.DataFrame:
+        """One row per TensorMap and stage, slowest total time first"""
+        rows = []
+        for (tm_name, stage), times in self.nanoseconds.items():
+            key = tm_name, stage
+            row = {'tensor_map': tm_name, 'stage': stage, 'count': times.count, 'total_seconds': times.total / 1e9, 'mean_ms': times.mean() / 1e6}
+            row.update({f'p{percentile}_ms': times.percentile(percentile) / 1e6 for percentile in PROFILE_PERCENTILES})
+            row['max_ms'] = times.max / 1e6
+            row['mean_bytes'] = self.nbytes[key].mean()
+            row['max_bytes'] = self.nbytes[key].max
+            row['mean_allocated_bytes'] = self.allocated_bytes[key].mean()
+            row['max_allocated_bytes'] = self.allocated_bytes[key].max
+            row['mean_read_bytes'] = self.read_bytes[key].mean()
+            row['max_read_bytes'] = self.read_bytes[key].max
+            rows.append(row)
+        summary = pd.DataFrame(rows)
+        if rows:
+            summary['stage_order'] = summary['stage'].map({stage: i for i, stage in enumerate(PROFILE_STAGES)})
+            summary = summary.sort_values(['total_seconds', 'stage_order'], ascending=[False, True]).drop(columns='stage_order')
+        return summary.reset_index(drop=True)
+
+    def write(self, path: str, epoch: int, title: Optional[str] = None):
+        """Log the summary table and append it to the tsv at path"""
+        summary = self.summary()
+        if summary.empty:
+            return
+        summary.insert(0, 'epoch', epoch)
+        logging.info(f"{title or 'TensorMap profile'} for epoch {epoch}:\n{summary.to_string(index=False, float_format='%.3f')}")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        summary.to_csv(path, sep='\t', index=False, mode='a', header=not os.path.exists(path))
+
+
+def write_worker_profile(profiler: TensorMapProfiler, profile_dir: str, name: str, epoch: int, worker_id: int):
+    """Write and clear a data loader worker's profile, called by each worker at the end of its share of an epoch"""
+    profiler.write(os.path.join(profile_dir, f'{name}_{worker_id}_tensor_map_profile{PROFILE_EXT}'), epoch, f'{name} worker {worker_id} TensorMap profile')
+    profiler.clear()
@@ -0,0 +1,99 @@
+import os
+import h5py
+import logging
+import argparse
+from collections import Counter
+
+import pandas as pd
+
+from ml4h.defines import TENSOR_EXT
+from ml4h.packed_hd5 import PACKED_MANIFEST, PACKED_SHARD_EXT, PACKED_ALIGNMENT, PACKED_SHARD_BYTES, MANIFEST_COLUMNS
+
+"""
+This script packs all the hd5 files within the 'sources' directories into a few large shard files
+in the 'destination' directory, with a parquet manifest of where each sample is and which datasets it has.
+
+Every sample hd5 is copied byte for byte, so the packed dataset holds exactly the same tensors.
+If the same sample id is in more than one source, the first source wins.
+Pass the destination directory as --tensors to read the packed dataset with any ml4h recipe.
+
+Example command line:
+python ./pack_hd5s.py \
+    --sources /path/to/src/tensor/directory/ \
+    --destination /path/to/output/packed/directory/
+"""
+
+
+def pack_hd5s_into_destination(
+    destination: str, sources: list, min_sample_id: int, max_sample_id: int,
+    shard_bytes: int = PACKED_SHARD_BYTES, alignment: int = PACKED_ALIGNMENT,
+):
+    stats = Counter()
+    os.makedirs(destination, exist_ok=True)
+    if os.path.exists(os.path.join(destination, PACKED_MANIFEST)):
+        raise ValueError(f'{destination} already has a packed dataset manifest.')
+
+    rows = []
+    seen = set()
+    shard_index, shard_file, shard_name = 0, None, None
+    for source_folder in sources:
+        for source_file in sorted(os.listdir(source_folder)):
+            sample_id, extension = os.path.splitext(source_file)
+            if extension.lower() != TENSOR_EXT or sample_id in seen:
+                continue
+            if sample_id.isdigit() and not (min_sample_id <= int(sample_id) < max_sample_id):
+                continue
+            source_path = os.path.join(source_folder, source_file)
+            try:
+                with h5py.File(source_path, 'r') as hd5:
+                    keys = []
+                    hd5.visititems(lambda name, obj: keys.append(f'/{name}') if isinstance(obj, h5py.Dataset) else None)
+            except OSError as e:
+                logging.warning(f'Could not read {source_path}, it will not be packed: {e}')
+                stats['unreadable'] += 1
+                continue
+            if shard_file is None or shard_file.tell() >= shard_bytes:
+                if shard_file is not None:
+                    shard_file.close()
+                shard_name = f'shard_{shard_index:05d}{PACKED_SHARD_EXT}'
+                shard_file = open(os.path.join(destination, shard_name), 'wb')
+                shard_index += 1
+            offset = shard_file.tell()
+            with open(source_path, 'rb') as source:
+                data = source.read()
+            shard_file.write(data)
+            shard_file.write(b'\0' * (-len(data) % alignment))  # the next sample starts on an aligned offset
+            rows.append((sample_id, shard_name, offset, len(data), keys))
+            seen.add(sample_id)
+            stats['samples'] += 1
+            stats['bytes'] += len(data)
+            if stats['samples'] % 10000 == 0:
+                logging.info(f"Packed {stats['samples']} samples into {shard_index} shards.")
+        logging.info(f"Done packing source folder {source_folder}")
+    if shard_file is not None:
+        shard_file.close()
+
+    manifest = pd.DataFrame(rows, columns=MANIFEST_COLUMNS)
+    manifest.to_parquet(os.path.join(destination, PACKED_MANIFEST), index=False)
+    logging.info(f"Packed {stats['samples']} samples ({stats['bytes'] / 1e9:.2f}GB) into {shard_index} shards at {destination}.")
+    if stats['unreadable']:
+        logging.warning(f"Skipped {stats['unreadable']} unreadable hd5 files.")
+    return manifest
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sources', nargs='+', help='List of source directories with hd5 files')
+    parser.add_argument('--destination', help='Destination directory for the shards and manifest')
+    parser.add_argument('--min_sample_id', default=0, type=int, help='Minimum sample id to pack.')
+    parser.add_argument('--max_sample_id', default=7000000, type=int, help='Maximum sample id to pack.')
+    parser.add_argument('--shard_bytes', default=PACKED_SHARD_BYTES, type=int, help='Start a new shard once a shard is this many bytes.')
+    parser.add_argument('--alignment', default=PACKED_ALIGNMENT, type=int, help='Samples start at multiples of this many bytes.')
+    parser.add_argument("--logging_level", default='INFO', help="Logging level", choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"])
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.getLogger().setLevel(args.logging_level)
+    pack_hd5s_into_destination(args.destination, args.sources, args.min_sample_id, args.max_sample_id, args.shard_bytes, args.alignment)
@@ -0,0 +1,145 @@
+# tf_dataset.py
+#
+# A tf.data pipeline of TensorMap batches.
+# Samples are read in parallel by tf.data's own threads, batched in graph and prefetched while the model trains,
+# without the worker processes and queues of the legacy TensorGenerator.
+
+import logging
+from typing import Dict, List, Optional, Tuple, Union
+
+import numpy as np
+import tensorflow as tf
+
+from ml4h.TensorMap import TensorMap
+from ml4h.defines import TensorGeneratorABC
+from ml4h.ml4ht_integration.tensor_map import TensorMapSampleGetter
+from ml4ht.data.data_loader import EXCEPTIONS
+
+TF_DATASET_SHUFFLE_BUFFER = 4096
+
+
+def _tensor_map_dtype(tm: TensorMap) -> np.dtype:
+    return np.dtype(tm.dtype or np.float32)
+
+
+class _SampleLoader:
+    """Reads one sample as a flat list of arrays in TensorMap dtypes, and whether reading it succeeded"""
+
+    def __init__(self, input_maps: List[TensorMap], output_maps: List[TensorMap], augment: bool):
+        self.sample_getter = TensorMapSampleGetter(input_maps, output_maps, augment)
+        self.names = [tm.input_name() for tm in input_maps] + [tm.output_name() for tm in output_maps]
+        self.zeros = [np.zeros(tm.static_shape(), dtype=_tensor_map_dtype(tm)) for tm in input_maps + output_maps]
+        self.errors = 0
+
+    def __call__(self, path: bytes) -> List[np.ndarray]:
+        path = path.decode()
+        try:
+            in_batch, out_batch = self.sample_getter(path)
+        except EXCEPTIONS as e:
+            self.errors += 1
+            if self.errors == 1:
+                logging.warning(f'Could not read {path}, samples that raise errors are skipped: {e!r}')
+            return self.zeros + [np.array(False)]
+        tensors = {**in_batch, **out_batch}
+        return [
+            np.asarray(tensors[name], dtype=zeros.dtype).reshape(zeros.shape)
+            for name, zeros in zip(self.names, self.zeros)
+        ] + [np.array(True)]
+
+
+class TensorMapTfDataset(TensorGeneratorABC):
+    def __init__(
+        self, batch_size: int, input_maps: List[TensorMap], output_maps: List[TensorMap],
+        paths: Union[List[str], List[List[str]]], num_workers: int,
+        weights: Optional[List[float]] = None,
+        keep_paths: bool = False,
+        augment: bool = False,
+        cache_tensors: bool = False,
+        seed: Optional[int] = None,
+        **kwargs,
+    ):
+        """
+        Batches of TensorMap tensors from a tf.data pipeline.
+        Paths are shuffled, read with TensorMap.tensor_from_file in parallel threads through tf.numpy_function,
+        batched and prefetched, repeating forever.
+
+        :param paths: If weights is provided, paths should be a list of path lists the same length as weights
+        :param num_workers: samples read in parallel, 0 lets tf.data tune it
+        :param weights: If set, each list of paths is drawn from in proportion to its weight
+        :param keep_paths: If True, batches also have the list of paths they were read from
+        :param augment: whether to apply the TensorMaps' data augmentations
+        :param cache_tensors: If True and no TensorMap is augmented, tensors read in the first epoch are kept in memory
+        :param seed: seeds shuffling and weighted sampling
+        """
+        self.input_maps = input_maps
+        self.output_maps = output_maps
+        self.keep_paths = keep_paths
+        self.loader = _SampleLoader(input_maps, output_maps, augment)
+        self.num_parallel_calls = num_workers or tf.data.AUTOTUNE
+        self.cache_tensors = cache_tensors and not (augment and any(tm.augmentations for tm in input_maps + output_maps))
+        self.seed = seed
+        if weights is None:
+            dataset = self._sample_dataset(paths)
+        else:
+            dataset = tf.data.Dataset.sample_from_datasets(
+                [self._sample_dataset(group_paths) for group_paths in paths], weights=weights, seed=seed,
+            )
+        self.dataset = dataset.batch(batch_size, drop_remainder=True).map(self._to_batch).prefetch(tf.data.AUTOTUNE)
+        self.iterator = None
+
+    def _signature(self) -> Tuple[List[tf.DType], List[Tuple[int, ...]]]:
+        tensor_maps = self.input_maps + self.output_maps
+        return [tf.as_dtype(_tensor_map_dtype(tm)) for tm in tensor_maps] + [tf.bool], [tm.static_shape() for tm in tensor_maps] + [()]
+
+    def _read(self, path: tf.Tensor):
+        dtypes, shapes = self._signature()
+        tensors = tf.numpy_function(self.loader, [path], dtypes, stateful=True)  # augmentation is random
+        for tensor, shape in zip(tensors, shapes):
+            tensor.set_shape(shape)
+        return tuple(tensors) + (path,)
+
+    def _sample_dataset(self, paths: List[str]) -> tf.data.Dataset:
+        path_dataset = tf.data.Dataset.from_tensor_slices(np.array(paths, dtype=str))
+        if self.cache_tensors:
+            samples = path_dataset.map(self._read, num_parallel_calls=self.num_parallel_calls).cache()
+            samples = samples.shuffle(min(len(paths), TF_DATASET_SHUFFLE_BUFFER), seed=self.seed).repeat()
+        else:
+            path_dataset = path_dataset.shuffle(len(paths), seed=self.seed, reshuffle_each_iteration=True).repeat()
+            samples = path_dataset.map(self._read, num_parallel_calls=self.num_parallel_calls, deterministic=False)
+        return samples.filter(lambda *sample: sample[-2])
+
+    def _to_batch(self, *batch):
+        num_inputs = len(self.input_maps)
+        in_batch = {tm.input_name(): tensor for tm, tensor in zip(self.input_maps, batch[:num_inputs])}
+        out_batch = {tm.output_name(): tensor for tm, tensor in zip(self.output_maps, batch[num_inputs:-2])}
+        if self.keep_paths:
+            return in_batch, out_batch, batch[-1]
+        return in_batch, out_batch
+
+    @staticmethod
+    def can_apply(paths, weights, mixup, siamese, **kwargs):
+        """Can you substitute this TensorGenerator for the ml4h legacy TensorGenerator"""
+        if isinstance(paths[0], list) and weights is None:
+            raise NotImplementedError("TensorMapTfDataset needs weights to sample from multiple lists of paths.")
+        if mixup:
+            raise NotImplementedError("Mixup not implemented for TensorMapTfDataset")
+        if siamese:
+            raise NotImplementedError("Siamese not implemented for TensorMapTfDataset")
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Tuple[Dict[str, np.ndarray], ...]:
+        if self.iterator is None:
+            self.iterator = self.dataset.as_numpy_iterator()
+        batch = next(self.iterator)
+        if self.keep_paths:
+            return batch[0], batch[1], [path.decode() for path in batch[2]]
+        return batch
+
+    def __call__(self):
+        return self
+
+    def kill_workers(self):
+        """necessary for legacy compatibility"""
+        self.iterator = None
@@ -8,6 +8,8 @@ import statsmodels.formula.api as smf
 from statsmodels.multivariate.manova import MANOVA
 from sklearn.linear_model import LogisticRegression, LinearRegression, ElasticNet, Ridge
 
+from ml4h.embedding_export import is_embedding_shards, embeddings_dataframe
+
 
 ADJUST = [
     #'PC1', 'PC2', 'PC3', 'PC4', 'PC5', 'PC6', 'PC7', 'PC8', 'PC9', 'PC10',
@@ -32,7 +34,10 @@ def run():
     stat_model = os.environ['STAT_MODEL']
 
     latent_cols = [f'{latent_prefix}{i}' for i in range(int(latent_total))]
-    latent_df = pd.read_csv(latent_csv)
+    if is_embedding_shards(latent_csv):  # embeddings exported by infer_hidden with --embedding_format npy
+        latent_df = embeddings_dataframe(latent_csv, latent_prefix)
+    else:
+        latent_df = pd.read_csv(latent_csv)
 
     latent_space_gwas(input_bcf, chrom, start, stop, latent_df, latent_cols, output_csv, stat_model,
                       adjust_cols=ADJUST, train_ratio_ols=0.1)
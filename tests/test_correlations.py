@@ -0,0 +1,99 @@
+import os
+import sys
+import h5py
+import pytest
+import numpy as np
+import pandas as pd
+from scipy.stats import spearmanr
+
+from ml4h.correlations import correlation_table, correlation_header
+from ml4h.arguments import parse_args
+from ml4h.explorations import _tabulate_correlations
+from ml4h.recipes import run
+
+
+def _pairwise_table(stats, min_samples):
+    """Each pair correlated on its common samples, the way explore tabulated correlations one pair at a time"""
+    rows = []
+    fields = [field for field in stats if not any(np.isnan(values).any() for values in stats[field].values())]
+    for i, field1 in enumerate(fields):
+        for field2 in fields[i + 1:]:
+            common_samples = [sample for sample in stats[field1] if sample in stats[field2]]
+            if len(common_samples) < max(min_samples, 1):
+                continue
+            values1 = [value for sample in common_samples for value in stats[field1][sample]]
+            values2 = [value for sample in common_samples for value in stats[field2][sample]]
+            if len(values1) != len(values2):
+                continue
+            if len(set(values1)) == 1 or len(set(values2)) == 1:
+                continue
+            corr = np.corrcoef(values1, values2)[1, 0]
+            rows.append([field1, field2, corr, corr * corr, len(common_samples)])
+    return pd.DataFrame(sorted(rows, key=lambda row: row[2], reverse=True), columns=correlation_header())
+
+
+def _random_stats(rng, n_fields=23, n_samples=200):
+    latent = rng.normal(size=n_samples)
+    stats = {}
+    for i in range(n_fields):
+        present = rng.random(n_samples) < rng.uniform(.2, 1)
+        values = latent * rng.normal() + rng.normal(size=n_samples)
+        if i % 7 == 3:
+            values = np.round(values)  # ties
+        stats[f'field_{i}'] = {f'{s}': [float(values[s])] for s in np.flatnonzero(present)}
+    stats['constant'] = {f'{s}': [2.0] for s in range(0, n_samples, 2)}
+    stats['nan'] = {f'{s}': [float('nan') if s == 5 else float(s)] for s in range(n_samples)}
+    stats['repeated'] = {f'{s}': [float(s), float(s % 7)] for s in range(0, n_samples, 3)}
+    stats['sparse'] = {f'{s}': [float(s)] for s in range(3)}
+    return stats
+
+
+class TestCorrelationTable:
+    @pytest.mark.parametrize('block_size', [1, 4, 100, None])
+    @pytest.mark.parametrize('min_samples', [0, 10, 90])
+    def test_pairwise_parity(self, block_size, min_samples):
+        stats = _random_stats(np.random.default_rng(min_samples))
+        expected = _pairwise_table(stats, min_samples)
+        actual = correlation_table(stats, min_samples, block_size=block_size)
+        assert len(actual) == len(expected) > 0
+        assert actual['Pearson R'].is_monotonic_decreasing
+        actual, expected = actual.set_index(['Field 1', 'Field 2']).sort_index(), expected.set_index(['Field 1', 'Field 2']).sort_index()
+        pd.testing.assert_index_equal(actual.index, expected.index)
+        np.testing.assert_allclose(actual[['Pearson R', 'Pearson R^2']], expected[['Pearson R', 'Pearson R^2']], rtol=1e-9, atol=1e-12)
+        np.testing.assert_array_equal(actual['Sample Size'], expected['Sample Size'])
+
+    def test_spearman(self):
+        rng = np.random.default_rng(1)
+        samples = rng.random((100, 3)) ** 3
+        samples[:, 1] += samples[:, 0]
+        stats = {f'field_{i}': {f'{s}': [samples[s, i]] for s in range(100)} for i in range(3)}
+        actual = correlation_table(stats, 10, method='spearman', block_size=2).set_index(['Field 1', 'Field 2'])
+        assert list(actual.columns) == correlation_header('spearman')[2:]
+        for (field1, field2), row in actual.iterrows():
+            expected = spearmanr(samples[:, int(field1[-1])], samples[:, int(field2[-1])])[0]
+            np.testing.assert_allclose(row['Spearman R'], expected)
+        with pytest.raises(ValueError):
+            correlation_table(stats, 10, method='kendall')
+
+    def test_tabulate(self, tmpdir):
+        stats = _random_stats(np.random.default_rng(2))
+        _tabulate_correlations(stats, 'correlations', 10, str(tmpdir))
+        table = pd.read_csv(tmpdir.join('correlations.tsv'))
+        assert list(table.columns) == correlation_header()
+        assert len(table) == len(_pairwise_table(stats, 10))
+
+    def test_tabulate_mode(self, tmpdir):
+        rng = np.random.default_rng(3)
+        for sample in range(20):
+            with h5py.File(tmpdir.join(f'{sample}.hd5'), 'w') as hd5:
+                value = rng.random()
+                hd5.create_dataset('continuous/1_field-a_0_0', data=[value])
+                hd5.create_dataset('continuous/2_field-b_0_0', data=[value ** 3 + rng.random() / 10])
+        sys.argv = [
+            'tabulate_correlations', '--mode', 'tabulate_correlations', '--tensors', str(tmpdir), '--output_folder', str(tmpdir),
+            '--id', 'correlations', '--correlation_method', 'spearman',
+        ]
+        run(parse_args())
+        table = pd.read_csv(os.path.join(tmpdir, 'correlations.tsv'))
+        assert list(table.columns) == correlation_header('spearman')
+        assert len(table) == 1
@@ -0,0 +1,159 @@
+import pytest
+import numpy as np
+
+from sklearn.metrics import roc_auc_score, average_precision_score
+
+from ml4h.metrics import concordance_index, concordance_index_censored, _estimate_concordance_index, coefficient_of_determination
+from ml4h.bootstrap import bootstrap, bootstrap_interval, batch_roc_auc, batch_average_precision, batch_r2, batch_pearson
+
+
+def _pairwise_comparable(event_indicator, event_time, order):
+    """The quadratic comparable pair masks the concordance indices used to be computed from"""
+    n_samples = len(event_time)
+    tied_time = 0
+    comparable = {}
+    i = 0
+    while i < n_samples - 1:
+        time_i = event_time[order[i]]
+        start = i + 1
+        end = start
+        while end < n_samples and event_time[order[end]] == time_i:
+            end += 1
+        censored_at_same_time = ~event_indicator[order[i:end]]
+        for j in range(i, end):
+            if event_indicator[order[j]]:
+                mask = np.zeros(n_samples, dtype=bool)
+                mask[end:] = True
+                mask[i:end] = censored_at_same_time
+                comparable[j] = mask
+                tied_time += censored_at_same_time.sum()
+        i = end
+    return comparable, tied_time
+
+
+def _pairwise_concordance(event_indicator, event_time, estimate, weights, higher_is_concordant, tied_tol=1e-8):
+    order = np.argsort(event_time)
+    comparable, tied_time = _pairwise_comparable(event_indicator, event_time, order)
+    if len(comparable) == 0:
+        raise ValueError("Data has no comparable pairs, cannot estimate concordance index.")
+    concordant, discordant, tied_risk, numerator, denominator = 0, 0, 0, 0.0, 0.0
+    for ind, mask in comparable.items():
+        est_i = estimate[order[ind]]
+        w_i = weights[order[ind]]
+        est = estimate[order[mask]]
+        ties = np.absolute(est - est_i) <= tied_tol
+        n_ties = ties.sum()
+        con = est > est_i if higher_is_concordant else est < est_i
+        n_con = con[~ties].sum()
+        numerator += w_i * n_con + 0.5 * w_i * n_ties
+        denominator += w_i * mask.sum()
+        tied_risk += n_ties
+        concordant += n_con
+        discordant += est.size - n_con - n_ties
+    return numerator / denominator, concordant, discordant, tied_risk, tied_time
+
+
+def _random_survival(rng, n_samples, n_times, n_estimates):
+    event_indicator = rng.random(n_samples) < .4
+    event_time = rng.integers(n_times, size=n_samples).astype(float)
+    estimate = rng.integers(n_estimates, size=n_samples) / n_estimates  # few distinct values so estimates tie
+    return event_indicator, event_time, estimate
+
+
+class TestConcordanceIndex:
+    @pytest.mark.parametrize('n_samples', [2, 3, 10, 57, 200])
+    @pytest.mark.parametrize('n_times', [1, 3, 40, 1000])
+    @pytest.mark.parametrize('n_estimates', [2, 10, 10 ** 6])
+    def test_censored_parity(self, n_samples, n_times, n_estimates):
+        rng = np.random.default_rng(n_samples * n_times + n_estimates)
+        for _ in range(5):
+            event_indicator, event_time, estimate = _random_survival(rng, n_samples, n_times, n_estimates)
+            weights = rng.random(n_samples)
+            try:
+                expected = _pairwise_concordance(event_indicator, event_time, estimate, weights, higher_is_concordant=False)
+            except ValueError:
+                with pytest.raises(ValueError):
+                    _estimate_concordance_index(event_indicator, event_time, estimate, weights)
+                continue
+            actual = _estimate_concordance_index(event_indicator, event_time, estimate, weights)
+            np.testing.assert_allclose(actual[0], expected[0], rtol=1e-12)
+            assert tuple(actual[1:]) == tuple(expected[1:])
+            if n_estimates == 2:
+                unweighted = _pairwise_concordance(event_indicator, event_time, estimate, np.ones(n_samples), higher_is_concordant=False)
+                np.testing.assert_allclose(concordance_index_censored(event_indicator, event_time, estimate), unweighted)
+
+    def test_tolerance(self):
+        event_indicator = np.array([True, True, False, True, False])
+        event_time = np.array([1., 1., 1., 2., 3.])
+        estimate = np.array([.5, .5 + 1e-9, .5 - 1e-9, .7, .5 + 1e-3])
+        for tied_tol in [1e-8, 1e-12, 1e-2]:
+            expected = _pairwise_concordance(event_indicator, event_time, estimate, np.ones(5), False, tied_tol)
+            actual = concordance_index_censored(event_indicator, event_time, estimate, tied_tol)
+            np.testing.assert_allclose(actual, expected)
+
+    def test_no_comparable_pairs(self):
+        with pytest.raises(ValueError):
+            concordance_index_censored(np.array([False, False, True]), np.array([1., 2., 3.]), np.array([.1, .2, .3]))
+
+    @pytest.mark.parametrize('intervals', [2, 5, 25])
+    def test_survival_curve_parity(self, intervals):
+        rng = np.random.default_rng(intervals)
+        n_samples = 300
+        survived = rng.integers(1, intervals + 1, size=n_samples)
+        truth = np.zeros((n_samples, 2 * intervals))
+        for i, last in enumerate(survived):
+            truth[i, :last] = 1
+            if last < intervals and rng.random() < .5:
+                truth[i, intervals + last] = 1
+        prediction = rng.integers(2, 6, size=(n_samples, 2 * intervals)) / 6
+        intervals_truth = truth[:, :intervals]
+        event_time = np.argmin(np.diff(intervals_truth), axis=-1)
+        event_time[intervals_truth[:, -1] == 1] = intervals - 1
+        event_indicator = truth[:, intervals:].sum(axis=-1).astype(bool)
+        estimate = np.cumprod(prediction[:, :intervals], axis=-1)[:, -1]
+        expected = _pairwise_concordance(event_indicator, event_time, estimate, np.ones(n_samples), higher_is_concordant=True)
+        actual = concordance_index(prediction, truth)
+        np.testing.assert_allclose(actual[0], expected[0], rtol=1e-12)
+        assert tuple(actual[1:]) == tuple(expected[1:])
+
+
+class TestBootstrap:
+    @staticmethod
+    def _resamples(rng, n_samples=60, n_boot=20, ties=True):
+        truth = (rng.random((n_boot, n_samples)) < .3).astype(float)
+        prediction = rng.integers(8, size=(n_boot, n_samples)) / 8 if ties else rng.random((n_boot, n_samples))
+        return truth, prediction
+
+    @pytest.mark.parametrize('ties', [True, False])
+    def test_batch_metrics_parity(self, ties):
+        rng = np.random.default_rng(ties)
+        truth, prediction = self._resamples(rng, ties=ties)
+        np.testing.assert_allclose(batch_roc_auc(truth, prediction), [roc_auc_score(t, p) for t, p in zip(truth, prediction)])
+        np.testing.assert_allclose(batch_average_precision(truth, prediction), [average_precision_score(t, p) for t, p in zip(truth, prediction)])
+        np.testing.assert_allclose(batch_r2(truth, prediction), [coefficient_of_determination(t, p) for t, p in zip(truth, prediction)])
+        np.testing.assert_allclose(batch_pearson(truth, prediction), [np.corrcoef(t, p)[1, 0] for t, p in zip(truth, prediction)])
+
+    def test_concordance_parity(self):
+        rng = np.random.default_rng(3)
+        event_indicator, event_time, estimate = _random_survival(rng, 80, 10, 5)
+        truth = np.stack([event_indicator, event_time], axis=-1)
+        performance = bootstrap(truth, estimate, 'c_index', 12, seed=5, chunk_size=5)
+        expected = bootstrap(truth, estimate, lambda t, p: concordance_index_censored(t[:, 0] == 1, t[:, 1], p)[0], 12, seed=5, chunk_size=5)
+        np.testing.assert_allclose(performance, expected)
+
+    def test_multilabel_roc_auc(self):
+        rng = np.random.default_rng(4)
+        truth = np.eye(3)[rng.integers(3, size=90)]
+        prediction = rng.random((90, 3))
+        np.testing.assert_allclose(
+            bootstrap(truth, prediction, 'roc_auc', 10, seed=1), bootstrap(truth, prediction, roc_auc_score, 10, seed=1),
+        )
+
+    def test_seeded(self):
+        rng = np.random.default_rng(5)
+        truth, prediction = rng.random(200), rng.random(200)
+        performance = bootstrap(truth, prediction, 'r2', 100, seed=7, chunk_size=30)
+        np.testing.assert_array_equal(performance, bootstrap(truth, prediction, 'r2', 100, seed=7, chunk_size=30, processes=2))
+        assert not np.array_equal(performance, bootstrap(truth, prediction, 'r2', 100, seed=8, chunk_size=30))
+        mean, interval = bootstrap_interval(truth, prediction, 'r2', 100, seed=7, chunk_size=30)
+        assert interval[0] <= mean <= interval[1]
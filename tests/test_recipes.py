@@ -5,15 +5,24 @@ import pandas as pd
 import numpy as np
 
 from ml4h.recipes import inference_file_name, _hidden_file_name
+from ml4h.inference_writer import INFERENCE_MANIFEST, AsyncInferenceWriter, InferenceSink, read_inference
+from ml4h.embedding_export import load_embeddings, embeddings_dataframe
 from ml4h.recipes import train_legacy, train_multimodal_multitask
 from ml4h.recipes import infer_multimodal_multitask, infer_hidden_layer_multimodal_multitask
 from ml4h.recipes import compare_multimodal_scalar_task_models, _find_learning_rate
+from ml4h.recipes import _scalar_predictions_from_generator, _get_common_outputs
+from ml4h.defines import MODEL_EXT
+from ml4h.models.legacy_models import make_multimodal_multitask_model, get_model_inputs_outputs
+from ml4h.tensor_generators import BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX
 from ml4h.explorations import _categorical_explore_header, _should_error_detect, explore
+from ml4h.explorations import EXPLORE_DATASET, ExploreParallelWrapper, read_explore_dataset, _explore_schema, _explore_record_batch
 # Imports with test in their name
 from ml4h.recipes import test_multimodal_multitask as tst_multimodal_multitask
 from ml4h.recipes import test_multimodal_scalar_tasks as tst_multimodal_scalar_tasks
+from ml4h.tensor_generators import test_train_valid_tensor_generators as tst_train_valid_tensor_generators
 from ml4h.test_utils import TMAPS_UP_TO_4D
 from ml4h.test_utils import build_hdf5s
+from ml4h.tensorize.pack_hd5s import pack_hd5s_into_destination
 from ml4h.TensorMap import TensorMap, Interpretation
 
 
@@ -21,6 +30,13 @@ class TestRecipes:
     def test_train(self, default_arguments):
         train_multimodal_multitask(default_arguments)
 
+    def test_train_tf_data(self, default_arguments):
+        default_arguments.tf_data = True
+        try:
+            train_multimodal_multitask(default_arguments)
+        finally:
+            default_arguments.tf_data = False
+
     def test_train_legacy(self, default_arguments):
         train_legacy(default_arguments)
 
@@ -44,12 +60,134 @@ class TestRecipes:
         default_arguments.tsv_style = 'standard'
         assert len(set(inferred['FID'])) == pytest.N_TENSORS
 
+    def test_infer_packed(self, default_arguments, tmpdir):
+        infer_multimodal_multitask(default_arguments)
+        infer_hidden_layer_multimodal_multitask(default_arguments)
+        hidden_tsv = _hidden_file_name(default_arguments.output_folder, default_arguments.hidden_layer, default_arguments.id, '.tsv')
+        expected = [
+            pd.read_csv(inference_file_name(default_arguments.output_folder, default_arguments.id), sep='\t'),
+            pd.read_csv(hidden_tsv, sep='\t'),
+        ]
+        pack_hd5s_into_destination(str(tmpdir), [default_arguments.tensors], 0, pytest.N_TENSORS)
+        tensors, default_arguments.tensors = default_arguments.tensors, str(tmpdir)
+        try:
+            infer_multimodal_multitask(default_arguments)
+            infer_hidden_layer_multimodal_multitask(default_arguments)
+        finally:
+            default_arguments.tensors = tensors
+        inferred = [
+            pd.read_csv(inference_file_name(default_arguments.output_folder, default_arguments.id), sep='\t'),
+            pd.read_csv(hidden_tsv, sep='\t'),
+        ]
+        for actual, expected_table in zip(inferred, expected):
+            assert len(actual) == len(expected_table) == pytest.N_TENSORS
+            assert sorted(actual['sample_id']) == sorted(expected_table['sample_id'])
+
+    def test_infer_batched(self, default_arguments):
+        batch_size, num_workers = default_arguments.batch_size, default_arguments.num_workers
+        default_arguments.batch_size, default_arguments.num_workers = 7, 2  # the last batch is partial
+        try:
+            infer_multimodal_multitask(default_arguments)
+        finally:
+            default_arguments.batch_size, default_arguments.num_workers = batch_size, num_workers
+        tsv = inference_file_name(default_arguments.output_folder, default_arguments.id)
+        inferred = pd.read_csv(tsv, sep='\t')
+        assert len(inferred) == len(set(inferred['sample_id'])) == pytest.N_TENSORS
+
+    @pytest.mark.parametrize('inference_format', ['parquet', 'arrow'])
+    def test_infer_columnar(self, default_arguments, inference_format):
+        infer_multimodal_multitask(default_arguments)
+        tsv = pd.read_csv(inference_file_name(default_arguments.output_folder, default_arguments.id), sep='\t')
+        default_arguments.inference_format, default_arguments.inference_writers, default_arguments.inference_partition_size = inference_format, 2, 30
+        try:
+            infer_multimodal_multitask(default_arguments)
+        finally:
+            default_arguments.inference_format, default_arguments.inference_writers, default_arguments.inference_partition_size = 'tsv', 1, 0
+        directory = inference_file_name(default_arguments.output_folder, default_arguments.id, inference_format)
+        manifest = pd.read_parquet(os.path.join(directory, INFERENCE_MANIFEST))
+        assert manifest['rows'].sum() == pytest.N_TENSORS
+        assert (manifest['max_sample_id'] // 30 == manifest['partition']).all()
+        assert (manifest['min_sample_id'] // 30 == manifest['partition']).all()
+        inferred = read_inference(directory)
+        assert inferred['sample_id'].dtype == np.int64
+        assert sorted(inferred['sample_id']) == sorted(tsv['sample_id'])
+        assert list(inferred.columns) == list(tsv.columns)
+        actual = [column for column in tsv.columns if column.endswith('_actual')]
+        inferred, tsv = inferred.set_index('sample_id').sort_index(), tsv.set_index('sample_id').sort_index()
+        np.testing.assert_allclose(inferred[actual].astype(np.float64), tsv[actual], rtol=1e-6)
+
+    def test_inference_writer_error(self):
+        class BrokenSink(InferenceSink):
+            def write(self, columns):
+                raise TypeError('cannot write')
+
+            def close(self):
+                return []
+
+        writer = AsyncInferenceWriter([BrokenSink()], max_pending=2)
+        with pytest.raises(TypeError):  # raised by a later write instead of blocking once the queue is full
+            for _ in range(100):
+                writer.write({'sample_id': [1]})
+        with pytest.raises(TypeError):
+            writer.close()
+
     def test_infer_hidden(self, default_arguments):
         infer_hidden_layer_multimodal_multitask(default_arguments)
         tsv = _hidden_file_name(default_arguments.output_folder, default_arguments.hidden_layer, default_arguments.id, '.tsv')
         inferred = pd.read_csv(tsv, sep='\t')
         assert len(set(inferred['sample_id'])) == pytest.N_TENSORS
 
+    def test_infer_hidden_npy(self, default_arguments):
+        infer_hidden_layer_multimodal_multitask(default_arguments)
+        tsv = _hidden_file_name(default_arguments.output_folder, default_arguments.hidden_layer, default_arguments.id, '.tsv')
+        inferred = pd.read_csv(tsv, sep='\t')
+        default_arguments.embedding_format, default_arguments.embedding_shard_size = 'npy', 32
+        try:
+            infer_hidden_layer_multimodal_multitask(default_arguments)
+        finally:
+            default_arguments.embedding_format, default_arguments.embedding_shard_size = 'tsv', 65536
+        directory = _hidden_file_name(default_arguments.output_folder, default_arguments.hidden_layer, default_arguments.id, '')
+        sample_ids, embeddings = load_embeddings(directory)
+        assert embeddings.dtype == np.float32
+        assert embeddings.shape == (pytest.N_TENSORS, len(inferred.columns) - 1)
+        assert sorted(sample_ids) == sorted(inferred['sample_id'])
+        exported = embeddings_dataframe(directory)
+        assert list(exported.columns) == list(inferred.columns)
+        np.testing.assert_array_equal(exported.drop(columns='sample_id').to_numpy(), embeddings)
+
+    def test_scalar_predictions_from_generator(self, default_arguments, tmpdir):
+        model = make_multimodal_multitask_model(**default_arguments.__dict__)
+        model_files = [os.path.join(tmpdir, f'model_{i}{MODEL_EXT}') for i in range(3)]
+        for model_file in model_files:
+            model.save(model_file)
+        tensor_maps_in, tensor_maps_out = default_arguments.tensor_maps_in, default_arguments.tensor_maps_out
+        models_io = get_model_inputs_outputs(model_files, tensor_maps_in, tensor_maps_out)
+        _, _, generate_test = tst_train_valid_tensor_generators(**default_arguments.__dict__)
+        batches = []
+
+        def recorded():
+            while True:
+                batches.append(next(generate_test))
+                yield batches[-1]
+        comparison_threads = default_arguments.comparison_threads
+        default_arguments.comparison_threads = 2
+        try:
+            predictions, labels, paths = _scalar_predictions_from_generator(
+                default_arguments, models_io, recorded(), 3, _get_common_outputs(models_io, 'output'), 'input', 'output',
+            )
+        finally:
+            default_arguments.comparison_threads = comparison_threads
+            default_arguments.tensor_maps_in, default_arguments.tensor_maps_out, default_arguments.model_file = tensor_maps_in, tensor_maps_out, None
+            generate_test.kill_workers()
+        assert len(batches) == 3
+        expected = np.concatenate([model.predict_on_batch(batch[BATCH_INPUT_INDEX]) for batch in batches])
+        for tm in tensor_maps_out:
+            np.testing.assert_array_equal(labels[tm.output_name()], np.concatenate([batch[BATCH_OUTPUT_INDEX][tm.output_name()] for batch in batches]))
+            assert set(predictions[tm]) == {f'model_{i}' for i in range(3)}
+            for model_predictions in predictions[tm].values():
+                np.testing.assert_allclose(model_predictions, expected, rtol=1e-5)
+        assert len(paths) == len(expected)
+
     def test_find_learning_rate(self, default_arguments):
         _find_learning_rate(default_arguments)
 
@@ -85,3 +223,47 @@ class TestRecipes:
                     for channel, idx in tm.channel_map.items():
                         channel_val = getattr(row, _categorical_explore_header(tm, channel))
                         assert channel_val == row_expected[idx]
+
+    def test_explore_parquet(self, default_arguments, tmpdir_factory):
+        temp_dir = tmpdir_factory.mktemp('explore_tensors_parquet')
+        tmaps = TMAPS_UP_TO_4D[:] + [TensorMap(f'scalar', shape=(1,), interpretation=Interpretation.CONTINUOUS)]
+        build_hdf5s(temp_dir, tmaps, n=pytest.N_TENSORS, keys_are_paths=False)
+        tensors, num_workers, tensor_maps_in = default_arguments.tensors, default_arguments.num_workers, default_arguments.tensor_maps_in
+        default_arguments.tensors, default_arguments.num_workers, default_arguments.tensor_maps_in = str(temp_dir), 2, tmaps
+        default_arguments.explore_skip_csv, default_arguments.explore_chunk_size, run_id = True, 5, default_arguments.id
+        default_arguments.id = 'explore_parquet'
+        os.makedirs(os.path.join(default_arguments.output_folder, default_arguments.id), exist_ok=True)
+        try:
+            explore(default_arguments)
+        finally:
+            default_arguments.tensors, default_arguments.num_workers, default_arguments.tensor_maps_in = tensors, num_workers, tensor_maps_in
+            default_arguments.explore_skip_csv, default_arguments.explore_chunk_size = False, 64
+            run_folder, default_arguments.id = os.path.join(default_arguments.output_folder, default_arguments.id), run_id
+        assert not os.path.exists(os.path.join(run_folder, 'tensors_all_union.csv'))
+        explored = read_explore_dataset(os.path.join(run_folder, EXPLORE_DATASET))
+        assert len(explored) == len(set(explored['fpath'])) == pytest.N_TENSORS
+        assert explored['fpath'].dtype == 'string'
+        assert explored['scalar'].dtype == np.float64
+
+        paths = [(os.path.join(temp_dir, name), 'train') for name in sorted(os.listdir(temp_dir))]
+        single = ExploreParallelWrapper([tmaps[-1]], paths, 0, str(temp_dir), 'single', chunk_size=4, file_rows=7, row_group_size=3).run()
+        pooled = ExploreParallelWrapper([tmaps[-1]], paths, 3, str(temp_dir), 'pooled', chunk_size=4, file_rows=7, row_group_size=3).run()
+        manifest = pd.read_parquet(os.path.join(pooled, INFERENCE_MANIFEST))
+        assert (manifest['rows'] <= 7).all() and manifest['rows'].sum() == len(paths)
+        assert (manifest['row_groups'] == -(-manifest['rows'] // 3)).all()
+        pd.testing.assert_frame_equal(read_explore_dataset(single), read_explore_dataset(pooled))
+
+    def test_explore_record_batch(self, caplog):
+        array_tm = TensorMap('array', shape=(3,), interpretation=Interpretation.CONTINUOUS)
+        scalar_tm = TensorMap('scalar', shape=(1,), interpretation=Interpretation.CONTINUOUS)
+        schema = _explore_schema([array_tm, scalar_tm])
+        rows = [
+            {'array': np.array([1., 2., 3.]), 'scalar': 4., 'fpath': '1', 'generator': 'train'},
+            {'array': None, 'scalar': np.array([5., 6.]), 'error_type_scalar': '', 'fpath': '2', 'generator': 'train'},
+        ]
+        with caplog.at_level(logging.WARNING):
+            batch = _explore_record_batch(rows, schema).to_pydict()
+        assert batch['array'] == [str(np.array([1., 2., 3.])), None]
+        assert batch['scalar'][0] == 4. and np.isnan(batch['scalar'][1])
+        assert batch['error_type_scalar'] == [None, None]
+        assert '1 values of scalar are not numbers' in caplog.text
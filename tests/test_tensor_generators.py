@@ -1,11 +1,44 @@
 import os
 import csv
+import json
+import queue
+import h5py
+import shutil
 import pytest
 import numpy as np
-from collections import defaultdict
+import pandas as pd
+from multiprocessing import Process
+from collections import Counter, defaultdict
 
 from ml4h.defines import TENSOR_EXT
+from ml4h.test_utils import CONTINUOUS_TMAPS, CATEGORICAL_TMAPS, build_hdf5s
 from ml4h.tensor_generators import _sample_csv_to_set, get_train_valid_test_paths, get_train_valid_test_paths_split_by_csvs
+from ml4h.tensor_generators import TensorGenerator, BATCH_INPUT_INDEX, BATCH_OUTPUT_INDEX, BATCH_PATHS_INDEX
+from ml4h.tensor_generators import _ReadAheadPaths
+from ml4h.tensor_generators import test_train_valid_tensor_generators as tst_train_valid_tensor_generators
+from ml4h.generator_stats import EpochStatsAggregator, merge_worker_stats, TENSOR_MAP_ERROR_PREFIX
+from ml4h.tensor_map_profiler import LogLinearHistogram, TensorMapProfiler, HISTOGRAM_SUB_BUCKETS, THREAD_IO_PATH
+from ml4h.TensorMap import TensorMap
+from ml4h.normalizer import Standardize
+from ml4h.tensor_cache import SharedTensorMapCache, PersistentTensorCache, tensor_map_fingerprint
+from ml4h.hd5_read_plan import Hd5ReadPlan
+from ml4h.packed_hd5 import PACKED_ALIGNMENT, packed_dataset, tensor_paths
+from ml4h.tensorize.pack_hd5s import pack_hd5s_into_destination
+from ml4h import sample_index
+from ml4h.sample_index import SampleIndex, build_sample_index, _scan_sample
+from ml4h.ml4ht_integration.tensor_map import TensorMapSampleGetter
+from ml4h.ml4ht_integration.tensor_generator import TensorMapDataLoader
+from ml4h.ml4ht_integration.sampler import ShuffleSampler, WeightedSampler, ClassBalancedSampler, StratifiedSampler
+from ml4h.ml4ht_integration.sampler import tensor_map_labels, MISSING_LABEL, STRATIFY_BINS
+from ml4h.ml4ht_integration import sampler as sampler_module
+from ml4h.batch_functions import _mixup_batch, _make_batch_siamese, batch_function_collate, pick_batch_function
+from ml4h.tensor_generators import pick_generator
+from ml4h.tf_dataset import TensorMapTfDataset
+from ml4ht.data.data_loader import numpy_collate_fn
+
+
+GENERATOR_TMAPS_IN = [CONTINUOUS_TMAPS[2]]
+GENERATOR_TMAPS_OUT = [CATEGORICAL_TMAPS[0]]
 
 
 def _write_samples(csv_path, sample_ids, use_header=False, write_dupes=False):
@@ -61,6 +94,17 @@ def train_valid_test_csv(tmpdir_factory, request):
     return (train_path, set(train_ids)), (valid_path, set(valid_ids)), (test_path, set(test_ids))
 
 
+@pytest.fixture(scope='module')
+def generator_paths(tmpdir_factory):
+    temp_dir = tmpdir_factory.mktemp('generator_tensors')
+    build_hdf5s(temp_dir, GENERATOR_TMAPS_IN + GENERATOR_TMAPS_OUT, n=pytest.N_TENSORS)
+    return [os.path.join(temp_dir, f'{i}{TENSOR_EXT}') for i in range(pytest.N_TENSORS)]
+
+
+def _path_to_sample_value(path):
+    return int(os.path.splitext(os.path.basename(path))[0])
+
+
 # Ugly meta fixtures because fixtures cannot be
 # used as parameters in pytest.mark.parametrize
 # https://github.com/pytest-dev/pytest/issues/349
@@ -229,4 +273,897 @@ class TestGetTrainValidTestPaths:
                 test_csv=test_csv,
             )
 
+    @pytest.mark.parametrize('random_seed', [0, 7, 12878])
+    def test_split_matches_per_path_draws(self, default_arguments, random_seed):
+        """Existing random seeds must keep splitting samples the way one draw per path, in the order the tensors are walked, did"""
+        args = default_arguments
+        np.random.seed(random_seed)
+        expected = {'train': [], 'valid': [], 'test': []}
+        for root, dirs, files in os.walk(args.tensors):
+            for name in files:
+                if os.path.splitext(name)[-1].lower() == TENSOR_EXT:
+                    choice = np.random.choice(['train', 'valid', 'test'], p=[1 - args.valid_ratio - args.test_ratio, args.valid_ratio, args.test_ratio])
+                    expected[choice].append(os.path.join(root, name))
+        np.random.seed(random_seed)
+        train_paths, valid_paths, test_paths = get_train_valid_test_paths(args.tensors, None, args.valid_ratio, args.test_ratio, None, None, None)
+        assert (train_paths, valid_paths, test_paths) == (expected['train'], expected['valid'], expected['test'])
+
     # TODO test method with balance csvs
+
+
+def _generators_from_arguments(args, **options):
+    """The train, validation and test generators a recipe would make with these options on the command line"""
+    return tst_train_valid_tensor_generators(**{**args.__dict__, **options})
+
+
+def _kill(generators):
+    for generator in generators:
+        generator.kill_workers()
+
+
+class TestSharedMemoryTransport:
+    def test_set_from_arguments(self, default_arguments):
+        generators = _generators_from_arguments(default_arguments, num_workers=2, shared_memory_transport=True)
+        try:
+            for generator in generators:
+                assert isinstance(generator, TensorGenerator)
+                in_batch = next(generator)[BATCH_INPUT_INDEX]
+                assert generator.batch_ring is not None
+                assert len(in_batch[default_arguments.tensor_maps_in[0].input_name()]) == default_arguments.batch_size
+        finally:
+            _kill(generators)
+
+    def test_batches_match_paths(self, generator_paths):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=2, cache_size=0, keep_paths=True, shared_memory_transport=True,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        try:
+            for _ in range(2 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    value = _path_to_sample_value(path)
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == value)
+                    assert np.argmax(batch[BATCH_OUTPUT_INDEX][tm_out.output_name()][i]) == value % tm_out.shape[-1]
+        finally:
+            generator.kill_workers()
+
+    def test_mixup_shapes(self, generator_paths):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=2, cache_size=0, mixup_alpha=1.0, shared_memory_transport=True,
+        )
+        try:
+            in_batch, out_batch = next(generator)
+            assert in_batch[GENERATOR_TMAPS_IN[0].input_name()].shape == (4,) + GENERATOR_TMAPS_IN[0].shape
+            assert out_batch[GENERATOR_TMAPS_OUT[0].output_name()].shape == (4,) + GENERATOR_TMAPS_OUT[0].shape
+        finally:
+            generator.kill_workers()
+
+
+class TestBufferPool:
+    def test_set_from_arguments(self, default_arguments):
+        generators = _generators_from_arguments(default_arguments, buffer_pool=True)
+        try:
+            for generator in generators:
+                assert isinstance(generator, TensorGenerator)
+                next(generator)
+                assert generator.worker_instances[0].buffer_pool is not None
+        finally:
+            _kill(generators)
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_same_dtype_without_pool(self, generator_paths, num_workers):
+        dtypes = []
+        for buffer_pool in (False, True):
+            generator = TensorGenerator(
+                batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+                paths=generator_paths, num_workers=num_workers, cache_size=0, buffer_pool=buffer_pool,
+            )
+            try:
+                in_batch, out_batch = next(generator)
+                dtypes.append({name: array.dtype for name, array in {**in_batch, **out_batch}.items()})
+            finally:
+                generator.kill_workers()
+        assert dtypes[0] == dtypes[1]
+        assert dtypes[0][GENERATOR_TMAPS_IN[0].input_name()] == GENERATOR_TMAPS_IN[0].dtype
+
+    def test_dead_workers_raise(self, generator_paths):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=2, cache_size=0, buffer_pool=True,
+        )
+        try:
+            next(generator)
+            for worker in generator.workers:
+                worker.terminate()
+                worker.join()
+            with pytest.raises(queue.Empty):
+                for _ in range(pytest.N_TENSORS):  # batches the workers queued before dying are still read
+                    next(generator)
+        finally:
+            generator.kill_workers()
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    @pytest.mark.parametrize('shared_memory_transport', [False, True])
+    def test_batches_match_paths(self, generator_paths, num_workers, shared_memory_transport):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=num_workers, cache_size=0, keep_paths=True,
+            shared_memory_transport=shared_memory_transport, buffer_pool=True,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        try:
+            previous = None
+            for _ in range(2 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                assert batch[BATCH_INPUT_INDEX][tm_in.input_name()].dtype == tm_in.dtype
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    value = _path_to_sample_value(path)
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == value)
+                    assert np.argmax(batch[BATCH_OUTPUT_INDEX][tm_out.output_name()][i]) == value % tm_out.shape[-1]
+                if previous is not None:  # the previous batch must survive while the next one is filled
+                    previous_in, previous_paths = previous
+                    for i, path in enumerate(previous_paths):
+                        assert np.all(previous_in[i] == _path_to_sample_value(path))
+                previous = batch[BATCH_INPUT_INDEX][tm_in.input_name()], batch[BATCH_PATHS_INDEX]
+        finally:
+            generator.kill_workers()
+
+
+def _fill_cache(cache, paths, name):
+    for value, path in enumerate(paths):
+        cache[path, name] = np.full(GENERATOR_TMAPS_IN[0].static_shape(), value)
+
+
+class TestSharedTensorMapCache:
+    def _cache(self, rows):
+        tm = GENERATOR_TMAPS_IN[0]
+        row_size = np.zeros(tm.static_shape(), dtype=np.float32).nbytes
+        return SharedTensorMapCache(rows * row_size, [tm], []), tm.input_name()
+
+    def test_evicts_least_recently_used(self):
+        cache, name = self._cache(rows=3)
+        try:
+            _fill_cache(cache, ['a', 'b', 'c'], name)
+            assert cache.get(('a', name)).flat[0] == 0  # b is now the least recently used
+            cache['d', name] = np.full(GENERATOR_TMAPS_IN[0].static_shape(), 3)
+            assert ('b', name) not in cache
+            assert [cache[path, name].flat[0] for path in 'acd'] == [0, 2, 3]
+            assert cache.get(('b', name)) is None
+            stats = cache.stats()
+            assert (stats['cache_hits'], stats['cache_misses'], stats['cache_evictions']) == (4, 1, 1)
+        finally:
+            cache.unlink()
+
+    def test_many_evictions_keep_table_consistent(self):
+        cache, name = self._cache(rows=8)
+        try:
+            paths = [f'path_{i}' for i in range(200)]
+            _fill_cache(cache, paths, name)
+            assert len(cache) == 8
+            for value, path in enumerate(paths[-8:], start=192):
+                assert cache[path, name].flat[0] == value
+            assert cache.stats()['cache_evictions'] == 192
+        finally:
+            cache.unlink()
+
+    def test_recently_used_survive_sampled_eviction(self):
+        cache, name = self._cache(rows=64)
+        try:
+            paths = [f'path_{i}' for i in range(64)]
+            _fill_cache(cache, paths, name)
+            for i in range(0, 64, 2):
+                cache.get((paths[i], name))  # only odd paths are left to evict
+            _fill_cache(cache, [f'new_{i}' for i in range(32)], name)
+            assert all((path, name) in cache for path in paths[::2])
+            assert not any((path, name) in cache for path in paths[1::2])
+        finally:
+            cache.unlink()
+
+    def test_shared_between_processes(self):
+        cache, name = self._cache(rows=4)
+        try:
+            worker = Process(target=_fill_cache, args=(cache, ['a', 'b'], name))
+            worker.start()
+            worker.join()
+            assert cache['b', name].flat[0] == 1
+        finally:
+            cache.unlink()
+
+    def test_generator_uses_shared_cache(self, generator_paths):
+        tm_in = GENERATOR_TMAPS_IN[0]
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=2, cache_size=1e6, keep_paths=True, shared_cache=True,
+        )
+        try:
+            for _ in range(3 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == _path_to_sample_value(path))
+            assert generator.shared_cache.stats()['cache_hits'] > 0
+        finally:
+            generator.kill_workers()
+
+
+def _scaled_tensor_from_file(scale):
+    read = GENERATOR_TMAPS_IN[0].tensor_from_file
+
+    def tensor_from_file(tm, hd5, dependents={}):
+        return read(tm, hd5, dependents) * scale
+    return tensor_from_file
+
+
+def _scaled_tensor_map(scale):
+    tm = GENERATOR_TMAPS_IN[0]
+    return TensorMap(tm.name, shape=tm.shape, interpretation=tm.interpretation, tensor_from_file=_scaled_tensor_from_file(scale))
+
+
+def _add_one(tensor):
+    return tensor + 1
+
+
+class TestPersistentTensorCache:
+    def _tensor(self, cache, tm, path, augment=False):
+        opened = []
+
+        def _get_hd5():
+            opened.append(h5py.File(path, 'r'))
+            return opened[-1]
+        try:
+            return cache.tensor(tm, path, augment, _get_hd5, {}), len(opened)
+        finally:
+            for hd5 in opened:
+                hd5.close()
+
+    def test_reused_across_runs(self, tmpdir, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        cache = PersistentTensorCache(str(tmpdir), [tm])
+        for path in generator_paths[:3]:
+            tensor, opens = self._tensor(cache, tm, path)
+            assert opens == 1 and np.all(tensor == _path_to_sample_value(path))
+        cache.close()
+        cache = PersistentTensorCache(str(tmpdir), [tm])
+        for path in generator_paths[:3]:
+            tensor, opens = self._tensor(cache, tm, path)
+            assert opens == 0 and np.all(tensor == _path_to_sample_value(path))
+        assert cache.stats['persistent_cache_hits'] == 3
+
+    def test_changed_definition_misses(self, tmpdir, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        cache = PersistentTensorCache(str(tmpdir), [tm])
+        self._tensor(cache, tm, generator_paths[0])
+        changed = TensorMap(tm.name, shape=tm.shape, interpretation=tm.interpretation, normalization=Standardize(1, 2))
+        cache = PersistentTensorCache(str(tmpdir), [changed])
+        tensor, opens = self._tensor(cache, changed, generator_paths[0])
+        assert opens == 1 and np.all(tensor == -.5)
+
+    def test_rewritten_hd5_misses(self, tmpdir, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        path = str(tmpdir.join(os.path.basename(generator_paths[0])))
+        shutil.copy(generator_paths[0], path)
+        cache = PersistentTensorCache(str(tmpdir.join('cache')), [tm])
+        self._tensor(cache, tm, path)
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        _, opens = self._tensor(cache, tm, path)
+        assert opens == 1
+
+    def test_augmentations_run_live(self, tmpdir, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        augmented = TensorMap(tm.name, shape=tm.shape, interpretation=tm.interpretation, augmentations=[_add_one])
+        cache = PersistentTensorCache(str(tmpdir), [augmented])
+        path = generator_paths[2]
+        for _ in range(2):
+            tensor, _ = self._tensor(cache, augmented, path, augment=True)
+            assert np.all(tensor == _path_to_sample_value(path) + 1)
+        tensor, opens = self._tensor(cache, augmented, path, augment=False)
+        assert opens == 0 and np.all(tensor == _path_to_sample_value(path))
+
+    def test_factory_parameters_miss(self, tmpdir, generator_paths):
+        assert tensor_map_fingerprint(_scaled_tensor_map(2)) == tensor_map_fingerprint(_scaled_tensor_map(2))
+        assert tensor_map_fingerprint(_scaled_tensor_map(2)) != tensor_map_fingerprint(_scaled_tensor_map(3))
+        path = generator_paths[5]
+        for scale in (2, 3):
+            tm = _scaled_tensor_map(scale)
+            tensor, opens = self._tensor(PersistentTensorCache(str(tmpdir), [tm]), tm, path)
+            assert opens == 1 and np.all(tensor == scale * _path_to_sample_value(path))
+
+    def test_generator_uses_persistent_cache(self, tmpdir, generator_paths):
+        tm_in = GENERATOR_TMAPS_IN[0]
+        for num_workers in [2, 0]:  # workers fill the cache, then the main thread reads it
+            generator = TensorGenerator(
+                batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+                paths=generator_paths, num_workers=num_workers, cache_size=0, keep_paths=True, tensor_cache_dir=str(tmpdir),
+            )
+            try:
+                for _ in range(pytest.N_TENSORS // 4):
+                    batch = next(generator)
+                    for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                        assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == _path_to_sample_value(path))
+            finally:
+                generator.kill_workers()
+        assert generator.worker_instances[0].persistent_cache.stats['persistent_cache_hits'] > 0
+
+
+class TestFusedHd5Reads:
+    def test_set_from_arguments(self, default_arguments):
+        generators = _generators_from_arguments(default_arguments, fused_hd5_reads=True)
+        try:
+            for generator in generators:
+                assert isinstance(generator, TensorGenerator)
+                next(generator)
+                assert generator.worker_instances[0].read_plan.samples_seen > 0
+        finally:
+            _kill(generators)
+
+    def test_view_reads_datasets_once(self, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        plan = Hd5ReadPlan(samples_to_learn=1)
+        hd5 = plan.open(generator_paths[3])
+        try:
+            first = tm.tensor_from_file(tm, hd5, {})
+            first[:] = -1  # callbacks may modify what they read
+            second = tm.tensor_from_file(tm, hd5, {})
+            assert np.all(second == 3)
+            assert len(hd5.datasets_read) == 1 and hd5.filename == hd5.hd5.filename
+            assert list(hd5) == list(hd5.hd5) and all(hd5.get(name) is hd5[name] for name in hd5.keys())
+            plan.learn(hd5)
+        finally:
+            hd5.close()
+        hd5 = plan.open(generator_paths[4])
+        try:
+            assert all(hd5[path]._data is not None for path in plan.datasets)
+            assert np.all(tm.tensor_from_file(tm, hd5, {}) == 4)
+        finally:
+            hd5.close()
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_batches_match_paths(self, generator_paths, num_workers):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=num_workers, cache_size=0, keep_paths=True, fused_hd5_reads=True,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        try:
+            for _ in range(2 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    value = _path_to_sample_value(path)
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == value)
+                    assert np.argmax(batch[BATCH_OUTPUT_INDEX][tm_out.output_name()][i]) == value % tm_out.shape[-1]
+        finally:
+            generator.kill_workers()
+
+
+@pytest.fixture(scope='module')
+def packed_dir(tmpdir_factory, generator_paths):
+    destination = str(tmpdir_factory.mktemp('packed'))
+    pack_hd5s_into_destination(
+        destination, [os.path.dirname(generator_paths[0])], 0, pytest.N_TENSORS, shard_bytes=4 * PACKED_ALIGNMENT,
+    )
+    return destination
+
+
+class TestPackedDataset:
+    def test_paths_match_source(self, packed_dir, generator_paths):
+        paths = list(tensor_paths(packed_dir))
+        assert sorted(map(_path_to_sample_value, paths)) == list(range(pytest.N_TENSORS))
+        assert len({shard for shard, _, _ in packed_dataset(packed_dir).locations.values()}) > 1
+        offsets = [offset for _, offset, _ in packed_dataset(packed_dir).locations.values()]
+        assert all(offset % PACKED_ALIGNMENT == 0 for offset in offsets)
+
+    def test_split_paths(self, packed_dir):
+        train, valid, test = get_train_valid_test_paths(packed_dir, None, .2, .2, None, None, None)
+        assert len(train) + len(valid) + len(test) == pytest.N_TENSORS
+
+    @pytest.mark.parametrize('fused_hd5_reads', [False, True])
+    def test_batches_match_paths(self, packed_dir, fused_hd5_reads):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=list(tensor_paths(packed_dir)), num_workers=2, cache_size=0, keep_paths=True,
+            fused_hd5_reads=fused_hd5_reads,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        try:
+            for _ in range(2 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    value = _path_to_sample_value(path)
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == value)
+                    assert np.argmax(batch[BATCH_OUTPUT_INDEX][tm_out.output_name()][i]) == value % tm_out.shape[-1]
+        finally:
+            generator.kill_workers()
+
+    def test_sample_getter(self, packed_dir):
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        sample_getter = TensorMapSampleGetter(GENERATOR_TMAPS_IN, GENERATOR_TMAPS_OUT)
+        for path in list(tensor_paths(packed_dir))[:5]:
+            in_batch, out_batch = sample_getter(path)
+            assert np.all(in_batch[tm_in.input_name()] == _path_to_sample_value(path))
+
+
+@pytest.fixture(scope='function')
+def index_tensors(tmpdir_factory):
+    temp_dir = str(tmpdir_factory.mktemp('index_tensors'))
+    build_hdf5s(temp_dir, GENERATOR_TMAPS_IN, n=10)
+    build_hdf5s(temp_dir, GENERATOR_TMAPS_IN + GENERATOR_TMAPS_OUT, n=6)  # only the first 6 samples have the output
+    return temp_dir
+
+
+class TestSampleIndex:
+    def test_build(self, index_tensors, tmpdir):
+        index_path = os.path.join(tmpdir, 'index.parquet')
+        index = build_sample_index(index_tensors, index_path, num_workers=1)
+        assert index['path'].nunique() == 10
+        assert set(index['dataset']) == {f'/{tm.name}' for tm in GENERATOR_TMAPS_IN + GENERATOR_TMAPS_OUT}
+        assert len(SampleIndex.load(index_path).paths()) == 10
+
+    def test_incremental_update(self, index_tensors, tmpdir, monkeypatch):
+        index_path = os.path.join(tmpdir, 'index.parquet')
+        build_sample_index(index_tensors, index_path, num_workers=1)
+        changed_path = os.path.join(index_tensors, f'7{TENSOR_EXT}')
+        with h5py.File(changed_path, 'a') as hd5:
+            hd5.create_dataset('2021-01-01/new', data=np.zeros(3))
+        scanned = []
+        monkeypatch.setattr(sample_index, '_scan_sample', lambda path_and_version: scanned.append(path_and_version[0]) or _scan_sample(path_and_version))
+        index = build_sample_index(index_tensors, index_path, num_workers=1)
+        assert scanned == [changed_path]
+        assert index['path'].nunique() == 10
+        assert index[index['dataset'] == '/2021-01-01/new']['date'].tolist() == ['2021-01-01']
+
+    def test_filter_by_tensor_maps(self, index_tensors, tmpdir):
+        index_path = os.path.join(tmpdir, 'index.parquet')
+        build_sample_index(index_tensors, index_path, num_workers=1)
+        index = SampleIndex.load(index_path)
+        paths = index.paths(GENERATOR_TMAPS_IN + GENERATOR_TMAPS_OUT)
+        assert sorted(map(_path_to_sample_value, paths)) == list(range(6))
+        declared = TensorMap('custom', shape=(1,), tensor_from_file=lambda tm, hd5, dependents: None, hd5_keys=['/missing'])
+        assert index.paths([declared]) == []
+        undeclared = TensorMap('custom', shape=(1,), tensor_from_file=lambda tm, hd5, dependents: None)
+        assert len(index.paths([undeclared])) == 10
+
+    def test_split_paths(self, index_tensors, tmpdir):
+        index_path = os.path.join(tmpdir, 'index.parquet')
+        build_sample_index(index_tensors, index_path, num_workers=1)
+        np.random.seed(3)  # a seed that puts at least one of the 6 samples in each split
+        train, valid, test = get_train_valid_test_paths(
+            index_tensors, None, .2, .2, None, None, None,
+            sample_index=index_path, tensor_maps=GENERATOR_TMAPS_IN + GENERATOR_TMAPS_OUT,
+        )
+        assert sorted(map(_path_to_sample_value, train + valid + test)) == list(range(6))
+
+
+def _loop_mixup(in_batch, out_batch, alpha):
+    """Per sample mixup, the reference for the vectorized batch function"""
+    half_batch = next(iter(in_batch.values())).shape[0] // 2
+    mixed = []
+    for batch in (in_batch, out_batch):
+        mixed.append({k: np.zeros((half_batch,) + v.shape[1:]) for k, v in batch.items()})
+    for i in range(half_batch):
+        weight = np.random.beta(alpha, alpha)
+        for batch, mixed_batch in zip((in_batch, out_batch), mixed):
+            for k in batch:
+                mixed_batch[k][i] = batch[k][i] * weight + batch[k][half_batch + i] * (1 - weight)
+    return mixed
+
+
+def _random_batches(batch_size):
+    in_batch = {'in_a': np.random.rand(batch_size, 3, 2).astype(np.float32), 'in_b': np.random.rand(batch_size).astype(np.float32)}
+    out_batch = {'out': np.eye(3, dtype=np.float32)[np.random.randint(3, size=batch_size)]}
+    return in_batch, out_batch
+
+
+class TestBatchFunctions:
+    def test_mixup_matches_loop(self):
+        in_batch, out_batch = _random_batches(16)
+        np.random.seed(2)
+        expected_in, expected_out = _loop_mixup(in_batch, out_batch, alpha=.4)
+        np.random.seed(2)
+        mixed_in, mixed_out, paths = _mixup_batch(in_batch, out_batch, True, [str(i) for i in range(16)], alpha=.4)
+        for expected, mixed in ((expected_in, mixed_in), (expected_out, mixed_out)):
+            assert expected.keys() == mixed.keys()
+            for k in expected:
+                np.testing.assert_allclose(mixed[k], expected[k], rtol=1e-6)
+        assert paths == [str(i) for i in range(8)]
+
+    def test_siamese_labels(self):
+        in_batch, out_batch = _random_batches(16)
+        siamese_in, siamese_out = _make_batch_siamese(in_batch, out_batch, False, [])
+        assert set(siamese_in) == {'in_a_left', 'in_a_right', 'in_b_left', 'in_b_right'}
+        np.testing.assert_array_equal(siamese_in['in_a_left'], in_batch['in_a'][:8])
+        np.testing.assert_array_equal(siamese_in['in_a_right'], in_batch['in_a'][8:])
+        differs = np.argmax(out_batch['out'][:8], axis=-1) != np.argmax(out_batch['out'][8:], axis=-1)
+        np.testing.assert_array_equal(siamese_out['output_siamese'][:, 0], differs)
+
+    @pytest.mark.parametrize('mixup_alpha, siamese', [(1.0, False), (0.0, True)])
+    def test_collate(self, mixup_alpha, siamese):
+        batch_function, kwargs, samples_per_row = pick_batch_function(mixup_alpha, siamese)
+        in_batch, out_batch = _random_batches(8 * samples_per_row)
+        samples = [
+            ({k: v[i] for k, v in in_batch.items()}, {k: v[i] for k, v in out_batch.items()}, str(i))
+            for i in range(8 * samples_per_row)
+        ]
+        collate = batch_function_collate(numpy_collate_fn, batch_function, True, **kwargs)
+        np.random.seed(3)
+        collated = collate(samples)
+        np.random.seed(3)
+        expected = batch_function(in_batch, out_batch, True, [sample[2] for sample in samples], **kwargs)
+        for collated_batch, expected_batch in zip(collated[:2], expected[:2]):
+            assert collated_batch.keys() == expected_batch.keys()
+            for k in expected_batch:
+                assert collated_batch[k].shape[0] == (4 if siamese else 8)
+                np.testing.assert_allclose(collated_batch[k], expected_batch[k], rtol=1e-6)
+        assert collated[2] == expected[2]
+
+    @pytest.mark.parametrize('mixup_alpha, siamese', [(1.0, False), (0.0, True)])
+    def test_data_loader_applies(self, mixup_alpha, siamese):
+        TensorMapDataLoader.can_apply(['path'], None, mixup_alpha, siamese)
+        assert pick_generator(['path'], None, mixup_alpha, siamese) is TensorMapDataLoader
+
+    def test_legacy_options_pick_legacy_generator(self):
+        assert pick_generator(['path'], None, 0, False, tf_data=True, legacy_options=[]) is TensorMapTfDataset
+        assert pick_generator(['path'], None, 0, False, tf_data=True, legacy_options=['buffer_pool']) is TensorGenerator
+        assert pick_generator([['path'], ['path']], [.5, .5], 1.0, False, legacy_options=['read_ahead']) is TensorGenerator
+
+
+class TestSamplers:
+    def test_epochs_are_deterministic(self):
+        sampler = ShuffleSampler(50, seed=7)
+        assert np.array_equal(sampler.epoch(3), ShuffleSampler(50, seed=7).epoch(3))
+        assert not np.array_equal(sampler.epoch(3), sampler.epoch(4))
+        assert sorted(sampler.epoch(3)) == list(range(50))
+
+    def test_weighted(self):
+        groups = np.array([0] * 90 + [1] * 10)
+        drawn = groups[WeightedSampler(groups, [.5, .5], num_samples=20000, seed=1).epoch(0)]
+        assert abs(drawn.mean() - .5) < .02
+        assert np.all(WeightedSampler(groups, [0, 1], seed=1).epoch(0) >= 90)
+
+    def test_class_balanced(self):
+        labels = np.array([0] * 80 + [1] * 15 + [2] * 5 + [MISSING_LABEL] * 5)
+        drawn = labels[ClassBalancedSampler(labels, num_samples=30000, seed=2).epoch(0)]
+        assert MISSING_LABEL not in drawn
+        np.testing.assert_allclose(np.bincount(drawn) / len(drawn), [1 / 3] * 3, atol=.02)
+
+    def test_stratified(self):
+        labels = np.array([0] * 75 + [1] * 25)
+        sampler = StratifiedSampler(labels, seed=3)
+        for epoch in range(3):
+            order = sampler.epoch(epoch)
+            assert sorted(order) == list(range(100))
+            for batch in np.split(labels[order], 10):
+                assert 1 <= batch.sum() <= 4
+
+    @pytest.mark.parametrize('num_workers', [0, 3])
+    def test_tensor_map_labels(self, generator_paths, num_workers, monkeypatch):
+        monkeypatch.setattr(sampler_module, 'LABEL_CHUNK_SIZE', 16)
+        labels = tensor_map_labels(generator_paths, GENERATOR_TMAPS_OUT[0], num_workers)
+        expected = [_path_to_sample_value(path) % GENERATOR_TMAPS_OUT[0].shape[-1] for path in generator_paths]
+        assert labels.tolist() == expected
+        assert set(tensor_map_labels(generator_paths, GENERATOR_TMAPS_IN[0], num_workers)) == set(range(STRATIFY_BINS))
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_weighted_data_loader(self, generator_paths, num_workers):
+        paths = [generator_paths[:90], generator_paths[90:]]
+        TensorMapDataLoader.can_apply(paths, [.5, .5], False, False)
+        loader = TensorMapDataLoader(
+            batch_size=10, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=paths, num_workers=num_workers, weights=[.5, .5], keep_paths=True, seed=4,
+        )
+        values = [_path_to_sample_value(path) for _ in range(20) for path in next(loader)[BATCH_PATHS_INDEX]]
+        assert len(values) == 200
+        assert 50 < sum(value >= 90 for value in values) < 150
+
+    def test_stratified_data_loader_epochs(self, generator_paths):
+        def _epoch_paths(loader):
+            return [path for _ in range(10) for path in next(loader)[BATCH_PATHS_INDEX]]
+        loaders = [
+            TensorMapDataLoader(
+                batch_size=10, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+                paths=generator_paths, num_workers=0, keep_paths=True, sampler='stratified', seed=5,
+            )
+            for _ in range(2)
+        ]
+        first_epochs = [_epoch_paths(loader) for loader in loaders]
+        assert first_epochs[0] == first_epochs[1]
+        assert sorted(first_epochs[0]) == sorted(generator_paths)
+        assert _epoch_paths(loaders[0]) != first_epochs[0]
+
+    def test_worker_without_valid_samples(self, generator_paths, tmpdir):
+        bad_paths = [os.path.join(tmpdir, f'bad_{i}{TENSOR_EXT}') for i in range(7)]
+        for bad_path in bad_paths:
+            with open(bad_path, 'w') as bad_file:
+                bad_file.write('not an hd5')
+        loader = TensorMapDataLoader(
+            batch_size=1, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths[:1] + bad_paths, num_workers=4, keep_paths=True, seed=6,
+        )
+        for _ in range(3):  # at most one worker has the valid sample each epoch
+            assert next(loader)[BATCH_PATHS_INDEX] == generator_paths[:1]
+        loader = TensorMapDataLoader(
+            batch_size=1, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=bad_paths, num_workers=4,
+        )
+        with pytest.raises(ValueError):
+            next(loader)
+
+
+class TestTfDataset:
+    @pytest.mark.parametrize('cache_tensors', [False, True])
+    def test_batches_match_paths(self, generator_paths, cache_tensors):
+        dataset = TensorMapTfDataset(
+            batch_size=8, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=2, keep_paths=True, cache_tensors=cache_tensors, seed=1,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        seen = set()
+        for _ in range(2 * pytest.N_TENSORS // 8):
+            in_batch, out_batch, paths = next(dataset)
+            assert in_batch[tm_in.input_name()].shape == (8,) + tm_in.static_shape()
+            assert in_batch[tm_in.input_name()].dtype == np.float32
+            for i, path in enumerate(paths):
+                value = _path_to_sample_value(path)
+                assert np.all(in_batch[tm_in.input_name()][i] == value)
+                assert np.argmax(out_batch[tm_out.output_name()][i]) == value % tm_out.shape[-1]
+                seen.add(path)
+        assert seen == set(generator_paths)
+
+    def test_skips_unreadable(self, generator_paths, tmpdir):
+        bad_path = os.path.join(tmpdir, f'bad{TENSOR_EXT}')
+        with open(bad_path, 'w') as bad_file:
+            bad_file.write('not an hd5')
+        dataset = TensorMapTfDataset(
+            batch_size=10, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths[:10] + [bad_path], num_workers=0, keep_paths=True,
+        )
+        for _ in range(3):
+            assert bad_path not in next(dataset)[BATCH_PATHS_INDEX]
+
+    def test_weighted(self, generator_paths):
+        dataset = TensorMapTfDataset(
+            batch_size=10, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=[generator_paths[:90], generator_paths[90:]], weights=[.5, .5], num_workers=2, keep_paths=True, seed=2,
+        )
+        values = [_path_to_sample_value(path) for _ in range(20) for path in next(dataset)[BATCH_PATHS_INDEX]]
+        assert 50 < sum(value >= 90 for value in values) < 150
+
+    @pytest.mark.parametrize('tf_data_cache', [False, True])
+    def test_cache_set_from_arguments(self, default_arguments, tf_data_cache):
+        generators = _generators_from_arguments(default_arguments, tf_data=True, tf_data_cache=tf_data_cache)
+        for generator in generators:
+            assert isinstance(generator, TensorMapTfDataset)
+            next(generator)
+        assert [generator.cache_tensors for generator in generators] == [tf_data_cache, tf_data_cache, False]
+
+    def test_pick_generator(self, generator_paths):
+        assert pick_generator(generator_paths, None, 0, False, tf_data=True) is TensorMapTfDataset
+        assert pick_generator(generator_paths, None, 1.0, False, tf_data=True) is TensorMapDataLoader
+
+
+class TestReadAhead:
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    @pytest.mark.parametrize('fused_hd5_reads', [False, True])
+    def test_batches_match_paths(self, generator_paths, num_workers, fused_hd5_reads):
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths, num_workers=num_workers, cache_size=0, keep_paths=True,
+            fused_hd5_reads=fused_hd5_reads, read_ahead=3,
+        )
+        tm_in, tm_out = GENERATOR_TMAPS_IN[0], GENERATOR_TMAPS_OUT[0]
+        try:
+            for _ in range(2 * pytest.N_TENSORS // 4):
+                batch = next(generator)
+                for i, path in enumerate(batch[BATCH_PATHS_INDEX]):
+                    value = _path_to_sample_value(path)
+                    assert np.all(batch[BATCH_INPUT_INDEX][tm_in.input_name()][i] == value)
+                    assert np.argmax(batch[BATCH_OUTPUT_INDEX][tm_out.output_name()][i]) == value % tm_out.shape[-1]
+        finally:
+            generator.kill_workers()
+
+    def test_depth_is_bounded(self, generator_paths):
+        reads = _ReadAheadPaths(iter(generator_paths), 3, lambda path: True)
+        for path in generator_paths[:10]:
+            assert next(reads) == path
+            assert len(reads.pending) == 3
+            with open(path, 'rb') as hd5_file:
+                assert reads.take() == hd5_file.read()
+        reads.cancel()
+        assert not reads.pending and reads.take() is None
+
+    def test_epoch_end_cancel_keeps_paths(self, generator_paths):
+        reads = _ReadAheadPaths(iter(generator_paths), 3, lambda path: True)
+        for i, path in enumerate(generator_paths[:10]):
+            if i % 4 == 3:
+                reads.cancel(keep_paths=True)
+            assert next(reads) == path
+            with open(path, 'rb') as hd5_file:
+                assert reads.take() == hd5_file.read()
+        reads.shutdown()
+        with pytest.raises(RuntimeError):  # the pool's threads are stopped
+            reads.pool.submit(print)
+
+    def test_set_from_arguments(self, default_arguments):
+        generators = _generators_from_arguments(default_arguments, read_ahead=2)
+        try:
+            for generator in generators:
+                assert isinstance(generator, TensorGenerator)
+                next(generator)
+                assert generator.worker_instances[0].read_ahead_paths is not None
+        finally:
+            _kill(generators)
+        assert all(generator.worker_instances[0].read_ahead_paths is None for generator in generators)
+
+    def test_skips_cached_and_unreadable(self, generator_paths, tmpdir):
+        bad_path = os.path.join(tmpdir, f'bad{TENSOR_EXT}')
+        with open(bad_path, 'w') as bad_file:
+            bad_file.write('not an hd5')
+        generator = TensorGenerator(
+            batch_size=5, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths[:9] + [bad_path], num_workers=0, cache_size=1e8, keep_paths=True, read_ahead=2,
+        )
+        try:
+            for _ in range(4):
+                assert bad_path not in next(generator)[BATCH_PATHS_INDEX]
+            worker = generator.worker_instances[0]
+            assert bad_path in worker.cache.failed_paths
+            assert not worker._needs_read(bad_path)
+            assert not any(worker._needs_read(path) for path in generator_paths[:9])
+        finally:
+            generator.kill_workers()
+
+
+class TestEpochStats:
+    def test_merge(self):
+        merged = merge_worker_stats([
+            Counter({'a_max': 3, 'a_min': 2, 'n': 1}),
+            Counter({'a_max': 5, 'a_min': 1, 'n': 2}),
+        ])
+        assert merged == Counter({'a_max': 5, 'a_min': 1, 'n': 3})
+
+    def test_aggregator_waits_for_all_workers(self):
+        aggregator = EpochStatsAggregator(2)
+        tm_stats = Counter({('tm', 'tensors'): 3, ('tm', f'{TENSOR_MAP_ERROR_PREFIX}KeyError'): 1})
+        assert aggregator.add('w0', 1, Counter({'Tensors presented': 3}), tm_stats) is None
+        assert aggregator.add('w0', 2, Counter({'Tensors presented': 3}), tm_stats) is None  # workers can run ahead
+        epoch_stats = aggregator.add('w1', 1, Counter({'Tensors presented': 4}), tm_stats)
+        assert epoch_stats.epoch == 1
+        assert epoch_stats.merged['Tensors presented'] == 7
+        metrics = epoch_stats.metrics('train')
+        assert metrics['tensor_maps']['tm']['tensors'] == 6
+        assert metrics['tensor_maps']['tm']['errors'] == {'KeyError': 2}
+        assert metrics['workers']['w0']['errors'] == {'KeyError': 1}
+        assert list(aggregator.pending) == [2]
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_metrics_json(self, generator_paths, tmpdir, num_workers):
+        metrics_path = os.path.join(tmpdir, 'metrics.jsonl')
+        bad_path = os.path.join(tmpdir, f'bad{TENSOR_EXT}')
+        with open(bad_path, 'w') as bad_file:
+            bad_file.write('not an hd5')
+        paths = generator_paths[:19] + [bad_path]
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=paths, num_workers=num_workers, cache_size=0, metrics_path=metrics_path,
+        )
+        try:
+            for _ in range(200):
+                next(generator)
+                if generator.epoch_metrics:
+                    break
+        finally:
+            generator.kill_workers()
+        with open(metrics_path) as metrics_file:
+            metrics = [json.loads(line) for line in metrics_file]
+        assert metrics[0] == generator.epoch_metrics[0]
+        assert len(metrics[0]['workers']) == max(num_workers, 1)
+        tm_in = GENERATOR_TMAPS_IN[0]
+        assert metrics[0]['tensor_maps'][tm_in.name]['read_seconds'] > 0
+        assert metrics[0]['tensor_maps'][tm_in.name]['errors'] == {'OSError': 1}
+        presented = sum(worker['Tensors presented'] for worker in metrics[0]['workers'].values())
+        assert presented == metrics[0]['tensor_maps'][tm_in.name]['tensors'] - 1  # the unreadable file is not presented
+
+
+    def test_set_from_arguments(self, default_arguments, tmpdir):
+        generators = _generators_from_arguments(default_arguments, generator_metrics=True, output_folder=str(tmpdir))
+        generate_valid = generators[1]
+        try:
+            assert all(isinstance(generator, TensorGenerator) for generator in generators)
+            for _ in range(200):
+                next(generate_valid)
+                if generate_valid.epoch_metrics:
+                    break
+        finally:
+            _kill(generators)
+        with open(os.path.join(tmpdir, default_arguments.id, 'validation_worker_metrics.jsonl')) as metrics_file:
+            assert json.loads(metrics_file.readline()) == generate_valid.epoch_metrics[0]
+
+
+class TestTensorMapProfiler:
+    def test_histogram_percentiles(self):
+        values = np.random.default_rng(0).lognormal(12, 2, size=5000).astype(np.int64)
+        histogram = LogLinearHistogram()
+        for value in values:
+            histogram.record(value)
+        for percentile in (50, 90, 99):
+            true_value = np.percentile(values, percentile, method='inverted_cdf')
+            assert true_value <= histogram.percentile(percentile) <= true_value * (1 + 1 / HISTOGRAM_SUB_BUCKETS)
+        assert histogram.max == values.max()
+        assert histogram.percentile(100) == values.max()
+
+    def test_histogram_buckets_cover_values(self):
+        for value in range(20000):
+            bucket = LogLinearHistogram.bucket(value)
+            assert LogLinearHistogram.bucket_value(bucket - 1) < value <= LogLinearHistogram.bucket_value(bucket)
+
+    def test_merge(self):
+        merged, first, second = TensorMapProfiler(), TensorMapProfiler(), TensorMapProfiler()
+        first.record('tm', 'read', 100, 8)
+        second.record('tm', 'read', 300, 16)
+        second.record('tm', 'normalize', 50, 16)
+        third = TensorMapProfiler()
+        third.record('tm', 'read', 200, 8, allocated_bytes=64, read_bytes=32)
+        merged.merge(first)
+        merged.merge(second)
+        merged.merge(third)
+        assert merged.nanoseconds['tm', 'read'].count == 3
+        assert merged.nbytes['tm', 'read'].max == 16
+        assert merged.allocated_bytes['tm', 'read'].max == 64
+        assert merged.read_bytes['tm', 'read'].total == 32
+        assert len(merged) == 2
+
+    def test_postprocess_stages(self, generator_paths):
+        tm = GENERATOR_TMAPS_IN[0]
+        profiler = TensorMapProfiler()
+        with h5py.File(generator_paths[0], 'r') as hd5:
+            raw = profiler.read(tm, hd5, {})
+            profiled = tm.postprocess_tensor(raw, augment=False, hd5=hd5, profiler=profiler)
+            expected = tm.postprocess_tensor(tm.tensor_from_file(tm, hd5, {}), augment=False, hd5=hd5)
+        np.testing.assert_array_equal(profiled, expected)
+        summary = profiler.summary()
+        assert set(summary['stage']) == {'read', 'validate', 'augment', 'normalize', 'discretize'}
+        assert (summary['count'] == 1).all()
+        assert (summary['mean_bytes'] == raw.nbytes).all()
+        read = summary.set_index('stage').loc['read']
+        assert read['mean_allocated_bytes'] >= raw.nbytes
+        if os.path.exists(THREAD_IO_PATH):
+            assert read['mean_read_bytes'] > 0
+        assert (summary.set_index('stage').drop(index='read')['mean_read_bytes'] == 0).all()
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_generator_profile(self, generator_paths, tmpdir, num_workers):
+        profile_path = os.path.join(tmpdir, 'profile.tsv')
+        generator = TensorGenerator(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths[:20], num_workers=num_workers, cache_size=0, profile_path=profile_path,
+        )
+        try:
+            for _ in range(200):
+                next(generator)
+                if generator.epoch_metrics:
+                    break
+        finally:
+            generator.kill_workers()
+        profile = pd.read_csv(profile_path, sep='\t')
+        profile = profile[profile['epoch'] == profile['epoch'].min()]  # workers may have finished more epochs
+        reads = profile[(profile['tensor_map'] == GENERATOR_TMAPS_IN[0].name) & (profile['stage'] == 'read')]
+        assert reads['count'].sum() == generator.epoch_metrics[0]['tensor_maps'][GENERATOR_TMAPS_IN[0].name]['tensors']
+        assert (profile['p50_ms'] <= profile['p99_ms']).all()
+
+    @pytest.mark.parametrize('num_workers', [0, 2])
+    def test_data_loader_profile(self, generator_paths, tmpdir, num_workers):
+        loader = TensorMapDataLoader(
+            batch_size=4, input_maps=GENERATOR_TMAPS_IN, output_maps=GENERATOR_TMAPS_OUT,
+            paths=generator_paths[:20], num_workers=num_workers, name='train', profile_dir=str(tmpdir),
+        )
+        for _ in range(6):
+            next(loader)
+        profiles = pd.concat([
+            pd.read_csv(os.path.join(tmpdir, f'train_{worker_id}_tensor_map_profile.tsv'), sep='\t')
+            for worker_id in range(max(num_workers, 1))
+        ])
+        assert set(profiles['epoch']) == {0}
+        assert profiles[profiles['stage'] == 'read']['count'].sum() == 20 * 2  # an input and an output TensorMap per sample
+